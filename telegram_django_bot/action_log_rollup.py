@@ -0,0 +1,88 @@
+import datetime
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import ActionLog, ActionLogDailyCount
+
+
+ROLLUP_CHUNK_SIZE = 2000  # amount of ActionLogDailyCount in 1 bulk_create
+
+
+def get_day_start(day):
+    """ start of the day in the current timezone (days of ActionLogDailyCount are in the current timezone) """
+    dttm = datetime.datetime.combine(day, datetime.time.min)
+    return timezone.make_aware(dttm) if settings.USE_TZ else dttm
+
+
+def get_local_date(dttm):
+    return timezone.localdate(dttm) if settings.USE_TZ else dttm.date()
+
+
+@dataclass(frozen=True)
+class RollupDays:
+    """ ActionLogDailyCount of days in [first_day, last_day) are complete, last_day could be partial """
+    first_day: datetime.date
+    last_day: datetime.date
+
+    def get_full_days(self, dttm_start):
+        """
+        :return: [first, last) days of rollup inside the window from dttm_start or None if the window is not covered
+            by rollup (ActionLog of the window start day before first and from last day are counted from raw logs)
+        """
+        first = get_local_date(dttm_start) + datetime.timedelta(days=1)
+        if first < self.first_day or first >= self.last_day:
+            return None
+        return first, self.last_day
+
+
+def get_rollup_days():
+    """ :return: RollupDays or None if there are no complete days in ActionLogDailyCount """
+    days = ActionLogDailyCount.objects.aggregate(first_day=Min('day'), last_day=Max('day'))
+    if days['first_day'] is None or days['first_day'] == days['last_day']:
+        return None
+    return RollupDays(days['first_day'], days['last_day'])
+
+
+def rollup_action_logs(since=None, chunk_size=ROLLUP_CHUNK_SIZE):
+    """
+    ActionLog are counted by user, type and day in ActionLogDailyCount. Only days from the last rolled up day
+    are recounted, so the function is called periodically (rollup_action_logs task) and is cheap for big ActionLog.
+
+    :param since: first day of the first rollup (by default -- the day of the first ActionLog), earlier
+        windows of trigger conditions are counted from raw logs
+    :return: amount of created ActionLogDailyCount
+    """
+    from_day = ActionLogDailyCount.objects.aggregate(day=Max('day'))['day']
+    if from_day is None:
+        if since is None:
+            first_dttm = ActionLog.objects.aggregate(dttm=Min('dttm'))['dttm']
+            if first_dttm is None:
+                return 0
+            since = get_local_date(first_dttm)
+        from_day = since
+
+    day_counts = ActionLog.objects.filter(
+        user__isnull=False,
+        dttm__gte=get_day_start(from_day),
+    ).annotate(day=TruncDate('dttm')).values('user_id', 'type', 'day').annotate(amount=Count('id')).order_by()
+
+    amount = 0
+    with transaction.atomic():
+        ActionLogDailyCount.objects.filter(day__gte=from_day).delete()
+
+        chunk = []
+        for day_count in day_counts.iterator(chunk_size=chunk_size):
+            chunk.append(ActionLogDailyCount(**day_count))
+            if len(chunk) == chunk_size:
+                ActionLogDailyCount.objects.bulk_create(chunk)
+                amount += len(chunk)
+                chunk = []
+
+        ActionLogDailyCount.objects.bulk_create(chunk)
+        amount += len(chunk)
+    return amount
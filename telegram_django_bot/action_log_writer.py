@@ -0,0 +1,237 @@
+import asyncio
+import atexit
+import logging
+import threading
+
+from asgiref.sync import sync_to_async
+from django.db import connection
+
+from .models import ActionLog
+from .settings_backends import BackendFromSettings
+
+
+class BaseActionLogWriter:
+    def add(self, user_id, action):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def start(self):
+        """ start of background writing, it is called in the event loop for asyncio writers """
+        pass
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        await sync_to_async(self.close)()
+
+
+class SyncActionLogWriter(BaseActionLogWriter):
+    """ each log is created immediately with 1 query (default) """
+
+    def add(self, user_id, action):
+        ActionLog.objects.create(type=action, user_id=user_id)
+
+
+class BufferedActionLogWriter(BaseActionLogWriter):
+    """
+    Logs are collected in the bounded buffer and created with bulk_create by flush.
+    Descendants call flush in background (by size of buffer or by time interval).
+
+    max_batch_size -- amount of logs in 1 bulk_create (and amount of logs for flushing without waiting interval)
+    flush_interval -- seconds between flushes
+    max_queue_size -- buffer size, if it is full then overflow_policy is used:
+        'drop' -- new log is dropped (and counted in dropped_amount)
+        'block' -- adding waits block_timeout seconds for free space, then log is dropped
+    """
+
+    OVERFLOW_DROP = 'drop'
+    OVERFLOW_BLOCK = 'block'
+
+    def __init__(
+            self,
+            max_batch_size=500,
+            flush_interval=1.0,
+            max_queue_size=10000,
+            overflow_policy=OVERFLOW_DROP,
+            block_timeout=1.0,
+            **kwargs
+    ):
+        if overflow_policy not in (self.OVERFLOW_DROP, self.OVERFLOW_BLOCK):
+            raise ValueError(f'unknown overflow_policy {overflow_policy}')
+
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+
+        self.written_amount = 0
+        self.dropped_amount = 0
+
+        self._buffer = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+
+    @property
+    def queue_size(self):
+        return len(self._buffer)
+
+    def add(self, user_id, action):
+        log = ActionLog(type=action, user_id=user_id)
+
+        with self._condition:
+            if len(self._buffer) >= self.max_queue_size and self.overflow_policy == self.OVERFLOW_BLOCK:
+                self._condition.wait_for(lambda: len(self._buffer) < self.max_queue_size, self.block_timeout)
+
+            if len(self._buffer) >= self.max_queue_size:
+                self.dropped_amount += 1
+                if self.dropped_amount % 1000 == 1:
+                    logging.warning(f'ActionLog buffer is full, {self.dropped_amount} logs are dropped')
+                return
+
+            self._buffer.append(log)
+            is_batch_ready = len(self._buffer) >= self.max_batch_size
+            if is_batch_ready:
+                self._condition.notify_all()
+
+        self._on_log_added(is_batch_ready)
+
+    def _on_log_added(self, is_batch_ready):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._condition:
+                logs, self._buffer = self._buffer, []
+                self._condition.notify_all()  # free space for blocked adding
+
+            for start in range(0, len(logs), self.max_batch_size):
+                batch = logs[start: start + self.max_batch_size]
+                try:
+                    ActionLog.objects.bulk_create(batch)
+                    self.written_amount += len(batch)
+                except Exception as error:
+                    self.dropped_amount += len(batch)
+                    logging.error(f'{len(batch)} action logs are not saved: {error}')
+
+
+class ThreadActionLogWriter(BufferedActionLogWriter):
+    """ flushes logs from a background thread (for sync python-telegram-bot), the thread is started on first log """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._thread = None
+        self._is_stopped = False
+        self._start_lock = threading.Lock()
+
+    def _on_log_added(self, is_batch_ready):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None and not self._is_stopped:
+                    self._thread = threading.Thread(target=self._run, name='ActionLogWriter', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    def _run(self):
+        try:
+            while not self._is_stopped:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._is_stopped or len(self._buffer) >= self.max_batch_size,
+                        self.flush_interval
+                    )
+                self.flush()
+        finally:
+            connection.close()
+
+    def close(self):
+        """ stop the thread and write all collected logs """
+        self._is_stopped = True
+        with self._condition:
+            self._condition.notify_all()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+
+class AsyncioActionLogWriter(BufferedActionLogWriter):
+    """
+    flushes logs from an asyncio task (for python-telegram-bot 20+). The task is started by start() in the event loop
+    (Application post_init or the first update of AsyncRouterCallbackMessageCommandHandler and async_handler_decor),
+    logs are usually added from sync_to_async threads and wake up the task with call_soon_threadsafe.
+    aclose() should be awaited on shutdown (for example, in post_shutdown), left logs are also flushed at exit.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._task = None
+        self._loop = None
+        self._batch_ready = None
+
+    def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._batch_ready = asyncio.Event()
+            self._task = self._loop.create_task(self.run())
+            atexit.register(self.flush)
+
+    def _on_log_added(self, is_batch_ready):
+        if self._task is None:
+            try:
+                self.start()
+            except RuntimeError:
+                # not in the event loop thread and the task is not started: logs are written here by batches,
+                # so they are not accumulated until the buffer overflow
+                if is_batch_ready:
+                    self.flush()
+                return
+
+        if is_batch_ready:
+            try:
+                self._loop.call_soon_threadsafe(self._batch_ready.set)
+            except RuntimeError:  # the loop is closed without aclose
+                self.flush()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await sync_to_async(self.flush)()
+
+    async def aclose(self):
+        """ stop the task and write all collected logs """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await sync_to_async(self.flush)()
+
+
+_action_log_writer = BackendFromSettings(
+    'TELEGRAM_ACTION_LOG_WRITER',
+    default={'BACKEND': 'telegram_django_bot.action_log_writer.SyncActionLogWriter'},
+)
+
+
+def get_action_log_writer():
+    """
+    Writer from settings TELEGRAM_ACTION_LOG_WRITER, for example:
+        TELEGRAM_ACTION_LOG_WRITER = {
+            'BACKEND': 'telegram_django_bot.action_log_writer.ThreadActionLogWriter',
+            'OPTIONS': {'max_batch_size': 500, 'flush_interval': 1, 'max_queue_size': 10000},
+        }
+    """
+    return _action_log_writer.get()
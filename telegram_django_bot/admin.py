@@ -6,7 +6,10 @@ from django.http import HttpResponse
 from django.db.models import Count
 from django.contrib import admin
 
-from .models import TeleDeepLink, ActionLog, Trigger, UserTrigger, BotMenuElem, BotMenuElemAttrText
+from .models import (
+    TeleDeepLink, ActionLog, ActionLogDailyCount, Trigger, UserTrigger, BotMenuElem, BotMenuElemAttrText,
+    TelegramFileCode,
+)
 from .admin_utils import CustomRelatedOnlyDropdownFilter, DefaultOverrideAdminWidgetsForm
 
 
@@ -79,6 +82,14 @@ class ActionLogAdmin(CustomModelAdmin):
     raw_id_fields = ('user', )
 
 
+@admin.register(ActionLogDailyCount)
+class ActionLogDailyCountAdmin(CustomModelAdmin):
+    list_display = ('id', 'user', 'day', 'type', 'amount')
+    search_fields = ('type__startswith',)
+    list_filter = ('type', 'day')
+    raw_id_fields = ('user',)
+
+
 @admin.register(TeleDeepLink)
 class TeleDeepLinkAdmin(CustomModelAdmin):
     list_display = ('id', 'title', 'price', 'link', 'count_users')
@@ -121,6 +132,13 @@ class BotMenuElemAttrTextAdmin(CustomModelAdmin):
     list_filter = ('language_code', 'bot_menu_elem')
 
 
+@admin.register(TelegramFileCode)
+class TelegramFileCodeAdmin(CustomModelAdmin):
+    list_display = ('id', 'dttm_added', 'content_hash', 'message_format', 'file_code')
+    search_fields = ('content_hash', 'file_code')
+    list_filter = ('message_format',)
+
+
 class TriggerAdminForm(DefaultOverrideAdminWidgetsForm):
     json_fields = ['condition_db',]
 
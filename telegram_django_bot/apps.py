@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class TelegramDjangoBotConfig(AppConfig):
     name = 'telegram_django_bot'
+
+    def ready(self):
+        from . import user_cache, bme_index, file_registry, count_cache  # connect signals
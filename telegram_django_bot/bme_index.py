@@ -0,0 +1,296 @@
+import copy
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import BotMenuElem, BotMenuElemAttrText
+from .settings_backends import BackendFromSettings
+
+
+_FROM_SETTINGS = object()
+
+
+class SharedVersion:
+    """ version of in-memory data in the django cache, so all bot processes see changes made in any of them """
+
+    def __init__(self, cache_alias, key):
+        self.cache_alias = cache_alias
+        self.key = key
+
+    def get(self):
+        return caches[self.cache_alias].get(self.key) if self.cache_alias else None
+
+    def incr(self):
+        if self.cache_alias:
+            cache = caches[self.cache_alias]
+            try:
+                cache.incr(self.key)
+            except ValueError:
+                cache.set(self.key, 1, None)
+
+
+class BotMenuElemIndex:
+    """
+    In-memory dictionaries {command: [BotMenuElem ids]} and {callback: [BotMenuElem ids]}, built from
+    BotMenuElem.command lines and BotMenuElem.callbacks. So commands and callbacks are matched exactly
+    (not by substring) without scanning the table.
+
+    The index is rebuilt after BotMenuElem saving or deleting. Changes of other processes (for example, in admin site)
+    are seen after the version change in cache_alias (if the cache is shared between processes) or after timeout
+    seconds. Changes made by queryset.update or bulk_create are not caught by signals, call invalidate() after them.
+
+    cache_alias -- cache of the shared version, None -- without shared version
+        (TELEGRAM_BME_INDEX_CACHE setting by default, 'default' cache if it is not set)
+    timeout -- seconds of the index life, None -- without timeout
+        (TELEGRAM_BME_INDEX_TIMEOUT setting by default, 60 if it is not set)
+    version_check_interval -- the shared version is requested from the cache at most once in this amount of seconds
+        (not on each lookup), so changes of other processes are seen with this delay
+    """
+    VERSION_CACHE_KEY = 'telegram_django_bot_bme_index_version'
+
+    def __init__(self, cache_alias=_FROM_SETTINGS, timeout=_FROM_SETTINGS, version_check_interval=1):
+        self._cache_alias = cache_alias
+        self._timeout = timeout
+        self.version_check_interval = version_check_interval
+        self._commands = None
+        self._callbacks = None
+        self._version = 0
+        self._shared_version = None
+        self._built_at = 0
+        self._version_checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cache_alias(self):
+        if self._cache_alias is _FROM_SETTINGS:
+            return getattr(settings, 'TELEGRAM_BME_INDEX_CACHE', 'default')
+        return self._cache_alias
+
+    @property
+    def timeout(self):
+        if self._timeout is _FROM_SETTINGS:
+            return getattr(settings, 'TELEGRAM_BME_INDEX_TIMEOUT', 60)
+        return self._timeout
+
+    @property
+    def shared_version(self):
+        return SharedVersion(self.cache_alias, self.VERSION_CACHE_KEY)
+
+    def invalidate(self, local_only=False):
+        with self._lock:
+            self._version += 1
+            self._commands = None
+            self._callbacks = None
+
+        if not local_only:
+            self.shared_version.incr()
+
+    def build(self):
+        version = self._version
+        shared_version = self.shared_version.get()
+        built_at = time.monotonic()
+        commands = {}
+        callbacks = {}
+
+        bme_rows = BotMenuElem.objects.order_by('id').values_list('id', 'command', 'callbacks_db')
+        for bme_id, command, callbacks_db in bme_rows:
+            for command_line in (command or '').splitlines():
+                if command_line := command_line.strip():
+                    commands.setdefault(command_line, []).append(bme_id)
+
+            try:
+                bme_callbacks = json.loads(callbacks_db)
+            except ValueError:
+                logging.warning(f'BME({bme_id}) has not valid callbacks_db: {callbacks_db}')
+                bme_callbacks = []
+
+            for callback in bme_callbacks:
+                callbacks.setdefault(str(callback), []).append(bme_id)
+
+        with self._lock:
+            if version == self._version:
+                self._commands = commands
+                self._callbacks = callbacks
+                self._shared_version = shared_version
+                self._built_at = self._version_checked_at = built_at
+        return commands, callbacks
+
+    def is_outdated(self):
+        now = time.monotonic()
+        timeout = self.timeout
+        if timeout is not None and now - self._built_at > timeout:
+            return True
+
+        if now - self._version_checked_at < self.version_check_interval:
+            return False
+        self._version_checked_at = now
+        return self.shared_version.get() != self._shared_version
+
+    def _get_dicts(self):
+        commands, callbacks = self._commands, self._callbacks
+        if commands is not None and callbacks is not None and self.is_outdated():
+            self.invalidate(local_only=True)
+            commands = None
+
+        if commands is None or callbacks is None:
+            commands, callbacks = self.build()
+        return commands, callbacks
+
+    def get_command_ids(self, command) -> list:
+        return self._get_dicts()[0].get(command, [])
+
+    def get_callback_ids(self, callback) -> list:
+        return self._get_dicts()[1].get(callback, [])
+
+
+bme_index = BotMenuElemIndex()
+
+
+class BotMenuElemSnapshot:
+    """
+    Process-level snapshot of all visible BotMenuElem with parsed buttons and callbacks, translations for all
+    languages and telegram_file_code, so BME handlers do not request db at all. The snapshot is loaded on first
+    use (or by load() on bot start) and dropped after saving or deleting BotMenuElem or BotMenuElemAttrText.
+
+    cache_alias -- if set, the snapshot version is stored in the django cache, so all bot processes reload
+    their snapshots after changes in any of them (for example, in admin site)
+    """
+    VERSION_CACHE_KEY = 'telegram_django_bot_bme_snapshot_version'
+
+    def __init__(self, cache_alias=None, **kwargs):
+        self.cache_alias = cache_alias
+        self.shared_version = SharedVersion(cache_alias, self.VERSION_CACHE_KEY)
+        self._data = None
+        self._version = 0
+        self._cache_version = None
+        self._lock = threading.Lock()
+
+    def invalidate(self, local_only=False):
+        with self._lock:
+            self._version += 1
+            self._data = None
+
+        if not local_only:
+            self.shared_version.incr()
+
+    def load(self):
+        version = self._version
+        cache_version = self.shared_version.get()
+
+        language_codes = set(map(lambda x: x[0], settings.LANGUAGES)) - {settings.LANGUAGE_CODE}
+        translations = {}
+        for bme_id, language_code, default_text, translated_text in BotMenuElemAttrText.objects.filter(
+            bot_menu_elem__is_visable=True,
+            translated_text__isnull=False,
+        ).values_list('bot_menu_elem_id', 'language_code', 'default_text', 'translated_text'):
+            translations.setdefault(bme_id, {}).setdefault(language_code, {})[default_text] = translated_text
+
+        commands = {}
+        callbacks = {}
+        empty_block = None
+        for menu_elem in BotMenuElem.objects.filter(is_visable=True).order_by('id'):
+            menu_elem.buttons, menu_elem.callbacks  # parse json once
+            for language_code in language_codes:
+                menu_elem.set_translations(language_code, translations.get(menu_elem.id, {}).get(language_code, {}))
+
+            for command_line in (menu_elem.command or '').splitlines():
+                if command_line := command_line.strip():
+                    commands.setdefault(command_line, menu_elem)
+            for callback in menu_elem.callbacks:
+                callbacks.setdefault(str(callback), menu_elem)
+            if menu_elem.empty_block and empty_block is None:
+                empty_block = menu_elem
+
+        data = {'commands': commands, 'callbacks': callbacks, 'empty_block': empty_block}
+        with self._lock:
+            if version == self._version:
+                self._data = data
+                self._cache_version = cache_version
+        return data
+
+    def _get_data(self):
+        data = self._data
+        if data is not None and self.cache_alias and self.shared_version.get() != self._cache_version:
+            self.invalidate(local_only=True)
+            data = None
+
+        if data is None:
+            data = self.load()
+        return data
+
+    @staticmethod
+    def _copy(menu_elem):
+        # copy for changing telegram_file_code and etc. without influence on snapshot
+        return copy.copy(menu_elem) if menu_elem else None
+
+    def get_command_bme(self, command):
+        return self._copy(self._get_data()['commands'].get(command))
+
+    def get_callback_bme(self, callback):
+        return self._copy(self._get_data()['callbacks'].get(callback))
+
+    def get_empty_block_bme(self):
+        return self._copy(self._get_data()['empty_block'])
+
+
+_bme_snapshot = BackendFromSettings('TELEGRAM_BME_SNAPSHOT')
+
+
+def get_bme_snapshot():
+    """
+    Snapshot from settings TELEGRAM_BME_SNAPSHOT (not used by default), for example:
+        TELEGRAM_BME_SNAPSHOT = {
+            'BACKEND': 'telegram_django_bot.bme_index.BotMenuElemSnapshot',
+            'OPTIONS': {'cache_alias': 'default'},
+        }
+    """
+    return _bme_snapshot.get()
+
+
+def _first_visible(bme_ids):
+    if not bme_ids:
+        return None
+    return BotMenuElem.objects.filter(id__in=bme_ids, is_visable=True).order_by('id').first()
+
+
+def find_command_bme(command):
+    """ visible BotMenuElem which has the command line (command without "/") """
+    if bme_snapshot := get_bme_snapshot():
+        return bme_snapshot.get_command_bme(command)
+    return _first_visible(bme_index.get_command_ids(command))
+
+
+def find_callback_bme(callback):
+    """ visible BotMenuElem which has callback in callbacks """
+    if bme_snapshot := get_bme_snapshot():
+        return bme_snapshot.get_callback_bme(callback)
+    return _first_visible(bme_index.get_callback_ids(callback))
+
+
+def find_empty_block_bme():
+    """ visible BotMenuElem which is shown if there is no catching callback """
+    if bme_snapshot := get_bme_snapshot():
+        return bme_snapshot.get_empty_block_bme()
+    return BotMenuElem.objects.filter(empty_block=True, is_visable=True).first()
+
+
+@receiver(post_save, sender=BotMenuElem)
+@receiver(post_delete, sender=BotMenuElem)
+def invalidate_bme_index(sender, **kwargs):
+    bme_index.invalidate()
+
+    if bme_snapshot := get_bme_snapshot():
+        bme_snapshot.invalidate()
+
+
+@receiver(post_save, sender=BotMenuElemAttrText)
+@receiver(post_delete, sender=BotMenuElemAttrText)
+def invalidate_bme_snapshot(sender, **kwargs):
+    if bme_snapshot := get_bme_snapshot():
+        bme_snapshot.invalidate()
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import connection
+from telegram import error
+
+from .utils import add_log_action
+
+
+# version 20.x + has Forbidden instead of Unauthorized
+TELEGRAM_FORBIDDEN_ERROR = getattr(error, 'Forbidden', None) or getattr(error, 'Unauthorized')
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: rate tokens per second, not more than capacity tokens at once.
+    reserve() takes a token and returns seconds to wait before using it, so waiting is made outside the lock
+    (by time.sleep or asyncio.sleep). pause(seconds) stops giving tokens (for RetryAfter from telegram).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+
+            wait_time = -self._tokens / self.rate if self._tokens < 0 else 0
+            return max(wait_time, self._paused_until - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0)
+
+    def acquire(self):
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    async def aacquire(self):
+        wait_time = self.reserve()
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+
+class PerChatLimiter:
+    """ not more than rate messages per second in 1 chat """
+
+    def __init__(self, rate=1.0):
+        self.interval = 1 / rate
+        self._next_times = OrderedDict()  # chat_id: next time, in order of reserving
+        self._lock = threading.Lock()
+
+    def reserve(self, chat_id) -> float:
+        with self._lock:
+            now = time.monotonic()
+            # passed times do not limit chats, so they are removed (the dict does not grow with every chat)
+            while self._next_times and next(iter(self._next_times.values())) <= now:
+                self._next_times.popitem(last=False)
+
+            next_time = max(now, self._next_times.get(chat_id, now))
+            self._next_times[chat_id] = next_time + self.interval
+            self._next_times.move_to_end(chat_id)
+            return next_time - now
+
+
+class BroadcastReport:
+    """ results of broadcast """
+
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.failed_user_ids = []
+        self.blocked_user_ids = []
+        self.retry_after_amount = 0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def failed(self):
+        return len(self.failed_user_ids)
+
+    @property
+    def blocked(self):
+        return len(self.blocked_user_ids)
+
+    @property
+    def duration(self):
+        if self.started_at is None:
+            return 0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        """ sent messages per second """
+        return self.sent / self.duration if self.duration else 0
+
+    def as_dict(self):
+        return {
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'retry_after_amount': self.retry_after_amount,
+            'duration': self.duration,
+            'throughput': self.throughput,
+        }
+
+    def __str__(self):
+        return 'BroadcastReport({})'.format(', '.join(f'{key}={value}' for key, value in self.as_dict().items()))
+
+
+class Broadcast:
+    """
+    Sends messages to many users concurrently with telegram limits: global token bucket (rate messages per second
+    for the bot) and per_chat_rate messages per second in each chat. RetryAfter from telegram pauses all workers
+    for retry_after seconds and the message is resent (max_retries times). Users who blocked the bot are marked
+    is_active=False with TYPE_BLOCKED log after sending.
+
+    send_func(bot, recipient) sends the message to the recipient, for example:
+        Broadcast(bot, lambda bot, user: bot.send_botmenuelem(None, user, menu_elem)).run(users)
+    get_user(recipient) -- user of the recipient, if recipients are not users (for example, UserTrigger)
+
+    Broadcast is for python-telegram-bot 13.x (thread workers), AsyncBroadcast is for 20.x+ (asyncio workers).
+    """
+
+    def __init__(self, bot, send_func, rate=30, per_chat_rate=1, workers=8, max_retries=3, get_user=None):
+        self.bot = bot
+        self.send_func = send_func
+        self.get_user = get_user or (lambda recipient: recipient)
+        self.workers = workers
+        self.max_retries = max_retries
+        self.token_bucket = TokenBucket(rate)
+        self.per_chat_limiter = PerChatLimiter(per_chat_rate)
+        self.report = BroadcastReport()
+
+    def get_chat_wait_time(self, user):
+        return max(self.token_bucket.reserve(), self.per_chat_limiter.reserve(user.id))
+
+    def handle_error(self, user, exception, attempt) -> float:
+        """
+        :return: seconds before resending or None if message is not resent
+        """
+        if isinstance(exception, error.RetryAfter) and attempt < self.max_retries:
+            retry_after = exception.retry_after
+            retry_after = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+            logging.warning(f'broadcast flood control, retry in {retry_after} seconds')
+            self.token_bucket.pause(retry_after)
+            with self.report._lock:
+                self.report.retry_after_amount += 1
+            return retry_after
+
+        with self.report._lock:
+            if isinstance(exception, TELEGRAM_FORBIDDEN_ERROR) or \
+                    isinstance(exception, error.BadRequest) and exception.message == 'Chat not found':
+                self.report.blocked_user_ids.append(user.id)
+            else:
+                logging.error(f'broadcast error for user={user.id}: {exception}')
+                self.report.failed_user_ids.append(user.id)
+        return None
+
+    def add_sent(self):
+        with self.report._lock:
+            self.report.sent += 1
+
+    def send(self, recipient):
+        user = self.get_user(recipient)
+        for attempt in range(self.max_retries + 1):
+            wait_time = self.get_chat_wait_time(user)
+            if wait_time > 0:
+                time.sleep(wait_time)
+            try:
+                self.send_func(self.bot, recipient)
+            except Exception as exception:
+                if self.handle_error(user, exception, attempt) is None:
+                    return
+            else:
+                self.add_sent()
+                return
+
+    def _worker(self, recipients_queue):
+        try:
+            while (recipient := recipients_queue.get()) is not None:
+                self.send(recipient)
+        finally:
+            connection.close()
+
+    def run(self, recipients) -> BroadcastReport:
+        self.report.started_at = time.monotonic()
+        recipients_queue = queue.Queue(maxsize=self.workers * 2)
+        threads = [
+            threading.Thread(target=self._worker, args=(recipients_queue,), name=f'Broadcast-{it}', daemon=True)
+            for it in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        for recipient in recipients:
+            self.report.total += 1
+            recipients_queue.put(recipient)
+        for __ in threads:
+            recipients_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        self.report.finished_at = time.monotonic()
+        self.mark_blocked_users()
+        return self.report
+
+    def mark_blocked_users(self):
+        if self.report.blocked_user_ids:
+            get_user_model().objects.filter(id__in=self.report.blocked_user_ids).update(is_active=False)
+            for user_id in self.report.blocked_user_ids:
+                add_log_action(user_id, 'TYPE_BLOCKED')
+
+
+class AsyncBroadcast(Broadcast):
+    """
+    Broadcast for python-telegram-bot 20.x+: send_func(bot, recipient) returns awaitable.
+    Recipients are iterated in event loop, so pass a list or an async iterable instead of QuerySet.
+    """
+
+    async def asend(self, recipient):
+        user = self.get_user(recipient)
+        for attempt in range(self.max_retries + 1):
+            wait_time = self.get_chat_wait_time(user)
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            try:
+                await self.send_func(self.bot, recipient)
+            except Exception as exception:
+                if self.handle_error(user, exception, attempt) is None:
+                    return
+            else:
+                self.add_sent()
+                return
+
+    async def _aworker(self, recipients_queue):
+        while (recipient := await recipients_queue.get()) is not None:
+            await self.asend(recipient)
+
+    async def _asend_all(self, recipients):
+        self.report.started_at = time.monotonic()
+        recipients_queue = asyncio.Queue(maxsize=self.workers * 2)
+        tasks = [asyncio.create_task(self._aworker(recipients_queue)) for __ in range(self.workers)]
+
+        if hasattr(recipients, '__aiter__'):
+            async for recipient in recipients:
+                self.report.total += 1
+                await recipients_queue.put(recipient)
+        else:
+            for recipient in recipients:
+                self.report.total += 1
+                await recipients_queue.put(recipient)
+        for __ in tasks:
+            await recipients_queue.put(None)
+        await asyncio.gather(*tasks)
+
+        self.report.finished_at = time.monotonic()
+
+    async def arun(self, recipients) -> BroadcastReport:
+        await self._asend_all(recipients)
+        await sync_to_async(self.mark_blocked_users)()
+        return self.report
+
+    def run(self, recipients) -> BroadcastReport:
+        """ run in new event loop from sync code """
+        asyncio.run(self._asend_all(recipients))
+        self.mark_blocked_users()
+        return self.report
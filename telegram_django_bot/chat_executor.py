@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+
+class BaseChatExecutor:
+    """
+    Updates of the same chat are processed one by one in the order of receiving, updates of different chats
+    are processed in parallel.
+
+    Metrics:
+        processed_amount -- amount of processed updates
+        max_queue_depth -- max amount of updates, which were waiting (or processing) in 1 chat
+        get_queue_depth(chat_id) -- amount of updates in the chat, which are waiting or processing now
+        get_stats() -- all metrics
+    """
+
+    def __init__(self, **kwargs):
+        self.processed_amount = 0
+        self.max_queue_depth = 0
+        self._queue_depths = {}  # chat_id: amount of waiting and processing updates
+        self._lock = threading.Lock()
+
+    def _increase_queue_depth(self, chat_id) -> int:
+        # should be called under self._lock
+        queue_depth = self._queue_depths[chat_id] = self._queue_depths.get(chat_id, 0) + 1
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        return queue_depth
+
+    def _decrease_queue_depth(self, chat_id) -> int:
+        # should be called under self._lock
+        self.processed_amount += 1
+        queue_depth = self._queue_depths.get(chat_id, 0) - 1
+        if queue_depth > 0:
+            self._queue_depths[chat_id] = queue_depth
+        else:
+            self._queue_depths.pop(chat_id, None)
+        return max(queue_depth, 0)
+
+    def _add_to_queue(self, chat_id) -> int:
+        with self._lock:
+            return self._increase_queue_depth(chat_id)
+
+    def _remove_from_queue(self, chat_id) -> int:
+        with self._lock:
+            return self._decrease_queue_depth(chat_id)
+
+    def get_queue_depth(self, chat_id) -> int:
+        return self._queue_depths.get(chat_id, 0)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'chats': len(self._queue_depths),
+                'queued': sum(self._queue_depths.values()),
+                'max_queue_depth': self.max_queue_depth,
+                'processed': self.processed_amount,
+            }
+
+
+class ChatOrderedExecutor(BaseChatExecutor):
+    """
+    Executor for python-telegram-bot 13.x: functions are executed in the pool of workers threads, a chat takes only
+    1 worker at a time and after each update the chat goes to the end of the pool queue (so a chat with many updates
+    does not occupy workers).
+    """
+
+    def __init__(self, workers=8, **kwargs):
+        super().__init__(**kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ChatOrderedExecutor')
+        self._tasks = {}  # chat_id: deque of (future, func, args, kwargs)
+
+    def submit(self, chat_id, func, *args, **kwargs) -> Future:
+        future = Future()
+        with self._lock:
+            chat_tasks = self._tasks.get(chat_id)
+            is_chat_waiting = chat_tasks is not None
+            if not is_chat_waiting:
+                chat_tasks = self._tasks[chat_id] = deque()
+            chat_tasks.append((future, func, args, kwargs))
+            self._increase_queue_depth(chat_id)
+
+        if not is_chat_waiting:
+            self._executor.submit(self._run_next, chat_id)
+        return future
+
+    def _run_next(self, chat_id):
+        with self._lock:
+            chat_tasks = self._tasks[chat_id]
+            future, func, args, kwargs = chat_tasks[0]
+
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func(*args, **kwargs)
+                except BaseException as error:
+                    logging.exception(f'error in processing update of chat {chat_id}')
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+                finally:
+                    close_old_connections()
+        finally:
+            # the next update of the chat is scheduled in any case, otherwise the chat stalls
+            with self._lock:
+                chat_tasks.popleft()
+                if not chat_tasks:
+                    del self._tasks[chat_id]
+                self._decrease_queue_depth(chat_id)
+                has_next = bool(chat_tasks)
+
+            if has_next:
+                self._executor.submit(self._run_next, chat_id)
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class AsyncChatOrderedExecutor(BaseChatExecutor):
+    """
+    Executor for python-telegram-bot 20.x+ with concurrent_updates: coroutines of the same chat are awaited under
+    the chat asyncio.Lock (which wakes waiters in FIFO order), so they are executed in the order of receiving.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._chat_locks = {}
+
+    async def run(self, chat_id, coroutine_func, *args, **kwargs):
+        self._add_to_queue(chat_id)
+        chat_lock = self._chat_locks.get(chat_id)
+        if chat_lock is None:
+            chat_lock = self._chat_locks[chat_id] = asyncio.Lock()
+
+        try:
+            async with chat_lock:
+                return await coroutine_func(*args, **kwargs)
+        finally:
+            if not self._remove_from_queue(chat_id):
+                self._chat_locks.pop(chat_id, None)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import time
+
+from django.apps import apps
+from django.core.cache import caches
+from django.db import connections
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+
+VERSION_KEY_PREFIX = 'telegram_django_bot_count_version'
+COUNT_KEY_PREFIX = 'telegram_django_bot_count'
+
+# {model label: cache aliases} of models, which counts are cached in the process (only their changes invalidate counts)
+_count_cached_models = {}
+
+
+def get_count_version_key(model):
+    return f'{VERSION_KEY_PREFIX}:{model._meta.label_lower}'
+
+
+def get_queryset_models(queryset):
+    """
+    models of queryset and of tables joined by its filters (for example, related models of foreign filters), changes
+    of them invalidate the count. Models of subqueries (filter(field__in=other_queryset)) are not found.
+    """
+    models_by_table = {model._meta.db_table: model for model in apps.get_models(include_auto_created=True)}
+    models = {queryset.model}
+    for join in queryset.query.alias_map.values():
+        if model := models_by_table.get(join.table_name):
+            models.add(model)
+    return sorted(models, key=lambda model: model._meta.label_lower)
+
+
+def get_new_version():
+    # version does not repeat the lost version (for example, after cache restarting)
+    return int(time.time() * 1000)
+
+
+def get_approximate_count(queryset):
+    """
+    count by database statistics (PostgreSQL only): reltuples of the table for not filtered queryset and
+    rows estimate of the query plan for filtered one.
+    :return: None if the database does not have statistics
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    if not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        # reltuples is -1 (or 0 in old versions) if the table has not been analyzed yet
+        return int(row[0]) if row and row[0] > 0 else None
+
+    try:
+        # not QuerySet.explain: it returns python repr of the parsed json with psycopg2
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    except Exception as error:
+        logging.warning(f'could not estimate count of {queryset.model}: {error}')
+        return None
+
+
+def get_cached_count(queryset, key, timeout=60, cache_alias='default', approximate=False, approximate_threshold=10000):
+    """
+    count of queryset, which is cached for timeout seconds and is invalidated if a model of queryset (or a model
+    joined by its filters, see get_queryset_models) is saved or deleted in the process (changes of other
+    processes and bulk updates are seen after timeout).
+
+    key -- unique key of the queryset (for example, viewset, foreign filters and user), it is hashed, so it could
+        have any symbols and length
+    approximate -- use database statistics (get_approximate_count) if estimated amount >= approximate_threshold
+    """
+    cache = caches[cache_alias]
+    version_keys = []
+    for model in get_queryset_models(queryset):
+        watch_model_changes(model, cache_alias)
+        version_keys.append(get_count_version_key(model))
+
+    versions = cache.get_many(version_keys)
+    for version_key in version_keys:
+        if version_key not in versions:
+            cache.add(version_key, get_new_version(), None)
+            versions[version_key] = cache.get(version_key)
+
+    versions_text = ':'.join(str(versions[version_key]) for version_key in version_keys)
+    count_key = f'{COUNT_KEY_PREFIX}:{hashlib.md5(f"{key}:{versions_text}".encode()).hexdigest()}'
+    count = cache.get(count_key)
+    if count is None:
+        if approximate and (count := get_approximate_count(queryset)) is not None and count < approximate_threshold:
+            count = None  # small tables are counted exactly
+        if count is None:
+            count = queryset.count()
+        cache.set(count_key, count, timeout)
+    return count
+
+
+def invalidate_counts(model):
+    """ counts of model querysets are recounted (new version of model counts) """
+    version_key = get_count_version_key(model)
+    for cache_alias in _count_cached_models.get(model._meta.label_lower, ()):
+        cache = caches[cache_alias]
+        try:
+            cache.incr(version_key)
+        except ValueError:
+            cache.add(version_key, get_new_version(), None)
+
+
+def watch_model_changes(model, cache_alias):
+    """ counts of the model are invalidated on saving and deleting (signals are connected only for counted models) """
+    label = model._meta.label_lower
+    if label not in _count_cached_models:
+        post_save.connect(invalidate_counts_on_change, sender=model, dispatch_uid=f'count_cache_save:{label}')
+        post_delete.connect(invalidate_counts_on_change, sender=model, dispatch_uid=f'count_cache_delete:{label}')
+    _count_cached_models.setdefault(label, set()).add(cache_alias)
+
+
+def invalidate_counts_on_change(sender, **kwargs):
+    invalidate_counts(sender)
+
+
+@receiver(m2m_changed)
+def invalidate_counts_on_m2m_change(sender, instance, model, action, **kwargs):
+    if action.startswith('post_') and _count_cached_models:
+        invalidate_counts(type(instance))
+        invalidate_counts(model)
+        invalidate_counts(sender)  # through model
@@ -0,0 +1,63 @@
+import threading
+
+from django.core.cache import caches
+
+from .settings_backends import BackendFromSettings
+
+
+class BaseDailyActiveTracker:
+    """
+    Remembers users which were active today, so ACTION_ACTIVE_TODAY log is checked in db only for the first user
+    update in a day (instead of each update).
+    """
+
+    def is_first_visit(self, user_id, date) -> bool:
+        """ True if the tracker sees user first time at this date """
+        raise NotImplementedError()
+
+
+class LocMemDailyActiveTracker(BaseDailyActiveTracker):
+    """ in-process set of user ids for the current date """
+
+    def __init__(self, **kwargs):
+        self._date = None
+        self._user_ids = set()
+        self._lock = threading.Lock()
+
+    def is_first_visit(self, user_id, date) -> bool:
+        with self._lock:
+            if date != self._date:
+                self._date = date
+                self._user_ids = set()
+
+            if user_id in self._user_ids:
+                return False
+
+            self._user_ids.add(user_id)
+            return True
+
+
+class DjangoCacheDailyActiveTracker(BaseDailyActiveTracker):
+    """ tracker through django cache framework (cache.add is atomic), so several bot processes share it """
+
+    def __init__(self, cache_alias='default', key_prefix='telegram_django_bot_active', timeout=2 * 24 * 3600, **kwargs):
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+
+    def is_first_visit(self, user_id, date) -> bool:
+        return caches[self.cache_alias].add(f'{self.key_prefix}:{date.isoformat()}:{user_id}', 1, self.timeout)
+
+
+_daily_active_tracker = BackendFromSettings(
+    'TELEGRAM_DAILY_ACTIVE_TRACKER',
+    default={'BACKEND': 'telegram_django_bot.daily_activity.LocMemDailyActiveTracker'},
+)
+
+
+def get_daily_active_tracker():
+    """
+    Tracker from settings TELEGRAM_DAILY_ACTIVE_TRACKER (LocMemDailyActiveTracker by default).
+    :return: None if TELEGRAM_DAILY_ACTIVE_TRACKER = None (then db is checked on each update)
+    """
+    return _daily_active_tracker.get()
@@ -0,0 +1,182 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import TelegramFileCode
+from .settings_backends import BackendFromSettings
+
+
+class FileCodeRegistry:
+    """
+    Registry of telegram file_id by file content hash (sha256) and message format, so the same file is uploaded
+    to telegram only once (even if it is used in several BotMenuElem or media groups).
+    Uploading of a file is made under single-flight lock: only one worker uploads the file, others wait and reuse
+    the file_id. Threads of the process are locked in memory and processes (bot workers, celery) through django
+    cache cache_alias, so the cache should be shared between processes (not LocMemCache) for the lock between them.
+
+    cache_alias -- django cache for the lock between processes (None - only threads of the process are locked)
+    lock_timeout -- max seconds of waiting for the lock (then file is uploaded without lock)
+    poll_interval -- seconds between attempts to get the lock from django cache
+    """
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, cache_alias='default', lock_timeout=60, poll_interval=0.1, key_prefix='telegram_django_bot_file',
+                 **kwargs):
+        self.cache_alias = cache_alias
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.key_prefix = key_prefix
+
+        self._file_codes = {}  # (content_hash, message_format): file_code
+        self._hashes = {}  # path: (size, mtime, content_hash)
+        self._locks = {}  # key: [threading.Lock, amount of users], the lock is removed by the last user
+        self._async_locks = {}  # key: [asyncio.Lock, amount of users]
+        self._lock = threading.Lock()
+
+    def get_content_hash(self, path) -> str:
+        """ sha256 of file content (remembered until the file size or modification time is changed) """
+        stat = os.stat(path)
+        file_hash = self._hashes.get(path)
+        if file_hash and file_hash[:2] == (stat.st_size, stat.st_mtime):
+            return file_hash[2]
+
+        content_hash = hashlib.sha256()
+        with open(path, 'rb') as file:
+            while chunk := file.read(self.HASH_CHUNK_SIZE):
+                content_hash.update(chunk)
+
+        content_hash = content_hash.hexdigest()
+        self._hashes[path] = (stat.st_size, stat.st_mtime, content_hash)
+        return content_hash
+
+    def get_many(self, keys) -> dict:
+        """
+        :param keys: list of (content_hash, message_format)
+        :return: {(content_hash, message_format): file_code} for known files
+        """
+        file_codes = {key: self._file_codes[key] for key in keys if key in self._file_codes}
+        missed_keys = set(keys) - set(file_codes)
+        if missed_keys:
+            for content_hash, message_format, file_code in TelegramFileCode.objects.filter(
+                content_hash__in=set(content_hash for content_hash, __ in missed_keys),
+            ).values_list('content_hash', 'message_format', 'file_code'):
+                if (content_hash, message_format) in missed_keys:
+                    file_codes[(content_hash, message_format)] = file_code
+                    self._file_codes[(content_hash, message_format)] = file_code
+        return file_codes
+
+    def set_many(self, file_codes: dict):
+        """ :param file_codes: {(content_hash, message_format): file_code} """
+        TelegramFileCode.objects.bulk_create([
+            TelegramFileCode(content_hash=content_hash, message_format=message_format, file_code=file_code)
+            for (content_hash, message_format), file_code in file_codes.items()
+        ], ignore_conflicts=True)
+        self._file_codes.update(file_codes)
+
+    def forget(self, content_hash, message_format):
+        self._file_codes.pop((content_hash, message_format), None)
+
+    @contextlib.contextmanager
+    def _local_lock(self, key):
+        with self._lock:
+            lock_users = self._locks.setdefault(key, [threading.Lock(), 0])
+            lock_users[1] += 1
+
+        try:
+            with lock_users[0]:
+                yield
+        finally:
+            with self._lock:
+                lock_users[1] -= 1
+                if not lock_users[1]:
+                    del self._locks[key]
+
+    @contextlib.asynccontextmanager
+    async def _async_local_lock(self, key):
+        # the dict is changed only in the event loop thread, so it is not locked
+        lock_users = self._async_locks.setdefault(key, [asyncio.Lock(), 0])
+        lock_users[1] += 1
+
+        try:
+            async with lock_users[0]:
+                yield
+        finally:
+            lock_users[1] -= 1
+            if not lock_users[1]:
+                del self._async_locks[key]
+
+    @contextlib.contextmanager
+    def single_flight(self, key):
+        """ lock for uploading the file with key (content_hash, message_format) """
+        with self._local_lock(key):
+            if not self.cache_alias:
+                yield
+                return
+
+            cache = caches[self.cache_alias]
+            lock_key = f'{self.key_prefix}:lock:{key[0]}:{key[1]}'
+            deadline = time.monotonic() + self.lock_timeout
+            is_locked = cache.add(lock_key, 1, self.lock_timeout)
+            while not is_locked and time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                is_locked = cache.add(lock_key, 1, self.lock_timeout)
+
+            try:
+                yield
+            finally:
+                if is_locked:
+                    cache.delete(lock_key)
+
+    @contextlib.asynccontextmanager
+    async def asingle_flight(self, key):
+        """ single_flight for asyncio (tasks of the event loop are locked by asyncio.Lock, not threads) """
+        async with self._async_local_lock(key):
+            if not self.cache_alias:
+                yield
+                return
+
+            cache = caches[self.cache_alias]
+            lock_key = f'{self.key_prefix}:lock:{key[0]}:{key[1]}'
+            deadline = time.monotonic() + self.lock_timeout
+            is_locked = await sync_to_async(cache.add)(lock_key, 1, self.lock_timeout)
+            while not is_locked and time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                is_locked = await sync_to_async(cache.add)(lock_key, 1, self.lock_timeout)
+
+            try:
+                yield
+            finally:
+                if is_locked:
+                    await sync_to_async(cache.delete)(lock_key)
+
+
+_file_registry = BackendFromSettings(
+    'TELEGRAM_FILE_REGISTRY',
+    default={'BACKEND': 'telegram_django_bot.file_registry.FileCodeRegistry'},
+)
+
+
+def get_file_registry():
+    """
+    File registry from settings TELEGRAM_FILE_REGISTRY, for example:
+        TELEGRAM_FILE_REGISTRY = {
+            'BACKEND': 'telegram_django_bot.file_registry.FileCodeRegistry',
+            'OPTIONS': {'cache_alias': 'default', 'lock_timeout': 60},
+        }
+    :return: None if registry is turned off
+    """
+    return _file_registry.get()
+
+
+@receiver(post_delete, sender=TelegramFileCode)
+def forget_file_code(sender, instance, **kwargs):
+    if file_registry := get_file_registry():
+        file_registry.forget(instance.content_hash, instance.message_format)
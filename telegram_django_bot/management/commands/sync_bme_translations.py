@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from telegram_django_bot.models import BotMenuElem
+
+
+class Command(BaseCommand):
+    help = 'Create missing BotMenuElemAttrText for all BotMenuElem (for example, after loading fixtures)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='amount of rows in 1 insert')
+
+    def handle(self, *args, **options):
+        created_amount = BotMenuElem.sync_translations(batch_size=options['batch_size'])
+        self.stdout.write(f'{created_amount} translations are created')
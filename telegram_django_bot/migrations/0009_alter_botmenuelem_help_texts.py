@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-18 11:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_django_bot', '0008_auto_20221225_1050'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='botmenuelem',
+            name='callbacks_db',
+            field=models.TextField(default='[]', help_text='List of regular expressions (so far only an explicit list) for callbacks that call this menu block. For example, list ["data", "callback2"] will catch the clicking InlineKeyboardButtons with callback_data "data" or "callback2"'),
+        ),
+        migrations.AlterField(
+            model_name='botmenuelem',
+            name='command',
+            field=models.TextField(blank=True, help_text='Bot command that can call this menu block. Add 1 command per row', null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2 on 2026-10-18 11:49
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_django_bot', '0009_alter_botmenuelem_help_texts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramFileCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dttm_added', models.DateTimeField(default=django.utils.timezone.now)),
+                ('content_hash', models.CharField(help_text='sha256 of file content', max_length=64)),
+                ('message_format', models.CharField(choices=[('T', 'Text'), ('P', 'Image'), ('D', 'Document'), ('A', 'Audio'), ('V', 'Video'), ('G', 'GIF/animation'), ('TV', 'Voice'), ('VN', 'Video note'), ('S', 'Sticker'), ('L', 'Location'), ('GM', 'Media Group')], max_length=2)),
+                ('file_code', models.CharField(help_text='File code in telegram', max_length=512)),
+            ],
+            options={
+                'unique_together': {('content_hash', 'message_format')},
+            },
+        ),
+    ]
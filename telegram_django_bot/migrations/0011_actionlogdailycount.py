@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-18 12:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('telegram_django_bot', '0010_telegramfilecode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActionLogDailyCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=64)),
+                ('day', models.DateField(db_index=True)),
+                ('amount', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'type', 'day')},
+            },
+        ),
+    ]
@@ -3,42 +3,18 @@ import logging
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.core import validators
+from django.core.exceptions import ValidationError
 import random
+import time
 from django.utils import timezone
 import json
 from django.conf import settings
 from django.db.models import QuerySet
-from django.core.serializers.json import DjangoJSONEncoder
-import datetime
 from django.utils.translation import gettext_lazy as _
 from telegram import InlineKeyboardButton  # no lazy text so standart possible to use
 
-
-class TelegramDjangoJsonDecoder(json.JSONDecoder):
-    def __init__(self, *args, **kwargs):
-        super(TelegramDjangoJsonDecoder, self).__init__(*args, object_hook=self.object_hook_decoder, **kwargs)
-
-    def object_hook_decoder(self, sub_dict, *args, **kwargs):
-        # so it works only for dictionary data (if datetime is in list it will not be worked)
-        for key in sub_dict.keys():
-            value = sub_dict[key]
-            dt_object = None
-            if type(value) == str:
-                try:
-                    dt_object = datetime.time.fromisoformat(value)
-                except ValueError:
-                    try:
-                        dt_object = datetime.date.fromisoformat(value)
-                    except ValueError:
-                        try:
-                            dt_object = datetime.datetime.fromisoformat(value)
-                        except ValueError:
-                            pass
-
-                if dt_object:
-                    sub_dict[key] = dt_object
-
-        return sub_dict
+from .state_backend import get_state_backend
+from .state_serializer import TelegramDjangoJsonDecoder, dumps_state, loads_state
 
 
 class MESSAGE_FORMAT:
@@ -118,16 +94,82 @@ class TelegramUser(AbstractUser):
     def __str__(self):
         return f"U({self.id}, {self.telegram_username or '-'}, {self.first_name or '-'})"
 
+    # fields of user status (FSM state), which are saved with update_fields only if they are changed
+    STATE_FIELDS = ('current_utrl', 'current_utrl_code_dttm', 'current_utrl_context_db', 'current_utrl_form_db')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_state()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._remember_state(fields)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        if '_loaded_state' in state:
+            state['_loaded_state'] = state['_loaded_state'].copy()  # copies (user cache) have own state
+        if not state.get('_is_state_form_db_changed'):
+            # form draft of the state backend could be changed by other process
+            state.pop('_state_form_db', None)
+            state.pop('_current_utrl_form', None)
+        return state
+
+    def _remember_state(self, fields=None):
+        """ remembers db values of state fields for dirty checking and time of them (for user cache) """
+        self._loaded_at = time.time()
+        loaded_state = self.__dict__.setdefault('_loaded_state', {})
+        for field_name in self.STATE_FIELDS:
+            if (fields is None or field_name in fields) and field_name in self.__dict__:  # not deferred
+                loaded_state[field_name] = self.__dict__[field_name]
+
+    def get_dirty_state_fields(self):
+        """ state fields, which are changed after loading from db """
+        loaded_state = self.__dict__.get('_loaded_state', {})
+        return [
+            field_name for field_name in self.STATE_FIELDS
+            if field_name in self.__dict__ and (
+                field_name not in loaded_state or loaded_state[field_name] != self.__dict__[field_name]
+            )
+        ]
+
+    def save_state(self):
+        """
+        saves only changed state fields with 1 query (nothing is requested if they are not changed).
+        Between defer_state_saving and save_deferred_state the state is only marked for saving.
+        """
+        if self.__dict__.get('_is_state_saving_deferred'):
+            return
+
+        if self._state.adding:
+            self.save()
+        elif dirty_state_fields := self.get_dirty_state_fields():
+            self.save(update_fields=dirty_state_fields)
+        get_state_backend().save(self)
+
+    def defer_state_saving(self):
+        """
+        clear_status, save_form_in_db, save_context_in_db and save_state do not save user until save_deferred_state
+        (changes of the update are saved with 1 query)
+        """
+        self._is_state_saving_deferred = True
+
+    def save_deferred_state(self):
+        self._is_state_saving_deferred = False
+        self.save_state()
+
     @property
     def current_utrl_form(self):
         if not hasattr(self, '_current_utrl_form'):
-            self._current_utrl_form = json.loads(self.current_utrl_form_db, cls=TelegramDjangoJsonDecoder)
+            self._current_utrl_form = loads_state(get_state_backend().get_form_db(self))
         return self._current_utrl_form
 
     @property
     def current_utrl_context(self):
         if not hasattr(self, '_current_utrl_context'):
-            self._current_utrl_context = json.loads(self.current_utrl_context_db, cls=TelegramDjangoJsonDecoder)
+            self._current_utrl_context = loads_state(self.current_utrl_context_db)
         return self._current_utrl_context
 
     def save_form_in_db(self, form_name, form_data, do_save=True):
@@ -143,20 +185,20 @@ class TelegramUser(AbstractUser):
 
             db_form_data[key] = db_value
 
-        self.current_utrl_form_db = json.dumps({
+        get_state_backend().set_form_db(self, dumps_state({
             'form_name': form_name,
             'form_data': db_form_data,
-        }, cls=DjangoJSONEncoder)
+        }))
         if do_save:
-            self.save()
+            self.save_state()
 
         if hasattr(self, '_current_utrl_form'):
             delattr(self, '_current_utrl_form')
 
     def save_context_in_db(self, context, do_save=True):
-        self.current_utrl_context_db = json.dumps(context, cls=DjangoJSONEncoder)
+        self.current_utrl_context_db = dumps_state(context)
         if do_save:
-            self.save()
+            self.save_state()
 
         if hasattr(self, '_current_utrl_context'):
             delattr(self, '_current_utrl_context')
@@ -165,9 +207,9 @@ class TelegramUser(AbstractUser):
         self.current_utrl = ''
         self.current_utrl_code_dttm = None
         self.current_utrl_context_db = '{}'
-        self.current_utrl_form_db = '{}'
+        get_state_backend().set_form_db(self, '{}')
         if commit:
-            self.save()
+            self.save_state()
 
         for attr in ['_current_utrl_context', '_current_utrl_form']:
             if hasattr(self, attr):
@@ -190,7 +232,9 @@ class TelegramUser(AbstractUser):
 
             logging.warning(f"Try to save user without ID. For staff the smallest unused ID will be used: {id_num}")
 
-        return super(TelegramUser, self).save(*args, **kwargs)
+        res = super(TelegramUser, self).save(*args, **kwargs)
+        self._remember_state(kwargs.get('update_fields'))
+        return res
             
 
 class TeleDeepLink(models.Model):
@@ -218,6 +262,22 @@ class ActionLog(models.Model):
         return 'AL({}, {}, {})'.format(self.user_id, self.dttm, self.type)
 
 
+class ActionLogDailyCount(models.Model):
+    """
+    Amount of user ActionLog of the type in the day (rollup of ActionLog for trigger conditions, see action_log_rollup)
+    """
+    class Meta:
+        unique_together = [['user', 'type', 'day']]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    type = models.CharField(max_length=64)
+    day = models.DateField(db_index=True)
+    amount = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'ALDC({self.user_id}, {self.day}, {self.type}, {self.amount})'
+
+
 class BotMenuElem(models.Model):
     """
 
@@ -272,29 +332,46 @@ class BotMenuElem(models.Model):
         super(BotMenuElem, self).save(*args, **kwargs)
 
         # check and create new models for translation
-        if settings.USE_I18N and len(settings.LANGUAGES):
-            language_codes = set(map(lambda x: x[0], settings.LANGUAGES))
-            if settings.LANGUAGE_CODE in language_codes:
-                language_codes.remove(settings.LANGUAGE_CODE)
-
-            get_existed_language_codes = lambda text: set(BotMenuElemAttrText.objects.filter(
-                language_code__in=language_codes,
-                bot_menu_elem_id=self.id,
-                default_text=text,
-            ).values_list('language_code', flat=True))
-
-            BotMenuElemAttrText.objects.bulk_create([
-                BotMenuElemAttrText(language_code=language_code, default_text=self.message, bot_menu_elem_id=self.id)
-                for language_code in language_codes - get_existed_language_codes(self.message)
-            ])
-
-            for row_elem in self.buttons:
-                for elem in row_elem:
-                    if text := elem.get('text'):
-                        BotMenuElemAttrText.objects.bulk_create([
-                            BotMenuElemAttrText(language_code=language_code, default_text=text, bot_menu_elem_id=self.id)
-                            for language_code in language_codes - get_existed_language_codes(text)
-                        ])
+        BotMenuElem.sync_translations([self])
+
+    @staticmethod
+    def get_translation_language_codes():
+        if not settings.USE_I18N:
+            return set()
+        return set(map(lambda x: x[0], settings.LANGUAGES)) - {settings.LANGUAGE_CODE}
+
+    @classmethod
+    def sync_translations(cls, menu_elems=None, batch_size=1000):
+        """
+        create missing BotMenuElemAttrText for message and buttons texts of menu_elems (all elements if None)
+        with 1 request for reading existed translations and 1 bulk_create (in batches of batch_size)
+
+        :return: amount of created BotMenuElemAttrText
+        """
+        language_codes = cls.get_translation_language_codes()
+        if not language_codes:
+            return 0
+
+        existed_translations = BotMenuElemAttrText.objects.filter(language_code__in=language_codes)
+        if menu_elems is None:
+            menu_elems = cls.objects.only('id', 'message', 'buttons_db')
+        else:
+            menu_elems = list(menu_elems)
+            existed_translations = existed_translations.filter(bot_menu_elem_id__in=[elem.id for elem in menu_elems])
+
+        existed_keys = set(existed_translations.values_list('bot_menu_elem_id', 'language_code', 'default_text'))
+
+        new_translations = []
+        for menu_elem in menu_elems:
+            for text in dict.fromkeys(menu_elem.get_texts()):
+                for language_code in language_codes:
+                    if (menu_elem.id, language_code, text) not in existed_keys:
+                        new_translations.append(BotMenuElemAttrText(
+                            language_code=language_code, default_text=text, bot_menu_elem_id=menu_elem.id
+                        ))
+
+        BotMenuElemAttrText.objects.bulk_create(new_translations, batch_size=batch_size, ignore_conflicts=True)
+        return len(new_translations)
 
     @property
     def buttons(self):
@@ -310,37 +387,81 @@ class BotMenuElem(models.Model):
 
         return self._callbacks
 
-    def get_message(self, language='en'):
-        get_translate_model = None
-        if language != settings.LANGUAGE_CODE:
-            get_translate_model = BotMenuElemAttrText.objects.filter(
-                language_code=language,
-                bot_menu_elem_id=self.id,
-                default_text=self.message,
-                translated_text__isnull=False,
-            ).first()
-        text = get_translate_model.translated_text if get_translate_model else self.message
-        return text
-
-    def get_buttons(self, language='en'):
-        # todo: rewrite with 1 request to db (default_text__in=...)
-
-        get_translate_model = lambda text: BotMenuElemAttrText.objects.filter(
-            language_code=language,
+    def get_texts(self):
+        """ texts which are translated: message and buttons texts """
+        texts = [self.message]
+        for row_elem in self.buttons:
+            for elem in row_elem:
+                if text := elem.get('text'):
+                    texts.append(text)
+        return texts
+
+    def set_translations(self, language, translations: dict):
+        """
+        set prebuilt translations {default_text: translated_text} for language, so get_message and get_buttons
+        do not request db for this language
+        """
+        if not hasattr(self, '_translations'):
+            self._translations = {}
+        self._translations[language] = translations
+
+    def _get_prebuilt_translations(self, language):
+        return getattr(self, '_translations', {}).get(language)
+
+    def prefetch_translations(self, *languages):
+        """ load translations of all texts for languages with 1 request to db and set them as prebuilt """
+        languages = [
+            language for language in languages
+            if language != settings.LANGUAGE_CODE and self._get_prebuilt_translations(language) is None
+        ]
+        if not languages:
+            return
+
+        translations = {language: {} for language in languages}
+        for language_code, default_text, translated_text in BotMenuElemAttrText.objects.filter(
+            bot_menu_elem_id=self.id,
+            language_code__in=languages,
+            default_text__in=set(self.get_texts()),
+            translated_text__isnull=False,
+        ).values_list('language_code', 'default_text', 'translated_text'):
+            translations[language_code][default_text] = translated_text
+
+        for language, language_translations in translations.items():
+            self.set_translations(language, language_translations)
+
+    def get_translations(self, language, texts=None) -> dict:
+        """
+        {default_text: translated_text} for texts (by default, all texts of the element) with 1 request to db
+        (or without requests if translations are prebuilt)
+        """
+        translations = self._get_prebuilt_translations(language)
+        if translations is not None:
+            return translations
+
+        return dict(BotMenuElemAttrText.objects.filter(
             bot_menu_elem_id=self.id,
-            default_text=text,
+            language_code=language,
+            default_text__in=set(self.get_texts() if texts is None else texts),
             translated_text__isnull=False,
-        ).first()
+        ).values_list('default_text', 'translated_text'))
+
+    def get_message(self, language='en'):
+        if language == settings.LANGUAGE_CODE:
+            return self.message
+        return self.get_translations(language, [self.message]).get(self.message) or self.message
 
+    def get_buttons(self, language='en'):
         need_translation = language != settings.LANGUAGE_CODE and settings.USE_I18N
+        translations = self.get_translations(language, self.get_texts()[1:]) if need_translation else {}
+
         buttons = []
 
         for row_elem in self.buttons:
             row_buttons = []
             for item_in_row in row_elem:
                 elem = dict(item_in_row)
-                if elem.get('text') and need_translation and (translate_model := get_translate_model(elem['text'])):
-                    elem['text'] = translate_model.translated_text
+                if elem.get('text') and (translated_text := translations.get(elem['text'])):
+                    elem['text'] = translated_text
                 row_buttons.append(InlineKeyboardButton(**elem))
 
             buttons.append(row_buttons)
@@ -362,6 +483,22 @@ class BotMenuElemAttrText(models.Model):
     translated_text = models.TextField(null=True, help_text=_('Default_text Translation'))
 
 
+class TelegramFileCode(models.Model):
+    """
+    Telegram file_id of uploaded files by file content hash, so each file is uploaded to telegram only once
+    """
+    class Meta:
+        unique_together = [['content_hash', 'message_format']]
+
+    dttm_added = models.DateTimeField(default=timezone.now)
+    content_hash = models.CharField(max_length=64, help_text=_('sha256 of file content'))
+    message_format = models.CharField(max_length=2, choices=MESSAGE_FORMAT.MESSAGE_FORMATS)
+    file_code = models.CharField(max_length=512, help_text=_('File code in telegram'))
+
+    def __str__(self):
+        return f'TFC({self.id}, {self.content_hash[:16]}, {self.message_format})'
+
+
 class Trigger(AbstractActiveModel):
 
     name = models.CharField(max_length=512, unique=True)
@@ -393,6 +530,27 @@ class Trigger(AbstractActiveModel):
 
         return self._condition
 
+    @property
+    def compiled_condition(self):
+        """ CompiledCondition of condition_db (see trigger_conditions) """
+        from .trigger_conditions import compile_condition
+        return compile_condition(self.condition_db)
+
+    def clean(self):
+        super().clean()
+        from .trigger_conditions import compile_condition
+        try:
+            compile_condition(self.condition_db)
+        except ValidationError as error:
+            raise ValidationError({'condition_db': error.messages})
+
+    def save(self, *args, **kwargs):
+        from .trigger_conditions import compile_condition
+        compile_condition(self.condition_db)  # not valid condition is not saved
+        if hasattr(self, '_condition'):
+            delattr(self, '_condition')
+        super().save(*args, **kwargs)
+
     @staticmethod
     def get_timedelta(delta_string:str):
         days = 0
@@ -1,15 +1,22 @@
 import logging
-from .models import BotMenuElem
-from .utils import handler_decor
+from .bme_index import find_command_bme, find_callback_bme
+from .utils import handler_decor, async_handler_decor
+from .user_cache import get_user_cache
+from .action_log_writer import get_action_log_writer
 from .td_viewset import TelegramViewSet
-from django.urls import resolve, Resolver404, reverse
+from django.urls import resolve, Resolver404, reverse, URLPattern
+from django.urls.resolvers import RegexPattern, RoutePattern
 from django.conf import settings
+from importlib import import_module
 from django.contrib.auth import get_user_model
 
 from telegram import (
     Update,
 )
 import inspect
+import re
+
+from asgiref.sync import sync_to_async
 
 
 try:
@@ -37,6 +44,150 @@ def telegram_resolve(path, utrl_conf=None):
     return resolver_match
 
 
+class CompiledUtrlMatch:
+    """
+    Result of CompiledUtrlRouter.resolve. It has the same attributes as django ResolverMatch which are used in the
+    library (func, args, kwargs, url_name, route).
+    """
+    __slots__ = ('func', 'args', 'kwargs', 'url_name', 'route')
+
+    def __init__(self, func, route, args=(), kwargs=None, url_name=None):
+        self.func = func
+        self.route = route
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.url_name = url_name
+
+    def __repr__(self):
+        return f'CompiledUtrlMatch({self.func}, {self.route})'
+
+
+class CompiledUtrlRouter:
+    """
+    Prefix trie over utrl patterns of the utrl_conf, built once. Patterns like "^cat/" (prefix) and "^me$" (exact)
+    are resolved in O(len(path)) by walking the trie, other patterns (with regex groups, includes and etc.)
+    are checked by django in the order of urlpatterns, so the result is the same as telegram_resolve returns.
+    """
+    TERMINALS_KEY = None
+    LITERAL_SYMBOLS = re.compile(r'(?:[^\\.^$*+?{}\[\]|()]|\\[^\w])*')
+    EXACT_ENDINGS = ('$', r'\Z')
+
+    def __init__(self, utrl_conf=None):
+        if utrl_conf is None:
+            utrl_conf = settings.TELEGRAM_ROOT_UTRLCONF
+
+        self.utrl_conf = utrl_conf
+        self.trie = {}
+        self.other_patterns = []  # (index, pattern) which are not literal
+        self.patterns_amount = 0
+
+        utrl_conf_module = import_module(utrl_conf) if isinstance(utrl_conf, str) else utrl_conf
+        for index, pattern in enumerate(getattr(utrl_conf_module, 'urlpatterns', [])):
+            literal = self.get_literal(pattern)
+            if literal is None:
+                self.other_patterns.append((index, pattern))
+            else:
+                self.add_to_trie(index, pattern, *literal)
+            self.patterns_amount += 1
+
+    @classmethod
+    def get_literal(cls, pattern):
+        """
+        :return: (prefix, is_exact) if pattern is a simple literal pattern without groups, else None
+        """
+        if not isinstance(pattern, URLPattern) or type(pattern.pattern) not in (RegexPattern, RoutePattern):
+            return None
+        if pattern.pattern.converters:
+            return None
+
+        regex = pattern.pattern.regex.pattern
+        if not regex.startswith('^'):
+            return None  # search in any place of path
+        regex = regex[1:]
+
+        is_exact = False
+        for ending in cls.EXACT_ENDINGS:
+            if regex.endswith(ending) and not regex.endswith('\\' + ending):
+                regex = regex[:-len(ending)]
+                is_exact = True
+                break
+
+        if cls.LITERAL_SYMBOLS.fullmatch(regex) is None:
+            return None
+        return re.sub(r'\\(.)', r'\1', regex), is_exact
+
+    def add_to_trie(self, index, pattern, prefix, is_exact):
+        node = self.trie
+        for symbol in prefix:
+            node = node.setdefault(symbol, {})
+        node.setdefault(self.TERMINALS_KEY, []).append((index, is_exact, pattern, len(prefix)))
+
+    def find_in_trie(self, path):
+        """ :return: (index, pattern) of the first pattern in urlpatterns, which matches the path """
+        best = None
+        node = self.trie
+        path_length = len(path)
+        position = 0
+        while node is not None:
+            for index, is_exact, pattern, prefix_length in node.get(self.TERMINALS_KEY, ()):
+                if (best is None or index < best[0]) and (not is_exact or prefix_length == path_length):
+                    best = (index, pattern)
+            if position == path_length:
+                break
+            node = node.get(path[position])
+            position += 1
+        return best
+
+    def resolve(self, path):
+        if '?' in path:
+            path = path.split('?')[0]
+        if path and path[0] == '/':
+            path = path[1:]
+
+        best = self.find_in_trie(path)
+        best_index = best[0] if best else self.patterns_amount
+
+        for index, pattern in self.other_patterns:
+            if index > best_index:
+                break
+
+            if isinstance(pattern, URLPattern):
+                match = pattern.pattern.match(path)
+                if match:
+                    __, args, kwargs = match
+                    kwargs.update(pattern.default_args)  # as URLPattern.resolve
+                    return CompiledUtrlMatch(pattern.callback, str(pattern.pattern), args, kwargs, pattern.name)
+            else:
+                try:
+                    resolver_match = pattern.resolve(path)
+                except Resolver404:
+                    resolver_match = None
+
+                if resolver_match:
+                    return resolver_match
+
+        if best:
+            __, pattern = best
+            return CompiledUtrlMatch(
+                pattern.callback, str(pattern.pattern), kwargs=dict(pattern.default_args), url_name=pattern.name
+            )
+        return None
+
+
+_compiled_routers = {}
+
+
+def get_compiled_router(utrl_conf=None):
+    """ return CompiledUtrlRouter for utrl_conf (router is built once) """
+    if utrl_conf is None:
+        utrl_conf = settings.TELEGRAM_ROOT_UTRLCONF
+
+    router = _compiled_routers.get(utrl_conf)
+    if router is None:
+        router = _compiled_routers[utrl_conf] = CompiledUtrlRouter(utrl_conf)
+    return router
+
+
 def telegram_reverse(viewname, utrl_conf=None, args=None, kwargs=None, current_app=None):
     if utrl_conf is None:
         utrl_conf = settings.TELEGRAM_ROOT_UTRLCONF
@@ -47,85 +198,180 @@ def telegram_reverse(viewname, utrl_conf=None, args=None, kwargs=None, current_a
     return response
 
 
-@handler_decor(log_type='C')
-def all_command_bme_handler(bot, update, user):
+def find_message_command_bme(update):
+    command = update.message.text[1:]
 
-    if len(update.message.text[1:]) and 'start' == update.message.text[1:].split()[0]:
+    if len(command) and 'start' == command.split()[0]:
         menu_elem = None
-        if len(update.message.text[1:]) > 6:  # 'start ' + something
-            menu_elem = BotMenuElem.objects.filter(
-                command__contains=update.message.text[1:],
-                is_visable=True,
-            ).first()
+        if len(command) > 6:  # 'start ' + something
+            menu_elem = find_command_bme(command)
 
         if menu_elem is None:
-            menu_elem = BotMenuElem.objects.filter(
-                command='start',
-                is_visable=True,
-            ).first()
+            menu_elem = find_command_bme('start')
     else:
-        menu_elem = BotMenuElem.objects.filter(
-            command=update.message.text[1:],
-            is_visable=True,
-        ).first()
+        menu_elem = find_command_bme(command)
+    return menu_elem
+
+
+@handler_decor(log_type='C')
+def all_command_bme_handler(bot, update, user):
+    menu_elem = find_message_command_bme(update)
     return bot.send_botmenuelem(update, user, menu_elem)
 
 
 @handler_decor(log_type='C')
 def all_callback_bme_handler(bot, update, user):
-    menu_elem = BotMenuElem.objects.filter(
-        callbacks_db__contains=update.callback_query.data,
-        is_visable=True,
-    ).first()
+    menu_elem = find_callback_bme(update.callback_query.data)
     return bot.send_botmenuelem(update, user, menu_elem)
 
 
+@async_handler_decor(log_type='C')
+async def async_all_command_bme_handler(bot, update, user):
+    menu_elem = await sync_to_async(find_message_command_bme)(update)
+    return await bot.asend_botmenuelem(update, user, menu_elem)
+
+
+@async_handler_decor(log_type='C')
+async def async_all_callback_bme_handler(bot, update, user):
+    menu_elem = await sync_to_async(find_callback_bme)(update.callback_query.data)
+    return await bot.asend_botmenuelem(update, user, menu_elem)
+
+
+
+class UtrlResolution:
+    """
+    Result of update resolving, which is computed once in RouterCallbackMessageCommandHandler.check_update and
+    passed to handle_update as check_result (so the resolver and the user query are not executed twice).
+
+    resolver_match -- ResolverMatch of utrl or None (then BME handlers are used)
+    user -- user model if it was selected from db for checking current_utrl
+    """
+    __slots__ = ('resolver_match', 'user')
+
+    def __init__(self, resolver_match=None, user=None):
+        self.resolver_match = resolver_match
+        self.user = user
+
+    def __repr__(self):
+        return f'UtrlResolution({self.resolver_match}, {self.user})'
+
 
 class RouterCallbackMessageCommandHandler(Handler):
-    def __init__(self, utrl_conf=None, only_utrl=False, **kwargs):
+    """
+    Routes callbacks, commands and messages (by user.current_utrl) to utrl functions, TelegramViewSet and BME.
+
+    chat_executor -- ChatOrderedExecutor (telegram_django_bot.chat_executor) for processing updates of the same chat
+        in order of receiving and updates of different chats in parallel. In this case user.current_utrl is checked
+        in handle_update (in order with other updates of the chat), so all messages without command are caught by
+        this handler (add it after other handlers) and errors are sent to dispatcher error handlers.
+    """
+
+    def __init__(self, utrl_conf=None, only_utrl=False, use_compiled_router=None, chat_executor=None, **kwargs):
         kwargs['callback'] = lambda x: 'for base class'
         super().__init__(**kwargs)
         self.callback = None
         self.utrl_conf = utrl_conf
         self.only_utrl = only_utrl # without BME elems
+        self.chat_executor = chat_executor
 
-    def get_callback_utrl(self, update):
+        if use_compiled_router is None:
+            use_compiled_router = getattr(settings, 'TELEGRAM_USE_COMPILED_ROUTER', False)
+        self.use_compiled_router = use_compiled_router
+
+    def telegram_resolve(self, path):
+        if self.use_compiled_router:
+            return get_compiled_router(self.utrl_conf).resolve(path)
+        return telegram_resolve(path, self.utrl_conf)
+
+    def resolve_update_utrl(self, update):
+        """ ResolverMatch of callback data or command (without db requests) """
         callback_func = None
         # check if utrls
         if update.callback_query:
-            callback_func = telegram_resolve(update.callback_query.data, self.utrl_conf)
+            callback_func = self.telegram_resolve(update.callback_query.data)
         elif update.message and update.message.text and update.message.text[0] == '/':  # is it ok? seems message couldnt be an url
-            callback_func = telegram_resolve(update.message.text, self.utrl_conf)
-
-        if callback_func is None:
-            # update.message -- could be data or info for managing, command could not be a data, it is managing info
-            if update.message and (update.message.text is None or update.message.text[0] != '/'):
-                user_details = update.message.from_user
-
-                user = get_user_model().objects.filter(id=user_details.id).first()
-                if user:
-                    logging.info(f'user.current_utrl {user.current_utrl}')
-                    if user.current_utrl:
-                        callback_func = telegram_resolve(user.current_utrl, self.utrl_conf)
+            callback_func = self.telegram_resolve(update.message.text)
         return callback_func
 
+    @staticmethod
+    def is_data_message(update):
+        # update.message -- could be data or info for managing, command could not be a data, it is managing info
+        return update.message and (update.message.text is None or update.message.text[0] != '/')
+
+    def resolve_user_utrl(self, update):
+        """ :return: user, ResolverMatch of user.current_utrl """
+        callback_func = None
+        user_details = update.message.from_user
+
+        user_cache = get_user_cache()
+        user = user_cache.get(user_details.id) if user_cache else None
+        if user is None:
+            user = get_user_model().objects.filter(id=user_details.id).first()
+            if user and user_cache:
+                user_cache.set(user)
+        if user:
+            logging.info(f'user.current_utrl {user.current_utrl}')
+            if user.current_utrl:
+                callback_func = self.telegram_resolve(user.current_utrl)
+        return user, callback_func
+
+    def resolve_update(self, update):
+        callback_func = self.resolve_update_utrl(update)
+        user = None
+
+        if callback_func is None and self.is_data_message(update):
+            user, callback_func = self.resolve_user_utrl(update)
+        return UtrlResolution(callback_func, user)
+
+    def get_callback_utrl(self, update):
+        return self.resolve_update(update).resolver_match
+
+    @staticmethod
+    def set_context_user(context, user):
+        """ user, which was selected for resolving current_utrl, is reused by handler_decor (get_handler_user) """
+        if context is not None:
+            context.resolved_user = user
+
+    @staticmethod
+    def get_update_chat_id(update):
+        """ key of updates order for chat_executor """
+        if update.effective_chat:
+            return update.effective_chat.id
+        return update.effective_user.id if update.effective_user else None
+
+    def check_update_without_db(self, update):
+        """ check_update, where all messages without command are caught (user.current_utrl is not checked) """
+        if isinstance(update, Update) and (update.effective_message or update.callback_query):
+            resolution = UtrlResolution(self.resolve_update_utrl(update))
+            if resolution.resolver_match or self.is_data_message(update):
+                return resolution
+            elif not self.only_utrl:
+                if update.message and update.message.text and update.message.text[0] == '/':
+                    return resolution
+                elif update.callback_query:
+                    return resolution
+        return None
+
     def check_update(self, update: object):
         """
         check if callback or message (command actually is message)
         :param update:
-        :return:
+        :return: UtrlResolution if update should be handled, which is reused in handle_update
         """
+        if self.chat_executor is not None:
+            return self.check_update_without_db(update)
+
         if isinstance(update, Update) and (update.effective_message or update.callback_query):
-            callback = self.get_callback_utrl(update)
-            if callback:
-                return True
+            resolution = self.resolve_update(update)
+            if resolution.resolver_match:
+                return resolution
             elif not self.only_utrl:
                 if update.message and update.message.text and update.message.text[0] == '/':
                     # if it is a command then it should be  early in handlers
                     # or in BME (then return True
-                    return True
+                    return resolution
                 elif update.callback_query:
-                    return True
+                    return resolution
         return None
 
     def handle_update(
@@ -137,15 +383,47 @@ class RouterCallbackMessageCommandHandler(Handler):
     ):
         # todo: add flush utrl and data if viewset utrl change or error
 
-        callback_func = self.get_callback_utrl(update)
+        if self.chat_executor is not None:
+            self.collect_additional_context(context, update, dispatcher, check_result)
+            return self.chat_executor.submit(
+                self.get_update_chat_id(update), self.handle_ordered_update, update, dispatcher, check_result, context
+            )
 
+        if isinstance(check_result, UtrlResolution):
+            resolution = check_result
+        else:
+            resolution = self.resolve_update(update)
+
+        self.collect_additional_context(context, update, dispatcher, check_result)
+        self.set_context_user(context, resolution.user)
+        return self.get_handler_func(update, resolution.resolver_match)(update, context)
+
+    def handle_ordered_update(self, update, dispatcher, check_result, context):
+        """ handle_update in chat_executor: errors are sent to dispatcher error handlers """
+        if isinstance(check_result, UtrlResolution):
+            resolution = check_result
+        else:
+            resolution = UtrlResolution(self.resolve_update_utrl(update))
+
+        try:
+            if resolution.resolver_match is None and self.is_data_message(update):
+                resolution.user, resolution.resolver_match = self.resolve_user_utrl(update)
+                if resolution.resolver_match is None:
+                    return None  # message without current_utrl
+            self.set_context_user(context, resolution.user)
+            return self.get_handler_func(update, resolution.resolver_match)(update, context)
+        except Exception as error:
+            dispatch_error = getattr(dispatcher, 'dispatch_error', None)
+            if dispatch_error is None:
+                raise
+            dispatch_error(update, error)
+
+    def get_handler_func(self, update, resolver_match):
+        """ handler function of the utrl resolution """
+        callback_func = resolver_match
         if not callback_func is None:
             if inspect.isclass(callback_func.func) and issubclass(callback_func.func, TelegramViewSet):
-                viewset = callback_func.func(callback_func.route)
-
-                decorating = handler_decor(log_type='N',)
-
-                callback_func = decorating(viewset.dispatch)
+                callback_func = callback_func.func.as_handler(callback_func.route)
 
             else:
                 callback_func = callback_func.func
@@ -156,8 +434,71 @@ class RouterCallbackMessageCommandHandler(Handler):
                 callback_func = all_callback_bme_handler
             else:
                 callback_func = all_command_bme_handler
+        return callback_func
 
-        self.collect_additional_context(context, update, dispatcher, check_result)
-        return callback_func(update, context)
 
+class AsyncRouterCallbackMessageCommandHandler(RouterCallbackMessageCommandHandler):
+    """
+    RouterCallbackMessageCommandHandler for python-telegram-bot 20.x+, which does not block the event loop:
+    check_update does not request db, TelegramViewSet are dispatched with adispatch, BME are sent with async handlers,
+    async handler functions (for example, with async_handler_decor) are awaited and sync ones are executed in
+    sync_to_async.
+
+    As user.current_utrl is checked in handle_update, all messages without command are caught by this handler,
+    so add it after other handlers.
+
+    chat_executor -- AsyncChatOrderedExecutor for processing updates of the same chat in order of receiving
+        (if application has concurrent_updates)
+    """
+
+    def check_update(self, update: object):
+        return self.check_update_without_db(update)
+
+    async def handle_update(
+        self,
+        update,
+        application,
+        check_result: object,
+        context=None,
+    ):
+        get_action_log_writer().start()  # flushing task is started in the event loop
+        if self.chat_executor is not None:
+            return await self.chat_executor.run(
+                self.get_update_chat_id(update), self.handle_ordered_update, update, application, check_result, context
+            )
+        return await self.handle_ordered_update(update, application, check_result, context)
+
+    async def handle_ordered_update(self, update, application, check_result, context):
+        if isinstance(check_result, UtrlResolution):
+            resolution = check_result
+        else:
+            resolution = UtrlResolution(self.resolve_update_utrl(update))
+        callback_func = resolution.resolver_match
+
+        if callback_func is None and self.is_data_message(update):
+            resolution.user, callback_func = await sync_to_async(self.resolve_user_utrl)(update)
+            if callback_func is None:
+                return None  # message without current_utrl
+
+        if not callback_func is None:
+            if inspect.isclass(callback_func.func) and issubclass(callback_func.func, TelegramViewSet):
+                callback_func = callback_func.func.as_async_handler(callback_func.route)
+
+            else:
+                callback_func = callback_func.func
+
+        if callback_func is None:
+            if update.callback_query:
+                callback_func = async_all_callback_bme_handler
+            else:
+                callback_func = async_all_command_bme_handler
+
+        self.collect_additional_context(context, update, application, check_result)
+        self.set_context_user(context, resolution.user)
+        if inspect.iscoroutinefunction(callback_func):
+            return await callback_func(update, context)
 
+        res = await sync_to_async(callback_func)(update, context)
+        if inspect.isawaitable(res):
+            res = await res
+        return res
@@ -0,0 +1,58 @@
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
+
+
+class BackendFromSettings:
+    """
+    Lazy created backend instance from setting in format:
+        SETTING_NAME = {
+            'BACKEND': 'path.to.BackendClass',
+            'OPTIONS': {},  # kwargs for BackendClass
+        }
+
+    The instance is recreated if setting is changed (for example, by override_settings in tests).
+    default -- setting value if it is not set in django settings (None -- no backend)
+    """
+    instances = []
+
+    def __init__(self, setting_name, default=None):
+        self.setting_name = setting_name
+        self.default = default
+        self._backend = None
+        self._is_loaded = False
+        self._lock = threading.Lock()
+        setting_changed.connect(self._setting_changed, weak=False)
+        self.instances.append(self)
+
+    def get(self):
+        if not self._is_loaded:
+            with self._lock:
+                if not self._is_loaded:
+                    backend_settings = getattr(settings, self.setting_name, self.default)
+                    if backend_settings:
+                        backend_class = import_string(backend_settings['BACKEND'])
+                        self._backend = backend_class(**backend_settings.get('OPTIONS', {}))
+                    else:
+                        self._backend = None
+                    self._is_loaded = True
+        return self._backend
+
+    def reset(self):
+        with self._lock:
+            if self._backend is not None and hasattr(self._backend, 'close'):
+                self._backend.close()
+            self._backend = None
+            self._is_loaded = False
+
+    @classmethod
+    def reset_all(cls):
+        """ recreate all backends (for example, in tests for clearing in-process states) """
+        for instance in cls.instances:
+            instance.reset()
+
+    def _setting_changed(self, setting, **kwargs):
+        if setting == self.setting_name:
+            self.reset()
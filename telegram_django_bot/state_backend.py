@@ -0,0 +1,143 @@
+from django.core.cache import caches
+
+from .settings_backends import BackendFromSettings
+
+
+EMPTY_FORM_DB = '{}'
+
+
+class BaseStateBackend:
+    """
+    Storage of in-progress form drafts (json of {'form_name': '', 'form_data': {}}), which are saved by
+    TelegramUser.save_form_in_db. Changes are made in the user instance by set_form_db and are written to
+    the storage by save (in TelegramUser.save_state, so once per update inside handler_decor).
+    """
+
+    def get_form_db(self, user) -> str:
+        raise NotImplementedError()
+
+    def set_form_db(self, user, form_db: str):
+        raise NotImplementedError()
+
+    def save(self, user):
+        raise NotImplementedError()
+
+
+class DBStateBackend(BaseStateBackend):
+    """ drafts in TelegramUser.current_utrl_form_db (saved together with other user state fields) """
+
+    def get_form_db(self, user) -> str:
+        return user.current_utrl_form_db
+
+    def set_form_db(self, user, form_db: str):
+        user.current_utrl_form_db = form_db
+
+    def save(self, user):
+        pass
+
+
+class KeyValueStateBackend(BaseStateBackend):
+    """
+    Drafts in key-value storage with timeout (abandoned drafts are expired). The draft is requested from the storage
+    once per user instance, TelegramUser.current_utrl_form_db column is not used.
+    """
+
+    def __init__(self, key_prefix='telegram_django_bot_state', timeout=24 * 3600, **kwargs):
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+
+    def get_key(self, user_id):
+        return f'{self.key_prefix}:form:{user_id}'
+
+    def get_form_db(self, user) -> str:
+        if '_state_form_db' not in user.__dict__:
+            user._state_form_db = self._get(self.get_key(user.pk)) or EMPTY_FORM_DB
+        return user._state_form_db
+
+    def set_form_db(self, user, form_db: str):
+        user._state_form_db = form_db
+        user._is_state_form_db_changed = True
+
+    def save(self, user):
+        if user.__dict__.pop('_is_state_form_db_changed', False):
+            if user._state_form_db == EMPTY_FORM_DB:
+                self._delete(self.get_key(user.pk))
+            else:
+                self._set(self.get_key(user.pk), user._state_form_db)
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def _set(self, key, value):
+        raise NotImplementedError()
+
+    def _delete(self, key):
+        raise NotImplementedError()
+
+
+class DjangoCacheStateBackend(KeyValueStateBackend):
+    """ drafts in django cache framework """
+
+    def __init__(self, cache_alias='default', **kwargs):
+        super().__init__(**kwargs)
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _get(self, key):
+        return self.cache.get(key)
+
+    def _set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def _delete(self, key):
+        self.cache.delete(key)
+
+
+class RedisStateBackend(KeyValueStateBackend):
+    """
+    drafts in Redis (or other storage with Redis protocol).
+
+    url -- connection url for redis.Redis.from_url (redis package is needed)
+    client -- ready client with get, set(ex=) and delete methods (instead of url)
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', client=None, **kwargs):
+        super().__init__(**kwargs)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def _get(self, key):
+        value = self.client.get(key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _set(self, key, value):
+        self.client.set(key, value, ex=self.timeout)
+
+    def _delete(self, key):
+        self.client.delete(key)
+
+    def close(self):
+        if hasattr(self.client, 'close'):
+            self.client.close()
+
+
+_state_backend = BackendFromSettings(
+    'TELEGRAM_STATE_BACKEND',
+    default={'BACKEND': 'telegram_django_bot.state_backend.DBStateBackend'},
+)
+
+
+def get_state_backend():
+    """
+    State backend from settings TELEGRAM_STATE_BACKEND (DBStateBackend by default), for example:
+        TELEGRAM_STATE_BACKEND = {
+            'BACKEND': 'telegram_django_bot.state_backend.RedisStateBackend',
+            'OPTIONS': {'url': 'redis://localhost:6379/0', 'timeout': 24 * 3600},
+        }
+    """
+    return _state_backend.get() or DBStateBackend()
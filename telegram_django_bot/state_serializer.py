@@ -0,0 +1,129 @@
+import datetime
+import decimal
+import json
+import uuid
+
+from django.db import models
+from django.db.models import QuerySet
+from django.utils.functional import Promise
+
+
+class TelegramDjangoJsonDecoder(json.JSONDecoder):
+    """ decoder of old (untagged) state json: strings in date/time iso format are converted to dates and times """
+
+    def __init__(self, *args, **kwargs):
+        super(TelegramDjangoJsonDecoder, self).__init__(*args, object_hook=self.object_hook_decoder, **kwargs)
+
+    def object_hook_decoder(self, sub_dict, *args, **kwargs):
+        # so it works only for dictionary data (if datetime is in list it will not be worked)
+        for key in sub_dict.keys():
+            value = sub_dict[key]
+            dt_object = None
+            if type(value) == str:
+                try:
+                    dt_object = datetime.time.fromisoformat(value)
+                except ValueError:
+                    try:
+                        dt_object = datetime.date.fromisoformat(value)
+                    except ValueError:
+                        try:
+                            dt_object = datetime.datetime.fromisoformat(value)
+                        except ValueError:
+                            pass
+
+                if dt_object:
+                    sub_dict[key] = dt_object
+
+        return sub_dict
+
+
+TAGGED_FORMAT_PREFIX = '{"__tdb__":1,"v":'
+TYPE_KEY = '__t'
+VALUE_KEY = 'v'
+TYPE_KEY_JSON = f'"{TYPE_KEY}":'
+
+
+class TaggedJSONEncoder(json.JSONEncoder):
+    """
+    Encoder of user state (form data and context) with explicit types of values:
+        {"__t": "date", "v": "2020-01-01"}
+    models are saved as pk and querysets as list of str pk (as form fields expect).
+    tags_amount -- amount of written tags (for checking that user dicts do not have "__t" key, see dumps_state)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tags_amount = 0
+
+    def default(self, o):
+        value = self.get_tagged(o)
+        if isinstance(value, dict):
+            self.tags_amount += 1
+        return value
+
+    def get_tagged(self, o):
+        if isinstance(o, datetime.datetime):
+            return {TYPE_KEY: 'datetime', VALUE_KEY: o.isoformat()}
+        elif isinstance(o, datetime.date):
+            return {TYPE_KEY: 'date', VALUE_KEY: o.isoformat()}
+        elif isinstance(o, datetime.time):
+            return {TYPE_KEY: 'time', VALUE_KEY: o.isoformat()}
+        elif isinstance(o, datetime.timedelta):
+            return {TYPE_KEY: 'timedelta', VALUE_KEY: o.total_seconds()}
+        elif isinstance(o, decimal.Decimal):
+            return {TYPE_KEY: 'decimal', VALUE_KEY: str(o)}
+        elif isinstance(o, models.Model):
+            return {TYPE_KEY: 'pk', VALUE_KEY: o.pk}
+        elif isinstance(o, QuerySet):
+            return {TYPE_KEY: 'pks', VALUE_KEY: [str(pk) for pk in o.values_list('pk', flat=True)]}
+        elif isinstance(o, (uuid.UUID, Promise)):
+            return str(o)
+        return super().default(o)
+
+
+TAG_DECODERS = {
+    'datetime': datetime.datetime.fromisoformat,
+    'date': datetime.date.fromisoformat,
+    'time': datetime.time.fromisoformat,
+    'timedelta': lambda value: datetime.timedelta(seconds=value),
+    'decimal': decimal.Decimal,
+    'pk': lambda value: value,
+    'pks': list,
+    'dict': dict,  # escaped user dict with "__t" key: {"__t": "dict", "v": [[key, value], ...]}
+}
+
+
+def decode_tagged(sub_dict):
+    if len(sub_dict) == 2 and TYPE_KEY in sub_dict and VALUE_KEY in sub_dict:
+        decoder = TAG_DECODERS.get(sub_dict[TYPE_KEY])
+        if decoder:
+            return decoder(sub_dict[VALUE_KEY])
+    return sub_dict
+
+
+def escape_tagged_dicts(value):
+    """ user dicts with "__t" key are written as list of items, so they are not decoded as tagged values """
+    if isinstance(value, dict):
+        if TYPE_KEY in value:
+            return {TYPE_KEY: 'dict', VALUE_KEY: [[key, escape_tagged_dicts(item)] for key, item in value.items()]}
+        return {key: escape_tagged_dicts(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [escape_tagged_dicts(item) for item in value]
+    return value
+
+
+def dumps_state(value) -> str:
+    """ json with tagged types (dates, decimals, models) for user state fields """
+    encoder = TaggedJSONEncoder(separators=(',', ':'))
+    text = encoder.encode(value)
+    if text.count(TYPE_KEY_JSON) != encoder.tags_amount:
+        # rare case: there are user dicts with "__t" key (only keys are written as "__t": in json)
+        text = TaggedJSONEncoder(separators=(',', ':')).encode(escape_tagged_dicts(value))
+    return f'{TAGGED_FORMAT_PREFIX}{text}}}'
+
+
+def loads_state(text: str):
+    """ reads tagged json of dumps_state and old (untagged) json of user state fields """
+    if text.startswith(TAGGED_FORMAT_PREFIX):
+        return json.loads(text, object_hook=decode_tagged)[VALUE_KEY]
+    return json.loads(text, cls=TelegramDjangoJsonDecoder)
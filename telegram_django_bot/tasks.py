@@ -1,105 +1,181 @@
+import logging
+
 from django.conf import settings
 
 from django.utils import timezone
-from django.db.models import Count
-from django.db.models.functions import Coalesce
-from django.db.models import OuterRef, Exists
+from django.db.models import (
+    OuterRef, Exists, Value, IntegerField, DateTimeField, BooleanField, Case, When, Q,
+)
+from django.db import connections, transaction
+from django.core.exceptions import ValidationError
 
 from django.contrib.auth import get_user_model
 from .models import Trigger, UserTrigger, ActionLog
+from . import action_log_rollup
+from .action_log_rollup import get_rollup_days
 from .tg_dj_bot import TG_DJ_Bot
+from .broadcast import Broadcast
 from celery import current_app
 
 
-@current_app.task
-def create_triggers():
-    def get_duration_dict(trigger, elem, add_prefix=True):
-        prefix = 'actionlog__'
-        if not add_prefix:
-            prefix = ''
-        return {
-            f'{prefix}dttm__gte': dttm_now - trigger.get_timedelta(elem.pop('duration'))
-        }
-
-    dttm_now = timezone.now()
-    User = get_user_model()
-
-    for trigger in Trigger.objects.bot_filter_active().order_by('-priority').select_related('botmenuelem'):
-        users = User.objects.filter(is_active=True)
-
-        seeds = trigger.condition.pop('seeds', [])
-        if seeds:
-            users = users.filter(seed_code__in=seeds)
-
-        # sequence = trigger.condition.pop('sequence', [])
-        # if len(sequence):
-        #     query = Q()
-        #     for seq_elem in sequence:
-        #         query = Q()
-        #         for elem in seq_elem:
-        #             kwargs = get_duration_dict(trigger, elem)
-        #             for key, value in elem.items():
-        #                 kwargs[f'actionlog__{key}'] = value
-        #             query |= Q(**kwargs)
-        #     users = users.filter(query)
-
-        # exclude = trigger.condition.pop('exclude', [])
-        # if len(exclude):
-        #     query = Q()
-        #     for elem in exclude:
-        #         kwargs = get_duration_dict(trigger, elem)
-        #         for key, value in elem.items():
-        #             kwargs[f'actionlog__{key}'] = value
-        #         query |= Q(**kwargs)
-        #     users = users.exclude(query)
-
-        check_amount = trigger.condition.pop('amount', [])
-        if len(check_amount):
-            for it, elem in enumerate(check_amount):
-                filter_key = None
-                filter_kwargs = get_duration_dict(trigger, elem, False)
-                for key_d, value in elem.items():
-                    if 'type' in key_d:
-                        filter_kwargs[key_d] = value
-                    else:
-                        filter_key = key_d
-                        filter_value = value
-                if filter_key:
-                    key = f'amount{it}'
-                    subquery = ActionLog.objects.filter(
-                        user_id=OuterRef('id'),
-                        **filter_kwargs,
-                    ).values('user_id').annotate(amount=Count('user_id')).values('amount')
-
-                    users = users.annotate(**{
-                        key: Coalesce(subquery, 0)
-                    }).filter(**{f'{key}__{filter_key}': filter_value})
-
-        user_triggers = UserTrigger.objects.filter(
-            trigger=trigger,
-            user=OuterRef('id'),
-            dttm_added__gte=dttm_now - trigger.min_duration
-        )
+TRIGGER_USERS_CHUNK_SIZE = 500  # amount of users in 1 send_triggers task
+SCHEDULED_TRIGGER_FIELD = 'scheduled_trigger_id'
 
-        users = users.annotate(exist_trigger=Exists(user_triggers)).filter(exist_trigger=False)
 
-        # todo: intersection with other triggers -- minimum time between triggers to do?
+def create_user_triggers(users, chunk_size=TRIGGER_USERS_CHUNK_SIZE):
+    """
+    ids of users of get_scheduled_users and their triggers are streamed from db once, UserTrigger are created by
+    chunks and send_triggers is called for each chunk in the same pass (so memory does not depend on the amount
+    of users)
+    :return: amount of created UserTrigger
+    """
 
+    def create_chunk(chunk):
         UserTrigger.objects.bulk_create([
-            UserTrigger(trigger=trigger, user=user) for user in users
+            UserTrigger(trigger_id=trigger_id, user_id=user_id) for user_id, trigger_id in chunk
         ])
+        send_triggers.delay([user_id for user_id, _ in chunk])
+
+    amount = 0
+    chunk = []
+    for user_trigger_id in users.values_list('id', SCHEDULED_TRIGGER_FIELD).iterator(chunk_size=chunk_size):
+        chunk.append(user_trigger_id)
+        if len(chunk) == chunk_size:
+            create_chunk(chunk)
+            amount += len(chunk)
+            chunk = []
+
+    if chunk:
+        create_chunk(chunk)
+        amount += len(chunk)
+    return amount
+
+
+def get_scheduled_users(triggers, dttm_now, cooldown=None, rollup_days=None):
+    """
+    queryset of users, who should get a trigger now, annotated with SCHEDULED_TRIGGER_FIELD. All triggers are
+    checked in 1 scan of users and each user gets at most 1 trigger -- the first suitable one in triggers order.
+
+    :param triggers: triggers ordered by priority
+    :param cooldown: minimum time between any 2 triggers of a user (timedelta), None -- only min_duration of triggers
+    :param rollup_days: RollupDays of ActionLogDailyCount for counting amount conditions, None -- count ActionLog
+    """
+    users = get_user_model().objects.filter(is_active=True)
+    if cooldown:
+        users = users.filter(~Exists(UserTrigger.objects.filter(
+            user=OuterRef('id'),
+            dttm_added__gte=dttm_now - cooldown,
+        )))
+
+    whens = []
+    for trigger in triggers:
+        prefix = f'trigger{trigger.id}_'
+        try:
+            condition = trigger.compiled_condition
+        except ValidationError as error:  # condition saved before validation, other triggers are still scheduled
+            logging.error(f'create_triggers: {trigger} has not valid condition: {error.messages}')
+            continue
+        users = users.annotate(**condition.get_annotations(dttm_now, prefix, rollup_days))
+
+        q = Q(condition.get_q(dttm_now, prefix), ~Exists(UserTrigger.objects.filter(
+            trigger_id=trigger.id,
+            user=OuterRef('id'),
+            dttm_added__gte=dttm_now - trigger.min_duration,
+        )))
+        whens.append(When(q, then=Value(trigger.id)))
+
+    if not whens:
+        return users.none()
+
+    return users.annotate(**{
+        SCHEDULED_TRIGGER_FIELD: Case(*whens, default=None, output_field=IntegerField())
+    }).filter(**{f'{SCHEDULED_TRIGGER_FIELD}__isnull': False})
+
+
+def insert_user_triggers(users, dttm_now):
+    """
+    UserTrigger are created in db with 1 INSERT ... SELECT ... RETURNING query (users are not loaded to python).
+    Databases without RETURNING (SQLite, MySQL): users are selected and UserTrigger are created by bulk_create
+    in 1 transaction, so exactly created UserTrigger are returned.
+
+    :param users: users of get_scheduled_users
+    :return: ids of users with created UserTrigger
+    """
+    connection = connections[users.db]
+    user_triggers = users.annotate(
+        dttm_added_value=Value(dttm_now, output_field=DateTimeField()),
+        is_sent_value=Value(False, output_field=BooleanField()),
+    ).values_list(
+        'id', SCHEDULED_TRIGGER_FIELD, 'dttm_added_value', 'is_sent_value',
+    ).order_by()
+
+    if not connection.features.can_return_rows_from_bulk_insert:
+        with transaction.atomic(using=users.db):
+            rows = list(user_triggers)
+            UserTrigger.objects.using(users.db).bulk_create([
+                UserTrigger(user_id=user_id, trigger_id=trigger_id, dttm_added=dttm_now)
+                for user_id, trigger_id, _, _ in rows
+            ], batch_size=TRIGGER_USERS_CHUNK_SIZE)
+        return [row[0] for row in rows]
+
+    qn = connection.ops.quote_name
+    select_sql, select_params = user_triggers.query.get_compiler(using=users.db).as_sql()
+    columns = ', '.join(qn(UserTrigger._meta.get_field(name).column) for name in [
+        'user', 'trigger', 'dttm_added', 'is_sent',
+    ])
+    insert_sql = (
+        f'INSERT INTO {qn(UserTrigger._meta.db_table)} ({columns}) {select_sql} '
+        f'RETURNING {qn(UserTrigger._meta.get_field("user").column)}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(insert_sql, select_params)
+        return [row[0] for row in cursor.fetchall()]
 
-        trig_users = []
-        for user in users:
-            trig_users.append(user.id)
-            if len(trig_users) == 500:
-                send_triggers.delay(trig_users)
-                trig_users = []
 
-        if len(trig_users):
-            send_triggers.delay(trig_users)
+def send_user_triggers(user_ids, chunk_size=TRIGGER_USERS_CHUNK_SIZE):
+    for it in range(0, len(user_ids), chunk_size):
+        send_triggers.delay(user_ids[it: it + chunk_size])
 
 
+@current_app.task
+def create_triggers(use_insert_select=None, cooldown=None, use_rollup=None):
+    """
+    all active triggers are checked in 1 scan of users (get_scheduled_users), so a user gets at most 1 trigger
+    in a run (the trigger with the highest priority).
+
+    :param use_insert_select: create UserTrigger by INSERT ... SELECT in db (insert_user_triggers) instead of
+        streaming ids of users and their triggers through python (create_user_triggers). By default it is
+        TELEGRAM_TRIGGERS_INSERT_SELECT
+    :param cooldown: minimum time between any 2 triggers of a user. By default it is TELEGRAM_TRIGGERS_COOLDOWN
+    :param use_rollup: count amount conditions by ActionLogDailyCount (rollup_action_logs task) instead of ActionLog.
+        By default it is TELEGRAM_TRIGGERS_USE_ACTION_LOG_ROLLUP
+    """
+    if use_insert_select is None:
+        use_insert_select = getattr(settings, 'TELEGRAM_TRIGGERS_INSERT_SELECT', False)
+    if cooldown is None:
+        cooldown = getattr(settings, 'TELEGRAM_TRIGGERS_COOLDOWN', None)
+    if use_rollup is None:
+        use_rollup = getattr(settings, 'TELEGRAM_TRIGGERS_USE_ACTION_LOG_ROLLUP', False)
+
+    dttm_now = timezone.now()
+    triggers = list(Trigger.objects.bot_filter_active().order_by('-priority', 'id'))
+    users = get_scheduled_users(triggers, dttm_now, cooldown, get_rollup_days() if use_rollup else None)
+
+    if use_insert_select:
+        user_ids = insert_user_triggers(users, dttm_now)
+        send_user_triggers(user_ids)
+        amount = len(user_ids)
+    else:
+        amount = create_user_triggers(users)
+    logging.info(f'create_triggers: {amount} users for {len(triggers)} triggers')
+
+
+@current_app.task
+def rollup_action_logs():
+    """ counts ActionLog of not rolled up days in ActionLogDailyCount (add to CeleryBeat schedule for using rollup) """
+    amount = action_log_rollup.rollup_action_logs()
+    logging.info(f'rollup_action_logs: {amount} day counts')
+
 
 @current_app.task
 def send_triggers(user_ids):
@@ -118,20 +194,14 @@ def send_triggers(user_ids):
 
     bot = TG_DJ_Bot(settings.TELEGRAM_TOKEN)
 
-    def _send_wrapper(self, *args, **kwargs):
-        return bot.send_botmenuelem(*args, **kwargs)
-
     sent_user_triggers = []
-    for user_trigger in user_triggers:
-        is_sent, res_mess = bot.task_send_message_handler(
-            _send_wrapper,
-            user_trigger.user,
-            None,
-            user_trigger.user,  # for task_send_message_handler и для send_botmenuelem
-            user_trigger.trigger.botmenuelem
-        )
-        if is_sent:
-            sent_user_triggers.append(user_trigger)
+
+    def send_user_trigger(bot, user_trigger):
+        bot.send_botmenuelem(None, user_trigger.user, user_trigger.trigger.botmenuelem)
+        sent_user_triggers.append(user_trigger)
+
+    report = Broadcast(bot, send_user_trigger, get_user=lambda user_trigger: user_trigger.user).run(user_triggers)
+    logging.info(f'send_triggers: {report}')
 
     UserTrigger.objects.filter(id__in=[x.id for x in sent_user_triggers]).update(is_sent=True)
     ActionLog.objects.bulk_create([
@@ -1,16 +1,18 @@
 import logging
 
-import re
 import copy
+from django.core.exceptions import FieldDoesNotExist
 from django.forms import HiddenInput
-from django.forms.models import ModelMultipleChoiceField
+from django.forms.models import ModelChoiceField, ModelMultipleChoiceField
 from django.db import models
 from django.forms.fields import ChoiceField, BooleanField
 from django.utils.translation import gettext as _, gettext_lazy
+from asgiref.sync import sync_to_async
 
-from .utils import add_log_action
+from .utils import add_log_action, handler_decor, async_handler_decor
 from .telegram_lib_redefinition import InlineKeyboardButtonDJ as inlinebutt
 from .permissions import PermissionAllowAny
+from .count_cache import get_cached_count
 
 
 class TelegramViewSetMetaClass(type):
@@ -81,6 +83,25 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
 
     use_name_and_id_in_elem_showing = True
 
+    # show_list pages by the last shown key of unique keyset_pagination_field (with '-' for descending order)
+    # instead of count() and offset, so each page is 1 query regardless of depth
+    use_keyset_pagination = False
+    keyset_pagination_field = 'pk'
+    KEYSET_CURSOR_SEPARATOR = ':'
+
+    # related fields for select_related / prefetch_related in show_list and get_orm_model,
+    # None -- ForeignKey / ManyToMany fields of model_form (see get_related_plan)
+    select_related_fields = None
+    prefetch_related_fields = None
+
+    # seconds of caching count of show_list (None -- count on each page), cache key contains viewset prefix,
+    # foreign filters and user; cached counts are reset after saving or deleting of queryset models and models
+    # joined by filters of get_queryset (not of subqueries, their changes are seen after timeout)
+    show_list_count_cache_timeout = None
+    show_list_count_cache_alias = 'default'
+    # count by database statistics (PostgreSQL), if exact amount of models is not needed
+    use_approximate_count = False
+
     meta_texts_dict = {
         'succesfully_deleted': gettext_lazy('The %(viewset_name)s  %(model_id)s is successfully deleted.'),
         'confirm_deleting': gettext_lazy('Are you sure you want to delete %(viewset_name)s  %(model_id)s?'),
@@ -102,25 +123,128 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
         self.form = None
         self.foreign_filters = foreign_filters or []
 
-        self.viewset_routing = {}
+        self.actions_routing = self.get_actions_routing()
+        self.prefix = prefix.replace('^', '').replace('$', '')
 
-        if self.queryset is None:
-            raise ValueError('queryset could not be None')
+    @classmethod
+    def get_actions_routing(cls) -> dict:
+        """
+        {utrl command: action name} for actions of the class. It is checked and created once per class.
+        """
+        actions_routing = cls.__dict__.get('_actions_routing')
+        if actions_routing is None:
+            if cls.queryset is None:
+                raise ValueError('queryset could not be None')
+
+            if cls.model_form is None:
+                raise ValueError('model_form could not be None')
+
+            actions_routing = {}
+            for action in cls.actions:
+                cr_action = f'command_routing_{action}'
+                if not cr_action in cls.command_routings.keys():
+                    raise ValueError(
+                        f'for action {action} must be determinate {cr_action},'
+                        f' but list is {cls.command_routings.keys()}'
+                    )
 
-        if self.model_form is None:
-            raise ValueError('model_form could not be None')
+                actions_routing[cls.command_routings[cr_action]] = action
+            cls._actions_routing = actions_routing
+        return actions_routing
 
-        for action in self.actions:
-            cr_action = f'command_routing_{action}'
-            if not cr_action in self.command_routings.keys():
-                raise ValueError(
-                    f'for action {action} must be determinate {cr_action},'
-                    f' but list is {self.command_routings.keys()}'
-                )
+    @classmethod
+    def get_related_plan(cls):
+        """
+        (select_related fields, prefetch_related fields) for showing models: forward ForeignKey / OneToOne and
+        ManyToMany fields of model_form, which are shown (not hidden). It is created once per class, redefine
+        select_related_fields / prefetch_related_fields or this method for changing the plan.
+        """
+        related_plan = cls.__dict__.get('_related_plan')
+        if related_plan is None:
+            select_related_fields, prefetch_related_fields = [], []
+            if cls.select_related_fields is None or cls.prefetch_related_fields is None:
+                model_meta = cls.queryset.model._meta
+                for field_name, form_field in cls.model_form.base_fields.items():
+                    if type(form_field.widget) == HiddenInput:
+                        continue
+                    try:
+                        model_field = model_meta.get_field(field_name)
+                    except FieldDoesNotExist:
+                        continue
+
+                    if model_field.many_to_many:
+                        prefetch_related_fields.append(field_name)
+                    elif model_field.is_relation and model_field.concrete and (
+                            model_field.many_to_one or model_field.one_to_one):
+                        select_related_fields.append(field_name)
+
+            related_plan = cls._related_plan = (
+                select_related_fields if cls.select_related_fields is None else list(cls.select_related_fields),
+                prefetch_related_fields if cls.prefetch_related_fields is None else list(cls.prefetch_related_fields),
+            )
+        return related_plan
+
+    def apply_related_plan(self, queryset):
+        select_related_fields, prefetch_related_fields = self.get_related_plan()
+        if select_related_fields:
+            queryset = queryset.select_related(*select_related_fields)
+        if prefetch_related_fields:
+            queryset = queryset.prefetch_related(*prefetch_related_fields)
+        return queryset
+
+    @classmethod
+    def get_permissions(cls) -> list:
+        """ instances of permission_classes, created once per class """
+        permissions = cls.__dict__.get('_permissions')
+        if permissions is None:
+            permissions = cls._permissions = [permission() for permission in cls.permission_classes]
+        return permissions
+
+    @classmethod
+    def as_handler(cls, prefix):
+        """
+        Handler function (update, context) for the route prefix. It is created once per route, so checking of actions,
+        permissions and handler_decor wrapper are reused and only a new viewset object is created for each update.
+        """
+        route_handlers = cls.__dict__.get('_route_handlers')
+        if route_handlers is None:
+            route_handlers = cls._route_handlers = {}
 
-            self.viewset_routing[self.command_routings[cr_action]] = self.__getattribute__(action)
+        handler = route_handlers.get(prefix)
+        if handler is None:
+            cls.get_actions_routing()
+            cls.get_permissions()
 
-        self.prefix = prefix.replace('^', '').replace('$', '')
+            def dispatch(bot, update, user):
+                return cls(prefix).dispatch(bot, update, user)
+
+            dispatch.__name__ = f'{cls.__name__}.dispatch'
+            handler = route_handlers[prefix] = handler_decor(log_type='N')(dispatch)
+        return handler
+
+    @classmethod
+    def as_async_handler(cls, prefix):
+        """ as_handler for python-telegram-bot 20.x+: async handler function, which calls adispatch """
+        route_handlers = cls.__dict__.get('_async_route_handlers')
+        if route_handlers is None:
+            route_handlers = cls._async_route_handlers = {}
+
+        handler = route_handlers.get(prefix)
+        if handler is None:
+            cls.get_actions_routing()
+            cls.get_permissions()
+
+            async def adispatch(bot, update, user):
+                return await cls(prefix).adispatch(bot, update, user)
+
+            adispatch.__name__ = f'{cls.__name__}.adispatch'
+            handler = route_handlers[prefix] = async_handler_decor(log_type='N')(adispatch)
+        return handler
+
+    @property
+    def viewset_routing(self) -> dict:
+        """ {utrl command: action function} """
+        return {command: getattr(self, action) for command, action in self.actions_routing.items()}
 
     @property
     def viewset_name(self) -> str:
@@ -141,27 +265,49 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
     def dispatch(self, bot, update, user):
         """ terminate function for response """
 
+        chat_reply_action, chat_action_args, utrl = self.get_answer(bot, update, user)
+        res = self.send_answer(chat_reply_action, chat_action_args, utrl)
+        self.log_utrl(utrl)
+        return res
+
+    async def adispatch(self, bot, update, user):
+        """
+        dispatch for python-telegram-bot 20.x+: actions (with db requests) are executed in sync_to_async and the answer
+        is sent with asend_answer
+        """
+
+        chat_reply_action, chat_action_args, utrl = await sync_to_async(self.get_answer)(bot, update, user)
+        res = await self.asend_answer(chat_reply_action, chat_action_args, utrl)
+        await sync_to_async(self.log_utrl)(utrl)
+        return res
+
+    def get_answer(self, bot, update, user):
+        """
+        checks permissions, selects and executes action function basing on user action
+        :return: chat_reply_action, chat_action_args, utrl
+        """
+
         self.bot = bot
         self.update = update
         self.user = user
 
         utrl = update.callback_query.data if update.callback_query else user.current_utrl
-        utrl_args = self.get_utrl_params(re.sub(f'^{self.prefix}', '', utrl))
+        # utrls of viewset are created as self.prefix + args, so prefix is stripped as a text (not a regex)
+        utrl_args = self.get_utrl_params(utrl[len(self.prefix):] if utrl.startswith(self.prefix) else utrl)
         logging.debug(f'used utrl: {utrl}')
 
         if self.has_permissions(bot, update, user, utrl_args):
-            chat_reply_action, chat_action_args = self.viewset_routing[utrl_args[0]](*utrl_args[1:])
+            chat_reply_action, chat_action_args = getattr(self, self.actions_routing[utrl_args[0]])(*utrl_args[1:])
         else:
             chat_reply_action = self.CHAT_ACTION_MESSAGE
             message = _('Sorry, you do not have permissions to this action.')
             buttons = []
             chat_action_args = (message, buttons)
+        return chat_reply_action, chat_action_args, utrl
 
-        res = self.send_answer(chat_reply_action, chat_action_args, utrl)
-
+    def log_utrl(self, utrl):
         utrl_path = utrl.split(self.ARGS_SEPARATOR_SYMBOL)[0]   # log without params as there are too much varients
         add_log_action(self.user.id, utrl_path)
-        return res
 
     def get_utrl_params(self, utrl):
         edge = self.foreign_filter_amount + 1
@@ -170,8 +316,8 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
         return args[:1] + args[edge:]
 
     def has_permissions(self, bot, update, user, utrl_args, **kwargs):
-        for permission in self.permission_classes:
-            if not permission().has_permissions(bot, update, user, utrl_args, **kwargs):
+        for permission in self.get_permissions():
+            if not permission.has_permissions(bot, update, user, utrl_args, **kwargs):
                 return False
         return True
 
@@ -187,6 +333,19 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
             raise ValueError(f'unknown chat_action {chat_reply_action} {utrl}, {self.user}')
         return res
 
+    async def asend_answer(self, chat_reply_action, chat_action_args, utrl, *args, **kwargs):
+        """ async version of send_answer (should be redefined together with send_answer) """
+        if chat_reply_action == self.CHAT_ACTION_MESSAGE:
+            message, buttons = chat_action_args
+            res = await self.bot.aedit_or_send(
+                self.update,
+                message,
+                buttons,
+            )
+        else:
+            raise ValueError(f'unknown chat_action {chat_reply_action} {utrl}, {self.user}')
+        return res
+
     # 5 main functions for data managing
 
     def create(self, field=None, value=None, initial_data=None):
@@ -259,19 +418,30 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
 
     def show_list(self, page=0, per_page=10, columns=1, *args, **kwargs):
         """show list items"""
-        page = int(page)
+        per_page, columns = int(per_page), int(columns)
 
         # generate content
-        count_models, page_models, first_this_page, first_next_page = self.show_list_get_queryset(
-            page, per_page, columns, *args, **kwargs
-        )
+        if self.use_keyset_pagination:
+            page, page_models, has_prev_page, has_next_page = self.show_list_get_keyset_queryset(
+                page, per_page, columns, *args, **kwargs
+            )
+        else:
+            page = int(page)
+            count_models, page_models, first_this_page, first_next_page = self.show_list_get_queryset(
+                page, per_page, columns, *args, **kwargs
+            )
 
         # generate view of content
         if page_models_amount := len(page_models):
             mess = ''
-            buttons = self.gm_show_list_create_pagination(
-                page, count_models, first_this_page, first_next_page, page_models_amount
-            )
+            if self.use_keyset_pagination:
+                buttons = self.gm_show_list_create_keyset_pagination(
+                    page, page_models, has_prev_page, has_next_page
+                )
+            else:
+                buttons = self.gm_show_list_create_pagination(
+                    page, count_models, first_this_page, first_next_page, page_models_amount
+                )
 
             for it_m, model in enumerate(page_models, page * per_page * columns + 1):
                 mess += self.gm_show_list_elem_info(model, it_m)
@@ -371,18 +541,67 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
                         res = self.show_elem(self.form.instance, _('The field has been updated!\n\n'))
         return res
 
+    def show_list_get_count(self):
+        queryset = self.get_queryset()
+        if self.show_list_count_cache_timeout is None and not self.use_approximate_count:
+            return queryset.count()
+
+        key = (
+            f'{self.__class__.__module__}.{self.__class__.__name__}:{self.prefix}:'
+            f'{self.construct_utrl()}:{self.user.pk if self.user else ""}'
+        )
+        return get_cached_count(
+            queryset,
+            key,
+            timeout=self.show_list_count_cache_timeout or 0,
+            cache_alias=self.show_list_count_cache_alias,
+            approximate=self.use_approximate_count,
+        )
+
     def show_list_get_queryset(self, page=0, per_page=10, columns=1, *args, **kwargs):
-        count_models = self.get_queryset().count()
+        count_models = self.show_list_get_count()
         first_this_page = page * per_page * columns
         first_next_page = (page + 1) * per_page * columns
-        page_models = list(self.get_queryset()[first_this_page: first_next_page])
+        page_models = list(self.apply_related_plan(self.get_queryset())[first_this_page: first_next_page])
         return count_models, page_models, first_this_page, first_next_page
 
+    def show_list_get_keyset_queryset(self, cursor='', per_page=10, columns=1, *args, **kwargs):
+        """
+        page of models after (or before) the key of cursor with LIMIT page_size + 1 (without count)
+        :param cursor: '<page>:<n -- next or p -- previous>:<key>', first page for other values
+        :return: page, page_models, has_prev_page, has_next_page
+        """
+        page_size = per_page * columns
+        cursor_parts = str(cursor).split(self.KEYSET_CURSOR_SEPARATOR, 2)
+        page, direction, key = cursor_parts if len(cursor_parts) == 3 else (0, None, None)
+        page = int(page)
+
+        field_name = self.keyset_pagination_field.lstrip('-')
+        is_descending = self.keyset_pagination_field.startswith('-')
+        queryset = self.apply_related_plan(self.get_queryset()).order_by(self.keyset_pagination_field)
+        if direction == 'n':
+            queryset = queryset.filter(**{f'{field_name}__{"lt" if is_descending else "gt"}': key})
+        elif direction == 'p':
+            queryset = queryset.filter(
+                **{f'{field_name}__{"gt" if is_descending else "lt"}': key}
+            ).order_by(field_name if is_descending else f'-{field_name}')
+
+        page_models = list(queryset[:page_size + 1])
+        has_more = len(page_models) > page_size
+        page_models = page_models[:page_size]
+
+        if direction == 'p':
+            page_models.reverse()
+            if not has_more:
+                page = 0
+            return page, page_models, has_more, True
+        return page, page_models, direction is not None, has_more
+
     def get_orm_model(self, model_or_pk):
         if issubclass(type(model_or_pk), models.Model):
             model = model_or_pk
         else:
-            model = self.get_queryset().filter(pk=model_or_pk).first()
+            model = self.apply_related_plan(self.get_queryset()).filter(pk=model_or_pk).first()
         return model
 
     # next functions are helpers for generate view of content (text and buttons for reply message)
@@ -472,6 +691,12 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
         elif type(value) != bool:
             value = ''
 
+        if isinstance(field, ModelChoiceField):
+            # value is already shown, choices are not requested from db for each model
+            if value == '' and field.empty_label is not None:
+                value = field.empty_label
+            return value
+
         is_choice_field = issubclass(type(field), ChoiceField)
         if is_choice_field or field_name in self.prechoice_fields_values:
             choices = field.choices if is_choice_field else self.prechoice_fields_values[field_name]
@@ -524,6 +749,29 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
                 )
         return buttons
 
+    def gm_show_list_create_keyset_pagination(self, page: int, page_models: list, has_prev_page: bool,
+                                              has_next_page: bool) -> []:
+        """ prev and next buttons with cursors of the first and the last model of the page """
+        field_name = self.keyset_pagination_field.lstrip('-')
+        buttons = []
+        if has_prev_page:
+            cursor = self.KEYSET_CURSOR_SEPARATOR.join([str(page - 1), 'p', str(getattr(page_models[0], field_name))])
+            buttons.append(inlinebutt(
+                text=f'◀️️️',
+                callback_data=self.generate_message_callback_data(
+                    self.command_routings['command_routing_show_list'], cursor,
+                )
+            ))
+        if has_next_page:
+            cursor = self.KEYSET_CURSOR_SEPARATOR.join([str(page + 1), 'n', str(getattr(page_models[-1], field_name))])
+            buttons.append(inlinebutt(
+                text=f'️▶️️',
+                callback_data=self.generate_message_callback_data(
+                    self.command_routings['command_routing_show_list'], cursor,
+                )
+            ))
+        return [buttons] if buttons else []
+
     def construct_utrl(self, *args, add_filters=True, **kwargs):
         f_args = list(args)
         if add_filters:
@@ -679,7 +927,7 @@ class TelegramViewSet(metaclass=TelegramViewSetMetaClass):
             )
 
         self.user.current_utrl = current_utrl
-        self.user.save()
+        self.user.save_state()
 
         # add return buttons
         buttons = []
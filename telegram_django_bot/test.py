@@ -10,6 +10,8 @@ from telegram_django_bot.routing import RouterCallbackMessageCommandHandler
 # from typing import Union
 
 from .tg_dj_bot import TG_DJ_Bot
+from .settings_backends import BackendFromSettings
+from .bme_index import bme_index
 # import asyncio
 
 
@@ -38,7 +40,11 @@ class TestCallbackContext:
 
 
 class DJ_TestCase(TestCase):
-    pass
+    def _pre_setup(self):
+        super()._pre_setup()
+        # in-process caches and trackers should not keep data between tests (db is rolled back)
+        BackendFromSettings.reset_all()
+        bme_index.invalidate()
 
 
 class TD_TestCase(DJ_TestCase):
@@ -1,3 +1,5 @@
+import contextlib
+import inspect
 import time
 import sys
 import logging
@@ -11,10 +13,13 @@ from telegram import (
     Message,
     error,
 )
+from asgiref.sync import sync_to_async
 from django.conf import settings  # LANGUAGES, USE_I18N
 from django.utils import translation
 
-from .models import BotMenuElem, MESSAGE_FORMAT
+from .models import MESSAGE_FORMAT
+from .bme_index import find_empty_block_bme
+from .file_registry import get_file_registry
 from .utils import add_log_action, ERROR_MESSAGE
 from .telegram_lib_redefinition import (
     InlineKeyboardMarkupDJ,
@@ -23,13 +28,59 @@ from .telegram_lib_redefinition import (
 )
 
 
+INPUT_MEDIA_CLASSES = {
+    MESSAGE_FORMAT.PHOTO: InputMediaPhoto,
+    MESSAGE_FORMAT.VIDEO: InputMediaVideo,
+    MESSAGE_FORMAT.AUDIO: InputMediaAudio,
+    MESSAGE_FORMAT.GIF: InputMediaAnimation,
+    MESSAGE_FORMAT.DOCUMENT: InputMediaDocument,
+}
+
+
+def run_bot_calls(steps):
+    """
+    execute bot calls, which are yielded by steps generator as (func, args, kwargs), the result of each call is sent
+    back to the generator
+    :return: result of the generator
+    """
+    result = None
+    try:
+        while True:
+            func, args, kwargs = steps.send(result)
+            result = func(*args, **kwargs)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def arun_bot_calls(steps):
+    """ run_bot_calls, but results of bot calls are awaited (for python-telegram-bot 20.x+) """
+    result = None
+    try:
+        while True:
+            func, args, kwargs = steps.send(result)
+            result = func(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+    except StopIteration as stop:
+        return stop.value
+
+
+def get_message_file_code(message: Message):
+    media_file = message.document or message.audio or message.video or message.animation or message.voice or \
+        message.video_note or message.sticker
+    if media_file is None and message.photo:
+        media_file = message.photo[-1]  # last -- biggest
+    return media_file.file_id if media_file else None
+
+
 class TG_DJ_Bot(BotDJ):
     """
     no_error_send
     bot_menu_elem
     """
 
-    def edit_or_send(bot, update, mess, buttons=None, only_send=False, decorate_buttons=True, **kwargs):
+    @staticmethod
+    def _get_reply_markup(buttons, decorate_buttons):
         if decorate_buttons and buttons:
             marked_buttons = InlineKeyboardMarkupDJ(buttons)
         else:
@@ -37,8 +88,10 @@ class TG_DJ_Bot(BotDJ):
 
         if not marked_buttons:
             marked_buttons = None
+        return marked_buttons
 
-        kwargs['reply_markup'] = marked_buttons
+    def edit_or_send(bot, update, mess, buttons=None, only_send=False, decorate_buttons=True, **kwargs):
+        kwargs['reply_markup'] = bot._get_reply_markup(buttons, decorate_buttons)
 
         res_mess, _ = bot.send_format_message(
             MESSAGE_FORMAT.TEXT,
@@ -49,9 +102,26 @@ class TG_DJ_Bot(BotDJ):
         )
         return res_mess
 
-    def send_botmenuelem(bot, update, user, menu_elem):
+    async def aedit_or_send(bot, update, mess, buttons=None, only_send=False, decorate_buttons=True, **kwargs):
+        """ async version of edit_or_send """
+        kwargs['reply_markup'] = bot._get_reply_markup(buttons, decorate_buttons)
+
+        res_mess, _ = await bot.asend_format_message(
+            MESSAGE_FORMAT.TEXT,
+            mess,
+            update=update,
+            only_send=only_send,
+            **kwargs,
+        )
+        return res_mess
+
+    def _prepare_botmenuelem(bot, update, user, menu_elem):
+        """
+        db part of send_botmenuelem
+        :return: menu_elem, send_kwargs for send_format_message (or for send_media_files if file_paths in them)
+        """
         if menu_elem is None:
-            menu_elem = BotMenuElem.objects.filter(empty_block=True, is_visable=True).first()
+            menu_elem = find_empty_block_bme()
 
         media_files_list = None
         extra_kwargs = {}
@@ -78,6 +148,8 @@ class TG_DJ_Bot(BotDJ):
             if settings.USE_I18N and user.language_code != settings.LANGUAGE_CODE:
                 language_code = user.language_code
 
+            menu_elem.prefetch_translations(language_code)  # 1 request for message and buttons
+
             message_format = menu_elem.message_format
             mess = menu_elem.get_message(language_code)
             buttons = menu_elem.get_buttons(language_code)
@@ -86,23 +158,50 @@ class TG_DJ_Bot(BotDJ):
                 extra_kwargs['reply_markup'] = InlineKeyboardMarkupDJ(buttons)
 
             if menu_elem.message_format != MESSAGE_FORMAT.TEXT:
-                media_file = menu_elem.telegram_file_code or open(menu_elem.media.path, 'rb')
-
-                media_files_list = [media_file]
-
-        response, media_codes = bot.send_format_message(
-            message_format,
-            mess,
-            media_files_list,
-            update,
-            user.id,
+                if menu_elem.telegram_file_code:
+                    media_files_list = [menu_elem.telegram_file_code]
+                else:
+                    # file is uploaded through file registry
+                    extra_kwargs['file_paths'] = [menu_elem.media.path]
 
+        return menu_elem, dict(
+            message_format=message_format,
+            text=mess,
+            media_files_list=media_files_list,
+            update=update,
+            chat_id=user.id,
             **extra_kwargs,
         )
 
+    @staticmethod
+    def _save_botmenuelem_file_code(menu_elem, media_codes):
         if menu_elem and menu_elem.telegram_file_code is None and menu_elem.media and len(media_codes) > 0:
             menu_elem.telegram_file_code = media_codes[0]
             menu_elem.save()
+
+    def send_botmenuelem(bot, update, user, menu_elem):
+        menu_elem, send_kwargs = bot._prepare_botmenuelem(update, user, menu_elem)
+
+        if 'file_paths' in send_kwargs:
+            send_kwargs.pop('media_files_list')
+            response, media_codes = bot.send_media_files(**send_kwargs)
+        else:
+            response, media_codes = bot.send_format_message(**send_kwargs)
+
+        bot._save_botmenuelem_file_code(menu_elem, media_codes)
+        return response
+
+    async def asend_botmenuelem(bot, update, user, menu_elem):
+        """ async version of send_botmenuelem (db requests are made in sync_to_async) """
+        menu_elem, send_kwargs = await sync_to_async(bot._prepare_botmenuelem)(update, user, menu_elem)
+
+        if 'file_paths' in send_kwargs:
+            send_kwargs.pop('media_files_list')
+            response, media_codes = await bot.asend_media_files(**send_kwargs)
+        else:
+            response, media_codes = await bot.asend_format_message(**send_kwargs)
+
+        await sync_to_async(bot._save_botmenuelem_file_code)(menu_elem, media_codes)
         return response
 
     def send_format_message(
@@ -128,17 +227,40 @@ class TG_DJ_Bot(BotDJ):
 
 
         telegram_message_kwargs - parse_mode, timeout, reply_markup, disable_web_page_preview, disable_notification and maybe other
-        :return:
+        :return: response, media_files_codes
         """
+        return run_bot_calls(bot._send_format_message_steps(
+            message_format, text, media_files_list, update, chat_id, only_send, **telegram_message_kwargs
+        ))
+
+    async def asend_format_message(
+            bot,
+            message_format: str = MESSAGE_FORMAT.TEXT,
+            text: str = None,
+            media_files_list: list = None,
+            update: Update = None,
+            chat_id: int = None,
+            only_send=False,
+
+            **telegram_message_kwargs
+    ):
+        """ async version of send_format_message """
+        return await arun_bot_calls(bot._send_format_message_steps(
+            message_format, text, media_files_list, update, chat_id, only_send, **telegram_message_kwargs
+        ))
 
-        input_media_dict = {
-            MESSAGE_FORMAT.PHOTO: InputMediaPhoto,
-            MESSAGE_FORMAT.VIDEO: InputMediaVideo,
-            MESSAGE_FORMAT.AUDIO: InputMediaAudio,
-            MESSAGE_FORMAT.GIF: InputMediaAnimation,
-            MESSAGE_FORMAT.DOCUMENT: InputMediaDocument,
-        }
+    def _send_format_message_steps(
+            bot,
+            message_format,
+            text,
+            media_files_list,
+            update,
+            chat_id,
+            only_send,
 
+            **telegram_message_kwargs
+    ):
+        """ send_format_message logic, bot calls are yielded for run_bot_calls or arun_bot_calls """
         # checks data
         if message_format == MESSAGE_FORMAT.TEXT:
             if text is None:
@@ -186,22 +308,20 @@ class TG_DJ_Bot(BotDJ):
                 is_editing_message = True
 
         if delete_message_id:
-            bot.delete_message(chat_id, delete_message_id)
+            yield bot.delete_message, (chat_id, delete_message_id), {}
 
         if is_editing_message:
             edit_message_id = update.callback_query.message.message_id
             telegram_message_kwargs.pop('disable_notification', None)
             if message_format == MESSAGE_FORMAT.TEXT:
-                response = bot.edit_message_text(
-                    text,
-                    chat_id,
+                response = yield bot.edit_message_text, (text, chat_id), dict(
                     message_id=edit_message_id,
                     **telegram_message_kwargs
                 )
             else:
                 telegram_message_kwargs.pop('disable_web_page_preview', None)
 
-                input_media = input_media_dict[message_format]
+                input_media = INPUT_MEDIA_CLASSES[message_format]
 
                 media_file = input_media(
                     media_files_list[0],
@@ -209,28 +329,21 @@ class TG_DJ_Bot(BotDJ):
                     parse_mode=telegram_message_kwargs.pop('parse_mode', None)  # fixme: why pop?
                 )
 
-                response = bot.edit_message_media(
-                    chat_id,
+                response = yield bot.edit_message_media, (chat_id,), dict(
                     message_id=edit_message_id,
                     media=media_file,
                     **telegram_message_kwargs
                 )
         else:
             if message_format == MESSAGE_FORMAT.TEXT:
-                response = bot.send_message(
-                    chat_id,
-                    text,
-                    **telegram_message_kwargs
-                )
+                response = yield bot.send_message, (chat_id, text), telegram_message_kwargs
             else:
                 telegram_message_kwargs.pop('disable_web_page_preview', None)
 
                 if message_format == MESSAGE_FORMAT.GROUP_MEDIA:
                     telegram_message_kwargs.pop('reply_markup', None)
-                    response = bot.send_media_group(
-                        chat_id,
+                    response = yield bot.send_media_group, (chat_id,), dict(
                         media=media_files_list,
-
                     )
                 else:
                     if message_format == MESSAGE_FORMAT.PHOTO:
@@ -253,25 +366,171 @@ class TG_DJ_Bot(BotDJ):
                     else:
                         telegram_func = bot.send_document
 
-                    response = telegram_func(
-                        chat_id,
-                        media_files_list[0],
+                    response = yield telegram_func, (chat_id, media_files_list[0]), dict(
                         caption=text,
                         **telegram_message_kwargs
                     )
 
         media_files_codes = []
-        if type(response) == Message:
-            media_file = response.document or response.audio or response.video or response.animation
-            if media_file is None and response.photo:
-                media_file = response.photo[-1] # last -- biggest
-            if media_file:
-                media_files_codes.append(media_file.file_id)
+        messages = response if type(response) in (list, tuple) else [response]
+        for message in messages:
+            if type(message) == Message and (file_code := get_message_file_code(message)):
+                media_files_codes.append(file_code)
+
+        return response, media_files_codes
+
+    def send_media_files(
+            bot,
+            message_format: str,
+            text: str = None,
+            file_paths: list = None,
+            update: Update = None,
+            chat_id: int = None,
+            only_send=False,
+
+            **telegram_message_kwargs
+    ):
+        """
+        send_format_message for files from disk with file registry: files which were uploaded before are sent by
+        telegram file_id, new files are uploaded under single-flight lock (other workers wait and reuse file_id).
+
+        :param file_paths: list of paths; for MESSAGE_FORMAT.GROUP_MEDIA -- list of (message_format, path), where
+            message_format is one of PHOTO, VIDEO, AUDIO, GIF, DOCUMENT (text is the caption of the first media)
+        :return: response, media_files_codes
+        """
+        file_registry = get_file_registry()
+        formats_and_paths, keys = bot._get_media_files_keys(message_format, file_paths)
+
+        def send(file_codes):
+            media_files_list, opened_files = bot._open_media_files(
+                message_format, text, formats_and_paths, keys, file_codes, telegram_message_kwargs
+            )
+            try:
+                return bot.send_format_message(
+                    message_format,
+                    text,
+                    media_files_list,
+                    update,
+                    chat_id,
+                    only_send,
+                    **telegram_message_kwargs
+                )
+            finally:
+                for opened_file in opened_files:
+                    opened_file.close()
 
-            # todo: add support for group media
+        if file_registry is None:
+            return send({})
 
+        file_codes = file_registry.get_many(keys)
+        missed_keys = sorted(set(keys) - set(file_codes))
+        if not missed_keys:
+            return send(file_codes)
+
+        with contextlib.ExitStack() as stack:
+            for key in missed_keys:  # sorted for the same order of locks in all workers
+                stack.enter_context(file_registry.single_flight(key))
+
+            file_codes = file_registry.get_many(keys)  # could be uploaded while waiting for lock
+            response, media_files_codes = send(file_codes)
+            bot._save_media_files_codes(keys, file_codes, media_files_codes)
+        return response, media_files_codes
+
+    async def asend_media_files(
+            bot,
+            message_format: str,
+            text: str = None,
+            file_paths: list = None,
+            update: Update = None,
+            chat_id: int = None,
+            only_send=False,
+
+            **telegram_message_kwargs
+    ):
+        """ async version of send_media_files (single-flight lock is made with asyncio lock in the process) """
+        file_registry = get_file_registry()
+        formats_and_paths, keys = await sync_to_async(bot._get_media_files_keys)(message_format, file_paths)
+
+        async def send(file_codes):
+            media_files_list, opened_files = bot._open_media_files(
+                message_format, text, formats_and_paths, keys, file_codes, telegram_message_kwargs
+            )
+            try:
+                return await bot.asend_format_message(
+                    message_format,
+                    text,
+                    media_files_list,
+                    update,
+                    chat_id,
+                    only_send,
+                    **telegram_message_kwargs
+                )
+            finally:
+                for opened_file in opened_files:
+                    opened_file.close()
+
+        if file_registry is None:
+            return await send({})
+
+        file_codes = await sync_to_async(file_registry.get_many)(keys)
+        missed_keys = sorted(set(keys) - set(file_codes))
+        if not missed_keys:
+            return await send(file_codes)
+
+        async with contextlib.AsyncExitStack() as stack:
+            for key in missed_keys:  # sorted for the same order of locks in all workers
+                await stack.enter_async_context(file_registry.asingle_flight(key))
+
+            file_codes = await sync_to_async(file_registry.get_many)(keys)  # could be uploaded while waiting for lock
+            response, media_files_codes = await send(file_codes)
+            await sync_to_async(bot._save_media_files_codes)(keys, file_codes, media_files_codes)
         return response, media_files_codes
 
+    @staticmethod
+    def _get_media_files_keys(message_format, file_paths):
+        """ :return: [(message_format, path)], [file registry key (content_hash, message_format) or None] """
+        if message_format == MESSAGE_FORMAT.GROUP_MEDIA:
+            formats_and_paths = list(file_paths)
+        else:
+            formats_and_paths = [(message_format, path) for path in file_paths]
+
+        file_registry = get_file_registry()
+        if file_registry is None:
+            keys = [None] * len(formats_and_paths)
+        else:
+            keys = [
+                (file_registry.get_content_hash(path), item_format) for item_format, path in formats_and_paths
+            ]
+        return formats_and_paths, keys
+
+    @staticmethod
+    def _open_media_files(message_format, text, formats_and_paths, keys, file_codes, telegram_message_kwargs):
+        """ :return: media_files_list for send_format_message, opened files (should be closed after sending) """
+        opened_files = []
+        media_files_list = []
+        for key, (item_format, path) in zip(keys, formats_and_paths):
+            media_file = file_codes.get(key)
+            if media_file is None:
+                media_file = open(path, 'rb')
+                opened_files.append(media_file)
+
+            if message_format == MESSAGE_FORMAT.GROUP_MEDIA:
+                media_file = INPUT_MEDIA_CLASSES[item_format](
+                    media_file,
+                    caption=None if media_files_list else text,
+                    parse_mode=telegram_message_kwargs.get('parse_mode', 'HTML'),
+                )
+            media_files_list.append(media_file)
+        return media_files_list, opened_files
+
+    @staticmethod
+    def _save_media_files_codes(keys, file_codes, media_files_codes):
+        if len(media_files_codes) == len(keys):
+            get_file_registry().set_many({
+                key: file_code
+                for key, file_code in zip(keys, media_files_codes) if key not in file_codes
+            })
+
     def task_send_message_handler(bot, user, func, func_args, func_kwargs):
         is_sent = False
         res_mess = None
@@ -0,0 +1,197 @@
+import functools
+import json
+import operator
+from dataclasses import dataclass
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Exists, OuterRef, Q, Sum
+from django.db.models.functions import Coalesce
+
+from .action_log_rollup import get_day_start
+from .models import ActionLog, ActionLogDailyCount, Trigger
+
+
+CONDITION_KEYS = ('seeds', 'amount', 'sequence', 'exclude')
+AMOUNT_LOOKUPS = ('gte', 'lte', 'gt', 'lt', 'exact')
+
+
+@dataclass(frozen=True)
+class ActionFilter:
+    """ ActionLog of types (type lookups) in the last duration """
+    type_filters: tuple  # ((lookup, value), ...)
+    duration: object  # timedelta
+
+    def get_type_kwargs(self, prefix=''):
+        return {
+            f'{prefix}{lookup}': list(value) if isinstance(value, tuple) else value
+            for lookup, value in self.type_filters
+        }
+
+    def get_kwargs(self, dttm_now, prefix=''):
+        return {f'{prefix}dttm__gte': dttm_now - self.duration, **self.get_type_kwargs(prefix)}
+
+    def get_q(self, dttm_now):
+        return Q(**self.get_kwargs(dttm_now))
+
+    def get_amount(self, dttm_now, rollup_days=None):
+        """
+        amount of actions of OuterRef('id') user. If rollup_days (RollupDays) covers the window, full days are
+        summed from ActionLogDailyCount and only the start day of the window and not rolled up days from ActionLog
+        """
+        dttm_start = dttm_now - self.duration
+        full_days = rollup_days.get_full_days(dttm_start) if rollup_days else None
+        logs = ActionLog.objects.filter(user_id=OuterRef('id'), **self.get_type_kwargs())
+
+        if full_days is None:
+            logs = logs.filter(dttm__gte=dttm_start)
+        else:
+            first_day, last_day = full_days
+            logs = logs.filter(
+                Q(dttm__gte=dttm_start, dttm__lt=get_day_start(first_day)) | Q(dttm__gte=get_day_start(last_day))
+            )
+
+        amount = Coalesce(logs.values('user_id').annotate(amount=Count('user_id')).values('amount'), 0)
+        if full_days is None:
+            return amount
+
+        day_counts = ActionLogDailyCount.objects.filter(
+            user_id=OuterRef('id'),
+            day__gte=first_day,
+            day__lt=last_day,
+            **self.get_type_kwargs(),
+        ).values('user_id').annotate(amount=Sum('amount')).values('amount')
+        return amount + Coalesce(day_counts, 0)
+
+
+@dataclass(frozen=True)
+class AmountCondition:
+    """ amount of ActionLog of action_filter compared by lookup (gte, lte, ...) with value """
+    lookup: str
+    value: int
+    action_filter: ActionFilter
+
+
+@dataclass(frozen=True)
+class CompiledCondition:
+    """
+    Trigger condition without parsing: users are filtered by seeds, amounts of actions, sequence (for each
+    group of actions user has at least 1 of them) and exclude (user has not any of actions).
+    """
+    seeds: tuple = ()
+    amounts: tuple = ()  # (AmountCondition, ...)
+    sequence: tuple = ()  # ((ActionFilter, ...), ...)
+    exclude: tuple = ()  # (ActionFilter, ...)
+
+    def get_annotations(self, dttm_now, prefix='', rollup_days=None):
+        """ amounts of actions for OuterRef('id') user, which are compared in get_q """
+        return {
+            f'{prefix}amount{it}': amount.action_filter.get_amount(dttm_now, rollup_days)
+            for it, amount in enumerate(self.amounts)
+        }
+
+    def get_q(self, dttm_now, prefix=''):
+        """ condition of users queryset annotated with get_annotations (with the same prefix) """
+        # Q of children, not combining by &: empty Q() & Q(Exists(...)) fails in django 3.2
+        children = []
+        if self.seeds:
+            children.append(Q(seed_code__in=self.seeds))
+
+        for it, amount in enumerate(self.amounts):
+            children.append(Q(**{f'{prefix}amount{it}__{amount.lookup}': amount.value}))
+
+        for action_filters in self.sequence:
+            children.append(Exists(ActionLog.objects.filter(
+                functools.reduce(operator.or_, [action_filter.get_q(dttm_now) for action_filter in action_filters]),
+                user_id=OuterRef('id'),
+            )))
+
+        if self.exclude:
+            children.append(~Exists(ActionLog.objects.filter(
+                functools.reduce(operator.or_, [action_filter.get_q(dttm_now) for action_filter in self.exclude]),
+                user_id=OuterRef('id'),
+            )))
+        return Q(*children)
+
+
+def is_type_lookup(key):
+    """ key is type or type__<lookup> of ActionLog.type field lookups (type__iexact, type__regex, ...) """
+    if key == 'type':
+        return True
+    field_name, _, lookup = key.partition('__')
+    return field_name == 'type' and lookup in ActionLog._meta.get_field('type').get_lookups()
+
+
+def _compile_action_filter(elem, path, allowed_keys=()):
+    if not isinstance(elem, dict):
+        raise ValidationError(f'{path} should be an object')
+
+    if 'duration' not in elem:
+        raise ValidationError(f'{path}.duration is required')
+    try:
+        duration = Trigger.get_timedelta(elem['duration'])
+    except (ValueError, AttributeError):
+        raise ValidationError(f'{path}.duration has unknown format {elem["duration"]}, use for example "7d 12h"')
+
+    type_filters = []
+    for key, value in elem.items():
+        if is_type_lookup(key):
+            if key == 'type__in':
+                if not isinstance(value, list) or not all(isinstance(x, str) for x in value):
+                    raise ValidationError(f'{path}.{key} should be a list of strings')
+                value = tuple(value)
+            elif not isinstance(value, str):
+                raise ValidationError(f'{path}.{key} should be a string')
+            type_filters.append((key, value))
+        elif key != 'duration' and key not in allowed_keys:
+            raise ValidationError(f'{path} has unknown key {key}')
+    return ActionFilter(tuple(type_filters), duration)
+
+
+def _compile_list(condition, key):
+    value = condition.get(key, [])
+    if not isinstance(value, list):
+        raise ValidationError(f'{key} should be a list')
+    return value
+
+
+@functools.lru_cache(maxsize=256)
+def compile_condition(condition_db: str) -> CompiledCondition:
+    """
+    Validates and compiles Trigger.condition_db (cached by text, so each trigger version is compiled once)
+    :raise ValidationError: if condition is not valid
+    """
+    try:
+        condition = json.loads(condition_db)
+    except ValueError as error:
+        raise ValidationError(f'condition is not valid json: {error}')
+    if not isinstance(condition, dict):
+        raise ValidationError('condition should be an object')
+
+    if unknown_keys := set(condition) - set(CONDITION_KEYS):
+        raise ValidationError(f'unknown condition keys: {", ".join(sorted(unknown_keys))}')
+
+    seeds = _compile_list(condition, 'seeds')
+    if not all(isinstance(seed, int) for seed in seeds):
+        raise ValidationError('seeds should be a list of integers')
+
+    amounts = []
+    for it, elem in enumerate(_compile_list(condition, 'amount')):
+        path = f'amount[{it}]'
+        action_filter = _compile_action_filter(elem, path, AMOUNT_LOOKUPS)
+        lookups = [key for key in elem if key in AMOUNT_LOOKUPS]
+        if len(lookups) != 1 or not isinstance(elem[lookups[0]], int):
+            raise ValidationError(f'{path} should have 1 integer comparison: {", ".join(AMOUNT_LOOKUPS)}')
+        amounts.append(AmountCondition(lookups[0], elem[lookups[0]], action_filter))
+
+    sequence = []
+    for it, elems in enumerate(_compile_list(condition, 'sequence')):
+        if not isinstance(elems, list) or not elems:
+            raise ValidationError(f'sequence[{it}] should be a not empty list')
+        sequence.append(tuple(
+            _compile_action_filter(elem, f'sequence[{it}][{it_e}]') for it_e, elem in enumerate(elems)
+        ))
+
+    exclude = tuple(
+        _compile_action_filter(elem, f'exclude[{it}]') for it, elem in enumerate(_compile_list(condition, 'exclude'))
+    )
+    return CompiledCondition(tuple(seeds), tuple(amounts), tuple(sequence), exclude)
@@ -0,0 +1,157 @@
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .settings_backends import BackendFromSettings
+
+
+class BaseUserCache:
+    """
+    Cache of user models for handler_decor (so user is not selected from db for each update).
+    Users are stored after handling update and removed on user model saving/deleting. The time of removing is
+    remembered, so copies of users loaded before it (for example, by a concurrent update of the user) are not stored
+    and the changed state is not overwritten by the old one.
+
+    hits, misses -- counters of get requests
+    """
+
+    def __init__(self, timeout=300, **kwargs):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._counters_lock = threading.Lock()
+
+    def get(self, user_id):
+        user = self._get(user_id)
+        with self._counters_lock:
+            if user is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return user
+
+    @staticmethod
+    def is_outdated(user, deleted_at):
+        """ user was loaded from db before it was changed (TelegramUser remembers _loaded_at) """
+        loaded_at = user.__dict__.get('_loaded_at')
+        return deleted_at is not None and (loaded_at is None or loaded_at < deleted_at)
+
+    def set(self, user):
+        raise NotImplementedError()
+
+    def delete(self, user_id):
+        raise NotImplementedError()
+
+    def _get(self, user_id):
+        raise NotImplementedError()
+
+    def get_stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class LocMemUserCache(BaseUserCache):
+    """ in-process LRU cache with TTL (each bot process has its own cache) """
+
+    def __init__(self, timeout=300, max_size=10000, **kwargs):
+        super().__init__(timeout, **kwargs)
+        self.max_size = max_size
+        self._users = OrderedDict()  # user_id: (expire time, user)
+        self._deleted_at = OrderedDict()  # user_id: time of deleting
+        self._lock = threading.Lock()
+
+    def _get(self, user_id):
+        with self._lock:
+            expire_and_user = self._users.get(user_id)
+            if expire_and_user is None:
+                return None
+
+            if expire_and_user[0] < time.monotonic():
+                del self._users[user_id]
+                return None
+
+            self._users.move_to_end(user_id)
+            return copy.copy(expire_and_user[1])
+
+    def set(self, user):
+        with self._lock:
+            if self.is_outdated(user, self._deleted_at.get(user.pk)):
+                return
+
+            self._users[user.pk] = (time.monotonic() + self.timeout, copy.copy(user))
+            self._users.move_to_end(user.pk)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def delete(self, user_id):
+        now = time.time()
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._deleted_at.pop(user_id, None)
+            self._deleted_at[user_id] = now
+            # copies loaded more than timeout ago are not expected in handling
+            while self._deleted_at and next(iter(self._deleted_at.values())) < now - self.timeout:
+                self._deleted_at.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._deleted_at.clear()
+
+
+class DjangoCacheUserCache(BaseUserCache):
+    """ cache through django cache framework, so several bot processes share it """
+
+    def __init__(self, timeout=300, cache_alias='default', key_prefix='telegram_django_bot_user', **kwargs):
+        super().__init__(timeout, **kwargs)
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_key(self, user_id):
+        return f'{self.key_prefix}:{user_id}'
+
+    def get_deleted_at_key(self, user_id):
+        return f'{self.key_prefix}:deleted:{user_id}'
+
+    def _get(self, user_id):
+        return self.cache.get(self.get_key(user_id))
+
+    def set(self, user):
+        if not self.is_outdated(user, self.cache.get(self.get_deleted_at_key(user.pk))):
+            self.cache.set(self.get_key(user.pk), user, self.timeout)
+
+    def delete(self, user_id):
+        self.cache.set(self.get_deleted_at_key(user_id), time.time(), self.timeout)
+        self.cache.delete(self.get_key(user_id))
+
+
+_user_cache = BackendFromSettings('TELEGRAM_USER_CACHE')
+
+
+def get_user_cache():
+    """
+    User cache from settings TELEGRAM_USER_CACHE, for example:
+        TELEGRAM_USER_CACHE = {
+            'BACKEND': 'telegram_django_bot.user_cache.DjangoCacheUserCache',
+            'OPTIONS': {'timeout': 300},
+        }
+    :return: None if cache is not set
+    """
+    return _user_cache.get()
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def delete_user_from_cache(sender, instance, **kwargs):
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        user_cache.delete(instance.pk)
@@ -1,11 +1,16 @@
+import inspect
 import sys
 
 from functools import wraps
 import telegram
+from asgiref.sync import sync_to_async
 
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from .models import ActionLog, TeleDeepLink
+from .user_cache import get_user_cache
+from .daily_activity import get_daily_active_tracker
+from .action_log_writer import get_action_log_writer
 from .telegram_lib_redefinition import (
     InlineKeyboardButtonDJ as inlinebutt
 )
@@ -22,7 +27,117 @@ LOGGING_TELEGRAM_ACTIONS = getattr(settings, 'TELEGRAM_ACTION_LOG', True)
 
 def add_log_action(user_id, action):
     if LOGGING_TELEGRAM_ACTIONS:
-        ActionLog.objects.create(type=action, user_id=user_id)
+        get_action_log_writer().add(user_id, action)
+
+
+def get_handler_user(update, update_user_info=True, user=None):
+    """
+    user model of the update sender: created if it is new, info (username, names) is updated if it is changed.
+    It is the first (db) part of handler_decor.
+
+    :param user: user model of the update sender, which is already selected (context.resolved_user of
+        RouterCallbackMessageCommandHandler), so it is not requested again
+    """
+
+    def check_first_income():
+        if update and update.message and update.message.text:
+            query_words = update.message.text.split()
+            if len(query_words) > 1 and query_words[0] == '/start':
+                telelink, _ = TeleDeepLink.objects.get_or_create(link=query_words[1])
+                telelink.users.add(user)
+
+    user_details = update.effective_user
+    # if update.callback_query:
+    #     user_details = update.callback_query.from_user
+    # elif update.inline_query:
+    #     user_details = update.inline_query.from_user
+    # else:
+    #     user_details = update.message.from_user
+
+    if user_details is None:
+        raise ValueError(
+            f'handler_decor is made for communication with user, current update has not any user: {update}'
+        )
+
+    User = get_user_model()
+
+    user_adding_info = {
+        'username': '{}'.format(user_details.id),
+        'telegram_language_code': user_details.language_code or 'en',
+
+        'telegram_username': user_details.username[:64] if user_details.username else '',
+        'first_name': user_details.first_name[:30] if user_details.first_name else '',
+        'last_name': user_details.last_name[:60] if user_details.last_name else '',
+    }
+
+    if user is not None and user.id != user_details.id:
+        user = None
+
+    user_cache = get_user_cache()
+    if user is None and user_cache:
+        user = user_cache.get(user_details.id)
+    created = False
+    if user is None:
+        user, created = User.objects.get_or_create(
+            id=user_details.id,
+            defaults=user_adding_info
+        )
+
+    # changed fields are saved together with 1 query
+    update_fields = []
+    if created:
+        add_log_action(user.id, 'ACTION_CREATED')
+        check_first_income()
+    elif update_user_info:
+        # check if telegram_username or first_name or last_name changed:
+        for key in ['telegram_username', 'first_name', 'last_name']:
+            if getattr(user, key) != user_adding_info[key]:
+                setattr(user, key, user_adding_info[key])
+                update_fields.append(key)
+
+    if not user.is_active:
+        check_first_income()
+        user.is_active = True
+        update_fields.append('is_active')
+
+    if update_fields:
+        user.save(update_fields=update_fields)
+    return user
+
+
+def finish_handling(update, user, func, log_type, is_error):
+    """
+    saving of changed user state, logs of the handled update and user caching. It is the last (db) part of
+    handler_decor
+    """
+    user.save_deferred_state()
+
+    if log_type != 'N':
+        if log_type == 'C':
+            if update.callback_query:
+                log_value = update.callback_query.data
+            else:
+                log_value = update.message.text
+        elif log_type == 'U':
+            log_value = user.current_utrl
+        # elif log_type == 'F':
+        else:
+            log_value = func.__name__
+
+        add_log_action(user.id, log_value[:32])
+
+    today = timezone.now().date()
+    daily_active_tracker = get_daily_active_tracker()
+    if daily_active_tracker is None or daily_active_tracker.is_first_visit(user.id, today):
+        if not ActionLog.objects.filter(user=user, type='ACTION_ACTIVE_TODAY', dttm__date=today).exists():
+            add_log_action(user.id, 'ACTION_ACTIVE_TODAY')
+
+    user_cache = get_user_cache()
+    if user_cache:
+        if is_error:
+            user_cache.delete(user.id)
+        else:
+            user_cache.set(user)
 
 
 def handler_decor(log_type='F', update_user_info=True):
@@ -36,67 +151,14 @@ def handler_decor(log_type='F', update_user_info=True):
     def decor(func):
         @wraps(func)
         def wrapper(update, CallbackContext):
-            def check_first_income():
-                if update and update.message and update.message.text:
-                    query_words = update.message.text.split()
-                    if len(query_words) > 1 and query_words[0] == '/start':
-                        telelink, _ = TeleDeepLink.objects.get_or_create(link=query_words[1])
-                        telelink.users.add(user)
-
             bot = CallbackContext.bot
-
-            user_details = update.effective_user
-            # if update.callback_query:
-            #     user_details = update.callback_query.from_user
-            # elif update.inline_query:
-            #     user_details = update.inline_query.from_user
-            # else:
-            #     user_details = update.message.from_user
-
-            if user_details is None:
-                raise ValueError(
-                    f'handler_decor is made for communication with user, current update has not any user: {update}'
-                )
-
-            User = get_user_model()
-
-            user_adding_info = {
-                'username': '{}'.format(user_details.id),
-                'telegram_language_code': user_details.language_code or 'en',
-
-                'telegram_username': user_details.username[:64] if user_details.username else '',
-                'first_name': user_details.first_name[:30] if user_details.first_name else '',
-                'last_name': user_details.last_name[:60] if user_details.last_name else '',
-            }
-
-            user, created = User.objects.get_or_create(
-                id=user_details.id,
-                defaults=user_adding_info
-            )
-
-            if created:
-                add_log_action(user.id, 'ACTION_CREATED')
-                check_first_income()
-            elif update_user_info:
-                # check if telegram_username or first_name or last_name changed:
-                fields_changed = False
-                for key in ['telegram_username', 'first_name', 'last_name']:
-                    if getattr(user, key) != user_adding_info[key]:
-                        setattr(user, key, user_adding_info[key])
-                        fields_changed = True
-
-                if fields_changed:
-                    user.save()
-
-            if not user.is_active:
-                check_first_income()
-                user.is_active = True
-                user.save()
+            user = get_handler_user(update, update_user_info, getattr(CallbackContext, 'resolved_user', None))
 
             if settings.USE_I18N:
                 translation.activate(user.language_code)
 
             raise_error = None
+            user.defer_state_saving()  # state changes are saved once in finish_handling
             try:
                 res = func(bot, update, user)
             except telegram.error.BadRequest as error:
@@ -112,24 +174,58 @@ def handler_decor(log_type='F', update_user_info=True):
                 tb = sys.exc_info()[2]
                 raise_error = error.with_traceback(tb)
 
-            # log actions
+            finish_handling(update, user, func, log_type, raise_error is not None)
 
-            if log_type != 'N':
-                if log_type == 'C':
-                    if update.callback_query:
-                        log_value = update.callback_query.data
-                    else:
-                        log_value = update.message.text
-                elif log_type == 'U':
-                    log_value = user.current_utrl
-                # elif log_type == 'F':
-                else:
-                    log_value = func.__name__
+            if raise_error:
+                raise raise_error
 
-                add_log_action(user.id, log_value[:32])
+            return res
+        return wrapper
+    return decor
+
+
+async def maybe_await(result):
+    """ await result of bot call if it is awaitable (python-telegram-bot 20.x+) """
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+def async_handler_decor(log_type='F', update_user_info=True):
+    """
+    handler_decor for async handlers (python-telegram-bot 20.x+): async func(bot, update, user) is awaited,
+    db requests of the decorator are made in sync_to_async, so the event loop is not blocked.
+    """
+
+    def decor(func):
+        @wraps(func)
+        async def wrapper(update, CallbackContext):
+            bot = CallbackContext.bot
+            get_action_log_writer().start()  # flushing task is started in the event loop
+            user = await sync_to_async(get_handler_user)(
+                update, update_user_info, getattr(CallbackContext, 'resolved_user', None)
+            )
+
+            if settings.USE_I18N:
+                translation.activate(user.language_code)
+
+            raise_error = None
+            user.defer_state_saving()
+            try:
+                res = await func(bot, update, user)
+            except telegram.error.BadRequest as error:
+                if 'Message is not modified:' in error.message:
+                    res = None
+                else:
+                    res = await maybe_await(bot.send_message(user.id, str(ERROR_MESSAGE)))
+                    tb = sys.exc_info()[2]
+                    raise_error = error.with_traceback(tb)
+            except Exception as error:
+                res = await maybe_await(bot.send_message(user.id, str(ERROR_MESSAGE)))
+                tb = sys.exc_info()[2]
+                raise_error = error.with_traceback(tb)
 
-            if ActionLog.objects.filter(user=user, type='ACTION_ACTIVE_TODAY', dttm__date=timezone.now().date()).count() == 0:
-                add_log_action(user.id, 'ACTION_ACTIVE_TODAY')
+            await sync_to_async(finish_handling)(update, user, func, log_type, raise_error is not None)
 
             if raise_error:
                 raise raise_error
@@ -6,17 +6,25 @@ from telegram.ext import ApplicationBuilder
 
 import os, django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app_settings')
-os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
 django.setup()
 from django.conf import settings
 
 
-from telegram_django_bot.routing import RouterCallbackMessageCommandHandler
+from telegram_django_bot.routing import AsyncRouterCallbackMessageCommandHandler
 from telegram_django_bot.tg_dj_bot import TG_DJ_Bot
+from telegram_django_bot.action_log_writer import get_action_log_writer
+
+
+async def post_init(application):
+    get_action_log_writer().start()
+
+
+async def post_shutdown(application):
+    await get_action_log_writer().aclose()
 
 
 if __name__ == '__main__':
     bot = TG_DJ_Bot(settings.TELEGRAM_TOKEN)
-    application = ApplicationBuilder().bot(bot).build()
-    application.add_handler(RouterCallbackMessageCommandHandler())
+    application = ApplicationBuilder().bot(bot).post_init(post_init).post_shutdown(post_shutdown).build()
+    application.add_handler(AsyncRouterCallbackMessageCommandHandler())
     application.run_polling()
\ No newline at end of file
@@ -0,0 +1,55 @@
+# compares telegram_resolve (django resolver) with CompiledUtrlRouter on a few hundred routes
+# run: python benchmark_routing.py
+import timeit
+import types
+
+import os, django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app_settings')
+django.setup()
+
+from django.urls import re_path
+
+from telegram_django_bot.routing import telegram_resolve, CompiledUtrlRouter
+from test_app.views import CategoryViewSet
+from test_app.handlers import me
+
+
+ROUTES_AMOUNT = 300
+RESOLVE_NUMBER = 2000
+
+
+def create_utrl_conf(routes_amount):
+    utrl_conf = types.ModuleType('benchmark_utrls')
+    utrl_conf.urlpatterns = []
+    for it in range(routes_amount):
+        if it % 2:
+            utrl_conf.urlpatterns.append(re_path(f'^vs{it}/', CategoryViewSet, name=f'vs{it}'))
+        else:
+            utrl_conf.urlpatterns.append(re_path(f'^command{it}$', me, name=f'command{it}'))
+    return utrl_conf
+
+
+def main():
+    utrl_conf = create_utrl_conf(ROUTES_AMOUNT)
+    router = CompiledUtrlRouter(utrl_conf)
+
+    paths = [
+        'vs1/se&1',
+        f'vs{ROUTES_AMOUNT // 2 + 1}/up&12&name',
+        f'vs{ROUTES_AMOUNT - 1}/sl&3',
+        f'command{ROUTES_AMOUNT - 2}',
+        'not_existed/path',
+    ]
+
+    for path in paths:
+        django_time = timeit.timeit(lambda: telegram_resolve(path, utrl_conf), number=RESOLVE_NUMBER)
+        compiled_time = timeit.timeit(lambda: router.resolve(path), number=RESOLVE_NUMBER)
+        print(
+            f'{path:<20} django resolve: {django_time / RESOLVE_NUMBER * 1e6:8.1f} us, '
+            f'compiled router: {compiled_time / RESOLVE_NUMBER * 1e6:8.1f} us, '
+            f'x{django_time / compiled_time:.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# compares old state json (DjangoJSONEncoder + TelegramDjangoJsonDecoder) with tagged state format
+# run: python benchmark_state_serializer.py
+import datetime
+import decimal
+import json
+import timeit
+
+import os, django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app_settings')
+django.setup()
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from telegram_django_bot.state_serializer import TelegramDjangoJsonDecoder, dumps_state, loads_state
+
+
+NUMBER = 5000
+
+
+def create_form_state(fields_amount):
+    form_data = {}
+    for it in range(fields_amount):
+        form_data[f'name{it}'] = f'some text value {it}'
+        form_data[f'date{it}'] = datetime.date(2020, 1, it % 28 + 1)
+        form_data[f'price{it}'] = decimal.Decimal(f'{it}.50')
+        form_data[f'pks{it}'] = [str(pk) for pk in range(it)]
+    return {'form_name': 'BenchmarkForm', 'form_data': form_data}
+
+
+def main():
+    for fields_amount in [1, 10, 50]:
+        state = create_form_state(fields_amount)
+        old_text = json.dumps(state, cls=DjangoJSONEncoder)
+        tagged_text = dumps_state(state)
+
+        old_time = timeit.timeit(lambda: json.loads(old_text, cls=TelegramDjangoJsonDecoder), number=NUMBER)
+        tagged_time = timeit.timeit(lambda: loads_state(tagged_text), number=NUMBER)
+        print(
+            f'{fields_amount * 4:>4} values  old decoding: {old_time / NUMBER * 1e6:8.1f} us, '
+            f'tagged decoding: {tagged_time / NUMBER * 1e6:8.1f} us, x{old_time / tagged_time:.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,24 @@
+import io
+import json
+
 import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from telegram_django_bot.test import TD_TestCase
 from telegram_django_bot.models import BotMenuElem, BotMenuElemAttrText
 from telegram_django_bot.routing import all_command_bme_handler, all_callback_bme_handler
+from telegram_django_bot.bme_index import (
+    find_command_bme, find_callback_bme, find_empty_block_bme, get_bme_snapshot, BotMenuElemSnapshot,
+    BotMenuElemIndex,
+)
 from test_app.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
+import time
 import unittest
+from unittest import mock
 
 
 class BMEInitData:
@@ -106,6 +118,176 @@ class TestBMEModels(TD_TestCase, BMEInitData):
         should_be = InlineKeyboardMarkup([[InlineKeyboardButton('start', callback_data='start')]])
         self.assertEqual(should_be.to_dict(), InlineKeyboardMarkup(self.bme_start.get_buttons('de')).to_dict())
 
+    def test_translation_queries(self):
+        bme = BotMenuElem.objects.create(
+            message='Keyboard',
+            buttons_db='[' + ','.join(
+                '[' + ','.join(f'{{"text": "b{row}{col}", "callback_data": "b"}}' for col in range(4)) + ']'
+                for row in range(3)
+            ) + ']'
+        )
+        BotMenuElemAttrText.objects.filter(bot_menu_elem=bme, language_code='ru', default_text='b00').update(
+            translated_text='к00'
+        )
+
+        with self.assertNumQueries(1):
+            buttons = bme.get_buttons('ru')
+        self.assertEqual('к00', buttons[0][0].text)
+        self.assertEqual('b01', buttons[0][1].text)
+
+        with self.assertNumQueries(1):
+            bme.prefetch_translations('ru', 'de')
+        with self.assertNumQueries(0):
+            self.assertEqual('Keyboard', bme.get_message('ru'))
+            self.assertEqual('к00', bme.get_buttons('ru')[0][0].text)
+            self.assertEqual('b00', bme.get_buttons('de')[0][0].text)
+            bme.prefetch_translations('ru')
+
+
+    def test_sync_translations(self):
+        BotMenuElemAttrText.objects.all().delete()
+
+        with self.assertNumQueries(3):  # elements + existed translations + insert
+            self.assertEqual(10, BotMenuElem.sync_translations())
+        self.assertEqual(10, BotMenuElemAttrText.objects.count())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(0, BotMenuElem.sync_translations([self.bme_start, self.bme_2]))
+
+        self.bme_2.buttons_db = '[[{"text": "button 1", "callback_data": "button1"}, {"text": "new", "url": "a.b"}]]'
+        self.bme_2._buttons = json.loads(self.bme_2.buttons_db)
+        with self.assertNumQueries(3):  # save + read + insert
+            self.bme_2.save()
+        self.assertEqual(8, BotMenuElemAttrText.objects.filter(bot_menu_elem=self.bme_2).count())
+
+    def test_sync_translations_command(self):
+        BotMenuElemAttrText.objects.filter(bot_menu_elem=self.bme_2).delete()
+        out = io.StringIO()
+        call_command('sync_bme_translations', stdout=out)
+        self.assertIn('6 translations are created', out.getvalue())
+        self.assertEqual(10, BotMenuElemAttrText.objects.count())
+
+
+class TestBMEIndex(TD_TestCase, BMEInitData):
+    def setUp(self) -> None:
+        self.setup_data()
+
+    def test_exact_matching(self):
+        self.assertEqual(self.bme_start, find_command_bme('start'))
+        self.assertEqual(self.bme_2, find_callback_bme('second'))
+
+        self.assertIsNone(find_command_bme('star'))
+        self.assertIsNone(find_callback_bme('s'))
+        self.assertIsNone(find_callback_bme('"second"'))
+
+    def test_rebuilding(self):
+        bme = BotMenuElem.objects.create(
+            command='first\nthird',
+            callbacks_db='["second", "third"]',
+            message='Third message',
+        )
+        self.assertEqual(bme, find_command_bme('third'))
+        self.assertEqual(bme, find_command_bme('first'))
+        self.assertEqual(self.bme_2, find_callback_bme('second'))
+
+        self.bme_2.delete()
+        self.assertEqual(bme, find_callback_bme('second'))
+
+        bme.is_visable = False
+        bme.save()
+        self.assertIsNone(find_callback_bme('second'))
+
+        with self.assertNumQueries(1):
+            find_callback_bme('third')  # index is not rebuilt
+
+    def test_changes_of_other_processes(self):
+        index_1 = BotMenuElemIndex(cache_alias='default', timeout=None)
+        index_2 = BotMenuElemIndex(cache_alias='default', timeout=None)
+        self.assertEqual([self.bme_start.id], index_1.get_command_ids('start'))
+        self.assertEqual([], index_2.get_command_ids('third'))
+
+        BotMenuElem.objects.filter(id=self.bme_start.id).update(command='third')  # without signals
+        index_1.invalidate()  # for example, after saving in admin site
+        with self.assertNumQueries(0):  # the shared version is checked once in version_check_interval
+            self.assertEqual([], index_2.get_command_ids('third'))
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 2):
+            self.assertEqual([self.bme_start.id], index_2.get_command_ids('third'))
+
+        # without shared cache changes are seen after timeout
+        index_3 = BotMenuElemIndex(cache_alias=None, timeout=60)
+        self.assertEqual([self.bme_start.id], index_3.get_command_ids('third'))
+        BotMenuElem.objects.filter(id=self.bme_start.id).update(command='start')
+        self.assertEqual([self.bme_start.id], index_3.get_command_ids('third'))
+
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual([], index_3.get_command_ids('third'))
+            self.assertEqual([self.bme_start.id], index_3.get_command_ids('start'))
+
+    def test_settings(self):
+        index = BotMenuElemIndex()
+        with self.settings(TELEGRAM_BME_INDEX_CACHE=None, TELEGRAM_BME_INDEX_TIMEOUT=None):
+            self.assertIsNone(index.cache_alias)
+            self.assertIsNone(index.timeout)
+        self.assertEqual('default', index.cache_alias)
+        self.assertEqual(60, index.timeout)
+
+
+@override_settings(TELEGRAM_BME_SNAPSHOT={'BACKEND': 'telegram_django_bot.bme_index.BotMenuElemSnapshot'})
+class TestBMESnapshot(TD_TestCase, BMEInitData):
+    def setUp(self) -> None:
+        self.setup_data(with_translation=True)
+
+    def test_no_queries_after_loading(self):
+        get_bme_snapshot().load()
+
+        with self.assertNumQueries(0):
+            bme = find_command_bme('start')
+            self.assertEqual(self.bme_start, bme)
+            self.assertEqual('Алоха, мир!', bme.get_message('ru'))
+            self.assertEqual('Aloha, world!', bme.get_message('de'))
+            self.assertEqual(
+                InlineKeyboardMarkup([[InlineKeyboardButton('старт', callback_data='start')]]).to_dict(),
+                InlineKeyboardMarkup(bme.get_buttons('ru')).to_dict()
+            )
+            self.assertEqual(self.bme_2, find_callback_bme('second'))
+            self.assertIsNone(find_callback_bme('not_exist'))
+            self.assertIsNone(find_empty_block_bme())
+
+    def test_invalidation(self):
+        self.assertEqual('Алоха, мир!', find_command_bme('start').get_message('ru'))
+
+        BotMenuElemAttrText.objects.get(
+            bot_menu_elem=self.bme_start,
+            language_code='ru',
+            default_text='Aloha, world!'
+        ).delete()
+        self.assertEqual('Aloha, world!', find_command_bme('start').get_message('ru'))
+
+        empty_block_bme = BotMenuElem.objects.create(empty_block=True, message='empty')
+        self.assertEqual(empty_block_bme, find_empty_block_bme())
+
+        self.bme_2.is_visable = False
+        self.bme_2.save()
+        self.assertIsNone(find_callback_bme('second'))
+
+    def test_returned_copy(self):
+        bme = find_command_bme('start')
+        bme.telegram_file_code = 'file_code'
+        self.assertIsNone(find_command_bme('start').telegram_file_code)
+
+    def test_cache_version(self):
+        snapshot_1 = BotMenuElemSnapshot(cache_alias='default')
+        snapshot_2 = BotMenuElemSnapshot(cache_alias='default')
+        cache.delete(BotMenuElemSnapshot.VERSION_CACHE_KEY)
+
+        self.assertEqual(self.bme_start, snapshot_1.get_command_bme('start'))
+        self.assertIsNone(snapshot_2.get_command_bme('third'))
+
+        BotMenuElem.objects.filter(id=self.bme_start.id).update(command='third')  # without signals
+        snapshot_1.invalidate()
+        self.assertEqual(self.bme_start, snapshot_2.get_command_bme('third'))
+        self.assertIsNone(snapshot_2.get_command_bme('start'))
+
 
 @unittest.skipIf(int(telegram.__version__.split('.')[0]) >= 20, 'tests do not support async')
 class TestBMEHandlers(TD_TestCase, BMEInitData):
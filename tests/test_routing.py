@@ -1,9 +1,16 @@
 import telegram
 
-from telegram_django_bot.routing import telegram_resolve, telegram_reverse, RouterCallbackMessageCommandHandler
+from telegram_django_bot.routing import (
+    telegram_resolve, telegram_reverse, RouterCallbackMessageCommandHandler, UtrlResolution,
+    CompiledUtrlRouter, get_compiled_router, AsyncRouterCallbackMessageCommandHandler,
+)
+from telegram_django_bot.utils import async_handler_decor
+from telegram_django_bot.chat_executor import ChatOrderedExecutor, AsyncChatOrderedExecutor
+from asgiref.sync import async_to_sync
 from telegram_django_bot.test import TD_TestCase
 from telegram_django_bot.models import BotMenuElem, ActionLog
 from django.urls.exceptions import NoReverseMatch
+from django.urls import re_path, path
 from django.conf import settings
 
 # import os, sys
@@ -13,7 +20,12 @@ from django.conf import settings
 from test_app.models import User, Category
 from test_app.views import CategoryViewSet, EntityViewSet
 from test_app.handlers import me
+import asyncio
+import threading
+import time
 import unittest
+from unittest import mock
+import types
 
 class TestTelegramResolve(TD_TestCase):
     def test_exist(self):
@@ -40,6 +52,72 @@ class TestTelegramResolve(TD_TestCase):
 
 
 
+class TestCompiledUtrlRouter(TD_TestCase):
+    def assertSameResolving(self, paths, utrl_conf=None):
+        router = CompiledUtrlRouter(utrl_conf)
+        for utrl in paths:
+            match = router.resolve(utrl)
+            resolver_match = telegram_resolve(utrl, utrl_conf)
+            if resolver_match is None:
+                self.assertIsNone(match, utrl)
+            else:
+                self.assertEqual(resolver_match.func, match.func, utrl)
+                self.assertEqual(resolver_match.route, match.route, utrl)
+
+    def test_same_as_telegram_resolve(self):
+        self.assertSameResolving([
+            'cat/se', '/cat/', 'cat/up&1&2&3', 'ent/cr&some_name&cat/', 'start', 'me', 'me?some=1', 'us/se',
+            'abracadabra', 'cat', 'startstart/', 'mee',
+        ])
+
+    def test_patterns_order(self):
+        utrl_conf = types.ModuleType('test_utrl_conf')
+        utrl_conf.urlpatterns = [
+            re_path(r'^ca', me, name='ca'),
+            re_path(r'^c(?P<symbol>\w)t/', CategoryViewSet, name='c_t'),
+            re_path(r'^cat/', EntityViewSet, name='cat'),
+            path('dog/', EntityViewSet, name='dog'),
+            re_path(r'^do\.g$', me, name='do.g'),
+            re_path(r'g/', CategoryViewSet, name='g'),
+        ]
+        self.assertSameResolving(['cat/', 'cbt/se', 'dog/se', 'do.g', 'doxg', 'bag/', 'ca'], utrl_conf)
+
+        router = CompiledUtrlRouter(utrl_conf)
+        self.assertEqual('ca', router.resolve('cat/').url_name)
+        self.assertEqual({'symbol': 'b'}, router.resolve('cbt/se').kwargs)
+        self.assertEqual('do.g', router.resolve('do.g').url_name)
+
+    def test_default_args(self):
+        utrl_conf = types.ModuleType('test_default_args_utrl_conf')
+        utrl_conf.urlpatterns = [
+            re_path(r'^c(?P<symbol>\w)t/', CategoryViewSet, {'page': 1}, name='c_t'),
+            re_path(r'^me$', me, {'page': 2}, name='me'),
+            path('dog/', EntityViewSet, {'page': 3}, name='dog'),
+        ]
+        router = CompiledUtrlRouter(utrl_conf)
+        for utrl in ['cbt/se', 'me', 'dog/']:
+            resolver_match = telegram_resolve(utrl, utrl_conf)
+            match = router.resolve(utrl)
+            self.assertEqual(resolver_match.kwargs, match.kwargs, utrl)
+            self.assertEqual(resolver_match.args, match.args, utrl)
+        self.assertEqual({'symbol': 'b', 'page': 1}, router.resolve('cbt/se').kwargs)
+
+    def test_compiled_router_cache(self):
+        match = get_compiled_router().resolve('cat/up&1&2&3')
+        self.assertEqual(CategoryViewSet, match.func)
+        self.assertIs(get_compiled_router(), get_compiled_router(settings.TELEGRAM_ROOT_UTRLCONF))
+
+    @unittest.skipIf(int(telegram.__version__.split('.')[0]) >= 20, 'tests do not support async')
+    def test_handler_with_compiled_router(self):
+        rc_mch = RouterCallbackMessageCommandHandler(use_compiled_router=True)
+        update = self.create_update({'text': '/start'})
+        check_result = rc_mch.check_update(update)
+        self.assertEqual(me, check_result.resolver_match.func)
+
+        res = rc_mch.handle_update(update, 'dispatcher', check_result, self.test_callback_context)
+        self.assertEqual(telegram.Message, type(res))
+
+
 class TestTelegramReverse(TD_TestCase):
     def test_exist(self):
         res = telegram_reverse('CategoryViewSet')
@@ -82,6 +160,17 @@ class TestRouterCallbackMessageCommandHandler(TD_TestCase):
         self.assertEqual(1, ActionLog.objects.filter(type='me').count())
 
 
+    def test_check_result_reused(self):
+        rc_mch = RouterCallbackMessageCommandHandler()
+        update = self.create_update({'text': '/start'})
+        check_result = rc_mch.check_update(update)
+        self.assertIsInstance(check_result, UtrlResolution)
+        self.assertEqual(me, check_result.resolver_match.func)
+
+        rc_mch.resolve_update = lambda update: self.fail('update should not be resolved twice')
+        res = rc_mch.handle_update(update, 'dispatcher', check_result, self.test_callback_context)
+        self.assertEqual(telegram.Message, type(res))
+
     def test_bme_command(self):
         rc_mch = RouterCallbackMessageCommandHandler()
         update = self.create_update({'text': '/test'})
@@ -158,6 +247,21 @@ class TestRouterCallbackMessageCommandHandler(TD_TestCase):
         self.assertEqual(1, ActionLog.objects.filter(type='cat/cr').count())
         self.assertEqual(telegram.Message, type(res))
 
+    def test_user_utrl_user_reused(self):
+        rc_mch = RouterCallbackMessageCommandHandler()
+        update = self.create_update({'text': 'category_name'})
+        user_id = settings.TELEGRAM_TEST_USER_IDS[0]
+        User.objects.create(id=user_id, username=user_id, current_utrl='cat/cr&name')
+
+        check_result = rc_mch.check_update(update)
+        self.assertEqual(user_id, check_result.user.id)
+
+        with mock.patch.object(User.objects, 'get_or_create', side_effect=AssertionError('user is selected twice')):
+            res = rc_mch.handle_update(update, 'dispatcher', check_result, self.test_callback_context)
+        self.assertEqual(telegram.Message, type(res))
+        self.assertIs(check_result.user, self.test_callback_context.resolved_user)
+        self.assertEqual(1, Category.objects.count())
+
     def test_callback_bme(self):
         rc_mch = RouterCallbackMessageCommandHandler()
 
@@ -178,3 +282,182 @@ class TestRouterCallbackMessageCommandHandler(TD_TestCase):
         self.assertEqual(1, ActionLog.objects.filter(type='test').count())
 
 
+class TestAsyncRouterCallbackMessageCommandHandler(TD_TestCase):
+    # sync python-telegram-bot is used, async pipeline awaits only awaitable results of bot calls
+    def setUp(self) -> None:
+        self.bme = BotMenuElem.objects.create(message='test', command='test')
+        self.rc_mch = AsyncRouterCallbackMessageCommandHandler()
+
+    def handle(self, update):
+        check_result = self.rc_mch.check_update(update)
+        if not check_result:
+            return None
+        return async_to_sync(self.rc_mch.handle_update)(update, 'application', check_result, self.test_callback_context)
+
+    def test_command(self):
+        res = self.handle(self.create_update({'text': '/start'}))
+        self.assertEqual(telegram.Message, type(res))
+        self.assertEqual(1, ActionLog.objects.filter(type='me').count())
+
+    def test_bme_command(self):
+        res = self.handle(self.create_update({'text': '/test'}))
+        self.assertEqual('test', res.text)
+        self.assertEqual(1, ActionLog.objects.filter(type='/test').count())
+
+        res = self.handle(self.create_update({'text': '/abra'}))
+        self.assertEqual(
+            'Oops! It seems that an error has occurred, please write to support (contact in bio)!',
+            res.text
+        )
+
+        self.rc_mch.only_utrl = True
+        self.assertIsNone(self.rc_mch.check_update(self.create_update({'text': '/test'})))
+
+    def test_callback_viewset(self):
+        message = self.test_callback_context.bot.send_message(
+            chat_id=settings.TELEGRAM_TEST_USER_IDS[0],
+            text='some text'
+        )
+        update = self.create_update(message.to_dict(), {'data': 'cat/cr'})
+        res = self.handle(update)
+        self.assertEqual(telegram.Message, type(res))
+        self.assertEqual(1, ActionLog.objects.filter(type='cat/cr').count())
+
+    def test_user_utrl(self):
+        update = self.create_update({'text': 'category_name'})
+        self.assertIsInstance(self.rc_mch.check_update(update), UtrlResolution)  # db is not requested
+        self.assertIsNone(self.handle(update))  # there is no user
+
+        user_id = settings.TELEGRAM_TEST_USER_IDS[0]
+        User.objects.create(id=user_id, username=user_id, current_utrl='cat/cr&name&')
+        res = self.handle(update)
+        self.assertEqual(telegram.Message, type(res))
+        self.assertEqual(1, Category.objects.filter(name='category_name').count())
+
+    def test_async_handler_decor(self):
+        @async_handler_decor()
+        async def async_handler(bot, update, user):
+            return await bot.aedit_or_send(update, 'async message')
+
+        @async_handler_decor()
+        async def async_error_handler(bot, update, user):
+            raise ValueError('some error')
+
+        update = self.create_update({'text': 'some text'})
+        res = async_to_sync(async_handler)(update, self.test_callback_context)
+        self.assertEqual('async message', res.text)
+        self.assertEqual(1, ActionLog.objects.filter(type='async_handler').count())
+
+        with self.assertRaises(ValueError):
+            async_to_sync(async_error_handler)(update, self.test_callback_context)
+
+
+class TestChatOrderedExecutor(TD_TestCase):
+    def test_order_and_parallel(self):
+        executor = ChatOrderedExecutor(workers=4)
+        processed = []
+        first_chat_event = threading.Event()
+
+        def process(chat_id, index):
+            if chat_id == 1 and index == 0:
+                first_chat_event.wait(5)  # the first chat is slow
+            processed.append((chat_id, index))
+
+        futures = [executor.submit(chat_id, process, chat_id, index) for index in range(3) for chat_id in [1, 2]]
+        self.assertEqual(3, executor.get_queue_depth(1))
+
+        futures[-1].result(5)  # chat 2 is not blocked by chat 1
+        self.assertEqual([(2, 0), (2, 1), (2, 2)], processed)
+        first_chat_event.set()
+
+        for future in futures:
+            future.result(5)
+        self.assertEqual([(1, 0), (1, 1), (1, 2)], [item for item in processed if item[0] == 1])
+        self.assertEqual({'chats': 0, 'queued': 0, 'max_queue_depth': 3, 'processed': 6}, executor.get_stats())
+        executor.close()
+
+    def test_error(self):
+        executor = ChatOrderedExecutor(workers=1)
+        future = executor.submit(1, int, 'abc')
+        with self.assertRaises(ValueError):
+            future.result(5)
+        self.assertEqual(2, executor.submit(1, int, '2').result(5))
+        executor.close()
+
+    def test_fast_tasks(self):
+        # tasks are finished before submit returns, the chat should not stall
+        executor = ChatOrderedExecutor(workers=4)
+        futures = []
+
+        def submit_many():
+            futures.extend(executor.submit(1, int, str(index)) for index in range(200))
+
+        threads = [threading.Thread(target=submit_many) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for future in futures:
+            future.result(5)
+        self.assertEqual({'chats': 0, 'queued': 0, 'processed': 800}, {
+            key: value for key, value in executor.get_stats().items() if key != 'max_queue_depth'
+        })
+        executor.close()
+
+    def test_async_order(self):
+        executor = AsyncChatOrderedExecutor()
+        processed = []
+
+        async def process(chat_id, index, delay):
+            await asyncio.sleep(delay)
+            processed.append((chat_id, index))
+
+        async def process_all():
+            await asyncio.gather(
+                executor.run(1, process, 1, 0, 0.05),
+                executor.run(1, process, 1, 1, 0),
+                executor.run(2, process, 2, 0, 0),
+            )
+
+        async_to_sync(process_all)()
+        self.assertEqual([(2, 0), (1, 0), (1, 1)], processed)
+        self.assertEqual({'chats': 0, 'queued': 0, 'max_queue_depth': 2, 'processed': 3}, executor.get_stats())
+
+    @unittest.skipIf(int(telegram.__version__.split('.')[0]) >= 20, 'tests do not support async')
+    def test_handler(self):
+        processed = []
+
+        def slow(update, context):
+            time.sleep(0.05)
+            processed.append('slow')
+
+        def fast(update, context):
+            processed.append('fast')
+
+        def error(update, context):
+            raise ValueError('some error')
+
+        utrl_conf = types.ModuleType('utrl_conf')
+        utrl_conf.urlpatterns = [re_path('^slow$', slow), re_path('^fast$', fast), re_path('^error$', error)]
+
+        class Dispatcher:
+            errors = []
+
+            def dispatch_error(self, update, error):
+                self.errors.append(error)
+
+        executor = ChatOrderedExecutor(workers=2)
+        rc_mch = RouterCallbackMessageCommandHandler(utrl_conf=utrl_conf, only_utrl=True, chat_executor=executor)
+        futures = []
+        for data in ['slow', 'fast', 'error']:
+            update = self.create_update(callback_kwargs={'data': data})
+            check_result = rc_mch.check_update(update)
+            futures.append(rc_mch.handle_update(update, Dispatcher(), check_result, self.test_callback_context))
+
+        for future in futures:
+            future.result(5)
+        self.assertEqual(['slow', 'fast'], processed)
+        self.assertEqual(1, len(Dispatcher.errors))
+        self.assertEqual(3, executor.get_stats()['max_queue_depth'])
+        executor.close()
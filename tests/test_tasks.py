@@ -0,0 +1,257 @@
+import json
+from unittest import mock
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from telegram_django_bot.test import DJ_TestCase
+from telegram_django_bot.models import BotMenuElem, Trigger, UserTrigger, ActionLog, ActionLogDailyCount
+from telegram_django_bot.tasks import create_triggers, create_user_triggers, get_scheduled_users, send_triggers
+from telegram_django_bot.action_log_rollup import rollup_action_logs, get_rollup_days, get_day_start, get_local_date
+
+from test_app.models import User
+
+
+class TestCreateTriggers(DJ_TestCase):
+    def setUp(self) -> None:
+        self.bme = BotMenuElem.objects.create(message='trigger message')
+        self.users = [User.objects.create(id=it, username=str(it), seed_code=it % 10) for it in range(1, 21)]
+        for user in self.users[:6]:
+            ActionLog.objects.bulk_create([ActionLog(user=user, type='clicked') for _ in range(3)])
+
+    def create_trigger(self, condition_db, name='trigger', priority=1):
+        return Trigger.objects.create(
+            name=name,
+            condition_db=condition_db,
+            min_duration=timezone.timedelta(days=1),
+            priority=priority,
+            botmenuelem=self.bme,
+        )
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_create_triggers(self, send_triggers_delay):
+        trigger = self.create_trigger(
+            '{"seeds": [1, 2, 3, 4, 5], "amount": [{"gte": 3, "type": "clicked", "duration": "7d"}]}'
+        )
+        create_triggers()
+
+        user_ids = {1, 2, 3, 4, 5}  # seeds and amount of actions
+        self.assertEqual(user_ids, set(UserTrigger.objects.filter(trigger=trigger).values_list('user_id', flat=True)))
+        send_triggers_delay.assert_called_once()
+        self.assertEqual(user_ids, set(send_triggers_delay.call_args[0][0]))
+
+        create_triggers()  # min_duration is not passed
+        self.assertEqual(5, UserTrigger.objects.count())
+        send_triggers_delay.assert_called_once()
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_create_triggers_insert_select(self, send_triggers_delay):
+        trigger = self.create_trigger(
+            '{"seeds": [1, 2, 3, 4, 5], "amount": [{"gte": 3, "type": "clicked", "duration": "7d"}]}'
+        )
+        with mock.patch.object(connection.features, 'can_return_rows_from_bulk_insert', True):  # as PostgreSQL
+            with self.assertNumQueries(2):  # triggers, insert ... select ... returning
+                create_triggers(use_insert_select=True)
+
+        user_ids = {1, 2, 3, 4, 5}
+        user_triggers = UserTrigger.objects.filter(trigger=trigger)
+        self.assertEqual(user_ids, set(user_triggers.values_list('user_id', flat=True)))
+        self.assertFalse(user_triggers.filter(is_sent=True).exists())
+        self.assertEqual(user_ids, set(send_triggers_delay.call_args[0][0]))
+
+        create_triggers(use_insert_select=True)
+        self.assertEqual(5, UserTrigger.objects.count())
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_insert_select_without_returning(self, send_triggers_delay):
+        self.create_trigger('{"seeds": [1, 2, 3, 4, 5], "amount": [{"gte": 3, "type": "clicked", "duration": "7d"}]}')
+        other_trigger = self.create_trigger('{}', 'other')
+        dttm_now = timezone.now()
+        UserTrigger.objects.create(trigger=other_trigger, user=self.users[-1], dttm_added=dttm_now)
+        Trigger.objects.filter(id=other_trigger.id).update(dttm_deleted=dttm_now)
+
+        with mock.patch('django.utils.timezone.now', return_value=dttm_now):
+            create_triggers(use_insert_select=True)
+
+        self.assertEqual({1, 2, 3, 4, 5}, set(send_triggers_delay.call_args[0][0]))  # rows of the run only
+        self.assertEqual(6, UserTrigger.objects.count())
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_one_trigger_per_user(self, send_triggers_delay):
+        clicked = self.create_trigger('{"amount": [{"gte": 1, "type": "clicked", "duration": "7d"}]}', 'clicked', 2)
+        seeds = self.create_trigger('{"seeds": [1, 2, 3, 4, 5, 6, 7]}', 'seeds', 1)
+        with self.assertNumQueries(3):  # triggers, users of all triggers, bulk_create
+            create_triggers()
+
+        self.assertEqual(
+            {1, 2, 3, 4, 5, 6},  # higher priority
+            set(UserTrigger.objects.filter(trigger=clicked).values_list('user_id', flat=True))
+        )
+        self.assertEqual(
+            {7, 11, 12, 13, 14, 15, 16, 17},
+            set(UserTrigger.objects.filter(trigger=seeds).values_list('user_id', flat=True))
+        )
+        send_triggers_delay.assert_called_once()
+
+        # without cooldown users 1-6 get the next trigger, min_duration of clicked trigger is not passed
+        create_triggers()
+        self.assertEqual(14 + 6, UserTrigger.objects.count())
+        self.assertEqual(14, UserTrigger.objects.filter(trigger=seeds).count())
+
+        create_triggers(use_insert_select=True)
+        self.assertEqual(14 + 6, UserTrigger.objects.count())
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_cooldown(self, send_triggers_delay):
+        trigger = self.create_trigger('{"seeds": [1, 2]}')
+        UserTrigger.objects.create(
+            trigger=self.create_trigger('{}', 'other'), user=self.users[0],
+        )
+        UserTrigger.objects.filter(trigger__name='other').update(dttm_added=timezone.now() - timezone.timedelta(days=2))
+        Trigger.objects.filter(name='other').update(dttm_deleted=timezone.now())
+
+        create_triggers(cooldown=timezone.timedelta(days=3))
+        self.assertEqual(
+            {2, 11, 12}, set(UserTrigger.objects.filter(trigger=trigger).values_list('user_id', flat=True))
+        )
+
+        with self.settings(TELEGRAM_TRIGGERS_COOLDOWN=timezone.timedelta(days=1)):
+            create_triggers()
+        self.assertEqual(
+            {1, 2, 11, 12}, set(UserTrigger.objects.filter(trigger=trigger).values_list('user_id', flat=True))
+        )
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_sequence_and_exclude(self, send_triggers_delay):
+        for user in self.users[6:9]:
+            ActionLog.objects.create(user=user, type='ordered')
+        ActionLog.objects.create(user=self.users[0], type='ordered')
+        ActionLog.objects.create(user=self.users[8], type='paid')
+
+        trigger = self.create_trigger(json.dumps({
+            'sequence': [[{'type': 'ordered', 'duration': '1d'}, {'type': 'clicked', 'duration': '1d'}]],
+            'exclude': [{'type__in': ['paid'], 'duration': '2d 12h'}],
+            'amount': [{'lt': 3, 'type': 'clicked', 'duration': '1d'}],
+        }))
+        condition = trigger.condition.copy()
+        create_triggers()
+
+        self.assertEqual({7, 8}, set(UserTrigger.objects.filter(trigger=trigger).values_list('user_id', flat=True)))
+        self.assertEqual(condition, trigger.condition)  # condition is not changed by running
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_only_sequence_or_exclude(self, send_triggers_delay):
+        ActionLog.objects.create(user=self.users[6], type='ordered')
+        sequence = self.create_trigger('{"sequence": [[{"type": "ordered", "duration": "1d"}]]}', 'sequence', 2)
+        exclude = self.create_trigger('{"exclude": [{"type": "clicked", "duration": "1d"}]}', 'exclude', 1)
+        create_triggers()
+
+        self.assertEqual([7], list(UserTrigger.objects.filter(trigger=sequence).values_list('user_id', flat=True)))
+        self.assertEqual(
+            set(range(8, 21)), set(UserTrigger.objects.filter(trigger=exclude).values_list('user_id', flat=True))
+        )
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_type_lookups(self, send_triggers_delay):
+        ActionLog.objects.create(user=self.users[6], type='Ordered')
+        ActionLog.objects.create(user=self.users[7], type='order_paid')
+        iexact = self.create_trigger('{"sequence": [[{"type__iexact": "ordered", "duration": "1d"}]]}', 'iexact', 2)
+        regex = self.create_trigger(
+            '{"amount": [{"gte": 1, "type__regex": "^order_", "duration": "1d"}]}', 'regex', 1
+        )
+        create_triggers()
+
+        self.assertEqual([7], list(UserTrigger.objects.filter(trigger=iexact).values_list('user_id', flat=True)))
+        self.assertEqual([8], list(UserTrigger.objects.filter(trigger=regex).values_list('user_id', flat=True)))
+
+        for condition_db in [
+            '{"exclude": [{"type__in": "a", "duration": "1d"}]}',
+            '{"exclude": [{"type__iendswith": ["a"], "duration": "1d"}]}',
+            '{"exclude": [{"type__unknown": "a", "duration": "1d"}]}',
+            '{"exclude": [{"type__iexact__in": "a", "duration": "1d"}]}',
+        ]:
+            with self.assertRaises(ValidationError):
+                self.create_trigger(condition_db, name=condition_db)
+
+    def test_condition_compiling(self):
+        trigger = self.create_trigger('{"seeds": [1, 2], "amount": [{"gte": 1, "type": "a", "duration": "1d"}]}')
+        self.assertIs(trigger.compiled_condition, Trigger.objects.get(id=trigger.id).compiled_condition)
+        self.assertEqual((1, 2), trigger.compiled_condition.seeds)
+        self.assertEqual(timezone.timedelta(days=1), trigger.compiled_condition.amounts[0].action_filter.duration)
+
+        for condition_db in [
+            'not json',
+            '{"seed": [1]}',
+            '{"seeds": ["1"]}',
+            '{"amount": [{"gte": 1, "type": "a"}]}',  # no duration
+            '{"amount": [{"type": "a", "duration": "1d"}]}',  # no comparison
+            '{"amount": [{"gte": 1, "user_id": 1, "duration": "1d"}]}',
+            '{"exclude": [{"type": "a", "duration": "1 week"}]}',
+            '{"sequence": [[]]}',
+        ]:
+            with self.assertRaises(ValidationError):
+                self.create_trigger(condition_db, name=condition_db)
+
+        trigger.condition_db = '{"seeds": "1"}'
+        with self.assertRaises(ValidationError) as error:
+            trigger.clean()
+        self.assertIn('condition_db', error.exception.message_dict)
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_create_user_triggers_by_chunks(self, send_triggers_delay):
+        trigger = self.create_trigger('{}')
+        amount = create_user_triggers(get_scheduled_users([trigger], timezone.now()), chunk_size=8)
+
+        self.assertEqual(20, amount)
+        self.assertEqual(20, UserTrigger.objects.filter(trigger=trigger).count())
+        self.assertEqual([8, 8, 4], [len(call[0][0]) for call in send_triggers_delay.call_args_list])
+
+
+class TestActionLogRollup(DJ_TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(id=1, username='1', seed_code=1)
+        self.dttm_now = timezone.now()
+        for days in range(1, 6):
+            ActionLog.objects.create(user=self.user, type='ordered')
+            ActionLog.objects.filter(dttm__gte=self.dttm_now).update(
+                dttm=self.dttm_now - timezone.timedelta(days=days, hours=-1)
+            )
+        ActionLog.objects.create(user=self.user, type='ordered')  # today
+
+    def test_rollup_action_logs(self):
+        self.assertEqual(6, rollup_action_logs())
+        self.assertEqual(6, ActionLogDailyCount.objects.aggregate(amount=Sum('amount'))['amount'])
+
+        ActionLog.objects.create(user=self.user, type='ordered')
+        ActionLog.objects.create(user=self.user, type='clicked')
+        self.assertEqual(2, rollup_action_logs())  # only the last day is recounted
+        self.assertEqual(
+            {('ordered', 2), ('clicked', 1)},
+            set(ActionLogDailyCount.objects.filter(day=get_local_date(timezone.now())).values_list('type', 'amount'))
+        )
+        self.assertEqual(8, ActionLogDailyCount.objects.aggregate(amount=Sum('amount'))['amount'])
+
+        rollup_days = get_rollup_days()
+        self.assertEqual(get_local_date(timezone.now()) - timezone.timedelta(days=5), rollup_days.first_day)
+        self.assertEqual(get_local_date(timezone.now()), rollup_days.last_day)
+
+    @mock.patch.object(send_triggers, 'delay')
+    def test_create_triggers_by_rollup(self, send_triggers_delay):
+        rollup_action_logs()
+        Trigger.objects.create(
+            name='ordered',
+            condition_db='{"amount": [{"gte": 5, "type": "ordered", "duration": "4d 12h"}]}',
+            min_duration=timezone.timedelta(days=1),
+            botmenuelem=BotMenuElem.objects.create(message='trigger message'),
+        )
+        # raw logs of full rolled up days of the window are not used
+        first_day, last_day = get_rollup_days().get_full_days(timezone.now() - timezone.timedelta(days=4, hours=12))
+        ActionLog.objects.filter(dttm__gte=get_day_start(first_day), dttm__lt=get_day_start(last_day)).delete()
+
+        create_triggers()
+        self.assertFalse(UserTrigger.objects.exists())
+
+        create_triggers(use_rollup=True)
+        self.assertEqual([self.user.id], list(UserTrigger.objects.values_list('user_id', flat=True)))
@@ -1,11 +1,18 @@
 from telegram_django_bot.test import TD_TestCase
 from telegram_django_bot.telegram_lib_redefinition import InlineKeyboardButtonDJ, InlineKeyboardMarkupDJ
-from telegram_django_bot.models import BotMenuElem, BotMenuElemAttrText, MESSAGE_FORMAT
+from telegram_django_bot.models import BotMenuElem, BotMenuElemAttrText, TelegramFileCode, MESSAGE_FORMAT
+from telegram_django_bot.file_registry import get_file_registry, FileCodeRegistry
+from telegram_django_bot.broadcast import Broadcast, AsyncBroadcast, TokenBucket, PerChatLimiter
+from django.core.cache import cache
+from asgiref.sync import async_to_sync
 from django.conf import settings
 
 from test_app.models import User
 
+import threading
+import time
 import unittest
+from unittest import mock
 import telegram
 
 
@@ -109,6 +116,61 @@ class Test_TG_DJ_BOT(TD_TestCase):
 
 
 
+    def test_send_media_files(self):
+        bot = self.test_callback_context.bot
+
+        message, media_codes = bot.send_media_files(
+            MESSAGE_FORMAT.PHOTO, 'photo', ['media/pic1.png'], chat_id=self.user1.id
+        )
+        self.assertEqual(1, len(media_codes))
+        self.assertEqual(1, TelegramFileCode.objects.count())
+
+        with self.assertNumQueries(0):  # file code is taken from registry
+            bot.send_media_files(MESSAGE_FORMAT.PHOTO, 'photo', ['media/pic1.png'], chat_id=self.user1.id)
+        self.assertEqual(1, TelegramFileCode.objects.count())
+
+        # the same file as document is uploaded again
+        bot.send_media_files(MESSAGE_FORMAT.DOCUMENT, 'doc', ['media/pic1.png'], chat_id=self.user1.id)
+        self.assertEqual(2, TelegramFileCode.objects.count())
+
+        message, media_codes = bot.send_media_files(
+            MESSAGE_FORMAT.GROUP_MEDIA,
+            'group',
+            [(MESSAGE_FORMAT.PHOTO, 'media/pic1.png'), (MESSAGE_FORMAT.PHOTO, 'media/pic2.jpg')],
+            chat_id=self.user1.id,
+        )
+        self.assertEqual(2, len(message))
+        self.assertEqual(2, len(media_codes))
+        self.assertEqual(3, TelegramFileCode.objects.count())
+
+    def test_send_botmenuelem_file_registry(self):
+        bme = BotMenuElem.objects.create(message_format=MESSAGE_FORMAT.PHOTO, message='m1', media='media/pic1.png')
+        bme_2 = BotMenuElem.objects.create(message_format=MESSAGE_FORMAT.PHOTO, message='m2', media='media/pic1.png')
+
+        bot = self.test_callback_context.bot
+        bot.send_botmenuelem(None, self.user1, bme)
+        bot.send_botmenuelem(None, self.user1, bme_2)
+
+        bme.refresh_from_db()
+        bme_2.refresh_from_db()
+        self.assertIsNotNone(bme.telegram_file_code)
+        self.assertIsNotNone(bme_2.telegram_file_code)
+        self.assertEqual(1, TelegramFileCode.objects.count())  # file is uploaded once
+
+    def test_asend_botmenuelem(self):
+        bme = BotMenuElem.objects.create(message_format=MESSAGE_FORMAT.PHOTO, message='async', media='media/pic1.png')
+        bot = self.test_callback_context.bot
+
+        message = async_to_sync(bot.asend_botmenuelem)(None, self.user1, bme)
+        self.assertEqual('async', message.caption)
+        bme.refresh_from_db()
+        self.assertIsNotNone(bme.telegram_file_code)
+        self.assertEqual(1, TelegramFileCode.objects.count())
+
+        update = self.create_update(message.to_dict(), {'data': 'just_for_update'})
+        message, __ = async_to_sync(bot.asend_format_message)(text='async text', update=update)
+        self.assertEqual('async text', message.text)
+
     def test_edit_or_send(self):
         bot = self.test_callback_context.bot
         user_id = settings.TELEGRAM_TEST_USER_IDS[0]
@@ -188,4 +250,148 @@ class Test_TG_DJ_BOT(TD_TestCase):
         self.assertFalse(self.user2.is_active)
 
 
-        # add translation check
\ No newline at end of file
+        # add translation check
+
+
+class TestFileCodeRegistry(TD_TestCase):
+    def test_content_hash(self):
+        file_registry = get_file_registry()
+        content_hash = file_registry.get_content_hash('media/pic1.png')
+        self.assertEqual(64, len(content_hash))
+        self.assertEqual(content_hash, file_registry.get_content_hash('media/pic1.png'))
+        self.assertNotEqual(content_hash, file_registry.get_content_hash('media/pic2.jpg'))
+
+    def test_get_set(self):
+        file_registry = get_file_registry()
+        key = ('hash', MESSAGE_FORMAT.PHOTO)
+        self.assertEqual({}, file_registry.get_many([key]))
+
+        file_registry.set_many({key: 'code'})
+        file_registry.set_many({key: 'code2'})  # conflict is ignored
+        self.assertEqual({key: 'code'}, FileCodeRegistry().get_many([key, ('hash', MESSAGE_FORMAT.DOCUMENT)]))
+
+        TelegramFileCode.objects.get().delete()
+        self.assertEqual({}, file_registry.get_many([key]))
+
+    def test_single_flight_cache_lock(self):
+        file_registry = FileCodeRegistry(cache_alias='default', lock_timeout=0.2, poll_interval=0.05)
+        lock_key = f'{file_registry.key_prefix}:lock:hash:{MESSAGE_FORMAT.PHOTO}'
+
+        with file_registry.single_flight(('hash', MESSAGE_FORMAT.PHOTO)):
+            self.assertFalse(cache.add(lock_key, 1))
+        self.assertTrue(cache.add(lock_key, 1))
+
+        # lock of other process: waits lock_timeout and does not release the lock
+        with file_registry.single_flight(('hash', MESSAGE_FORMAT.PHOTO)):
+            pass
+        self.assertFalse(cache.add(lock_key, 1))
+        cache.delete(lock_key)
+
+    def test_single_flight_locks_removed(self):
+        file_registry = FileCodeRegistry()
+        key = ('hash', MESSAGE_FORMAT.PHOTO)
+        is_locked = threading.Event()
+        order = []
+
+        def upload():
+            with file_registry.single_flight(key):
+                is_locked.set()
+                time.sleep(0.05)
+                order.append('first')
+
+        thread = threading.Thread(target=upload)
+        thread.start()
+        is_locked.wait(5)
+        with file_registry.single_flight(key):  # waits the first upload
+            order.append('second')
+        thread.join()
+
+        self.assertEqual(['first', 'second'], order)
+        self.assertEqual({}, file_registry._locks)
+
+        async def aupload():
+            async with file_registry.asingle_flight(key):
+                self.assertIn(key, file_registry._async_locks)
+
+        async_to_sync(aupload)()
+        self.assertEqual({}, file_registry._async_locks)
+
+
+class TestBroadcast(TD_TestCase):
+    def setUp(self) -> None:
+        self.users = [User.objects.create(id=user_id, username=user_id) for user_id in range(1000, 1010)]
+
+    def test_token_bucket(self):
+        token_bucket = TokenBucket(rate=10, capacity=2)
+        self.assertEqual(0, token_bucket.reserve())
+        self.assertEqual(0, token_bucket.reserve())
+        self.assertAlmostEqual(0.1, token_bucket.reserve(), delta=0.01)
+        self.assertAlmostEqual(0.2, token_bucket.reserve(), delta=0.01)
+
+        token_bucket.pause(1)
+        self.assertAlmostEqual(1, token_bucket.reserve(), delta=0.01)
+
+    def test_per_chat_limiter(self):
+        per_chat_limiter = PerChatLimiter(rate=10)
+        now = time.monotonic()
+        with mock.patch('time.monotonic', return_value=now):
+            self.assertEqual(0, per_chat_limiter.reserve(1))
+            self.assertAlmostEqual(0.1, per_chat_limiter.reserve(1))
+            self.assertEqual(0, per_chat_limiter.reserve(2))
+
+        with mock.patch('time.monotonic', return_value=now + 1):
+            self.assertEqual(0, per_chat_limiter.reserve(3))
+        self.assertEqual([3], list(per_chat_limiter._next_times))  # passed times of chats are removed
+
+    def test_run(self):
+        sent_user_ids = []
+        lock = threading.Lock()
+        retry_after_user_ids = {self.users[0].id}
+
+        def send_func(bot, user):
+            if user.id in retry_after_user_ids:
+                retry_after_user_ids.remove(user.id)
+                raise telegram.error.RetryAfter(0.05)
+            if user.id == self.users[1].id:
+                raise telegram.error.Unauthorized('Forbidden: bot was blocked by the user')
+            if user.id == self.users[2].id:
+                raise telegram.error.BadRequest('Message is too long')
+            with lock:
+                sent_user_ids.append(user.id)
+
+        broadcast = Broadcast(None, send_func, rate=1000, workers=3)
+        report = broadcast.run(User.objects.filter(id__in=[user.id for user in self.users]))
+
+        self.assertEqual(10, report.total)
+        self.assertEqual(8, report.sent)
+        self.assertEqual(set(user.id for user in self.users[3:]) | {self.users[0].id}, set(sent_user_ids))
+        self.assertEqual([self.users[1].id], report.blocked_user_ids)
+        self.assertEqual([self.users[2].id], report.failed_user_ids)
+        self.assertEqual(1, report.retry_after_amount)
+        self.assertGreaterEqual(report.duration, 0.05)
+
+        self.users[1].refresh_from_db()
+        self.assertFalse(self.users[1].is_active)
+
+    def test_rate(self):
+        broadcast = Broadcast(None, lambda bot, user: None, rate=50, workers=4)
+        broadcast.token_bucket.reserve()
+        broadcast.token_bucket._tokens = 0  # without burst
+
+        started_at = time.monotonic()
+        report = broadcast.run(self.users)
+        self.assertEqual(10, report.sent)
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.18)
+
+    def test_async_run(self):
+        sent_user_ids = []
+
+        async def send_func(bot, user):
+            if user.id == self.users[1].id:
+                raise telegram.error.Unauthorized('Forbidden: bot was blocked by the user')
+            sent_user_ids.append(user.id)
+
+        report = AsyncBroadcast(None, send_func, rate=1000, workers=3).run(self.users)
+        self.assertEqual(9, report.sent)
+        self.assertEqual(9, len(sent_user_ids))
+        self.assertEqual([self.users[1].id], report.blocked_user_ids)
@@ -1,8 +1,33 @@
 import datetime
+import time
+from decimal import Decimal
 
 from telegram_django_bot.test import DJ_TestCase
+from telegram_django_bot.state_backend import get_state_backend, RedisStateBackend
+from telegram_django_bot.state_serializer import TAGGED_FORMAT_PREFIX, dumps_state, loads_state
 from test_app.models import User
 from django.conf import settings
+from django.test import override_settings
+
+
+class FakeRedis:
+    """ local storage with part of redis client interface """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expire_at = self.data.get(key, (None, None))
+        if expire_at is not None and expire_at < time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        self.data[key] = (value.encode(), time.monotonic() + ex if ex else None)
+
+    def delete(self, key):
+        self.data.pop(key, None)
 
 
 class TestUser(DJ_TestCase):
@@ -68,6 +93,69 @@ class TestUser(DJ_TestCase):
         self.user1.save_context_in_db(data2)
         self.assertEqual(data2, self.user1.current_utrl_context)
 
+    def test_save_state(self):
+        user = User.objects.get(id=self.user1.id)
+        with self.assertNumQueries(0):
+            user.save_state()  # nothing is changed
+            user.clear_status()
+
+        user.current_utrl = 'aa/bb'
+        self.assertEqual(['current_utrl'], user.get_dirty_state_fields())
+        with self.assertNumQueries(1):
+            user.save_state()
+        self.assertEqual([], user.get_dirty_state_fields())
+        self.assertEqual('aa/bb', User.objects.get(id=self.user1.id).current_utrl)
+
+    def test_deferred_state_saving(self):
+        self.user1.defer_state_saving()
+        with self.assertNumQueries(0):
+            self.user1.clear_status()
+            self.user1.save_context_in_db({'a': 1})
+            self.user1.save_form_in_db('TestForm', {'int': 1})
+
+        self.assertEqual(
+            ['current_utrl_context_db', 'current_utrl_form_db'],
+            self.user1.get_dirty_state_fields()
+        )
+        with self.assertNumQueries(1):
+            self.user1.save_deferred_state()
+
+        user = User.objects.get(id=self.user1.id)
+        self.assertEqual({'a': 1}, user.current_utrl_context)
+        self.assertEqual('TestForm', user.current_utrl_form['form_name'])
+
+    def test_tagged_state_format(self):
+        context = {
+            'date_like_string': '2020-01-01',
+            'dt': datetime.date(2020, 1, 1),
+            'dttm': datetime.datetime(2020, 1, 1, 10, 30),
+            'price': Decimal('10.50'),
+            'user': self.user1,
+            'users': User.objects.filter(id=self.user1.id),
+            'list': [datetime.time(10, 30), {'__t': 'unknown', 'v': 1}],
+        }
+        self.user1.save_context_in_db(context)
+        self.assertTrue(self.user1.current_utrl_context_db.startswith(TAGGED_FORMAT_PREFIX))
+
+        context['user'] = self.user1.pk
+        context['users'] = [str(self.user1.pk)]
+        self.assertEqual(context, User.objects.get(id=self.user1.id).current_utrl_context)
+
+    def test_user_dicts_like_tags(self):
+        context = {
+            'tag_like': {'__t': 'date', 'v': '2020-01-01'},
+            'nested': [{'__t': 'pk', 'v': {'__t': 'dict', 'v': [['a', 1]]}, 'dt': datetime.date(2020, 1, 1)}],
+            'dt': datetime.date(2020, 1, 2),
+        }
+        text = dumps_state(context)
+        self.assertEqual(context, loads_state(text))
+        self.assertEqual({'dt': datetime.date(2020, 1, 2)}, loads_state(dumps_state({'dt': datetime.date(2020, 1, 2)})))
+
+    def test_old_state_format(self):
+        self.user1.current_utrl_context_db = '{"dttm": "2020-01-01T01:00:00", "a": "b"}'
+        self.assertEqual({'dttm': datetime.datetime(2020, 1, 1, 1), 'a': 'b'}, self.user1.current_utrl_context)
+        self.assertEqual({}, loads_state('{}'))
+
     def test_language_selection(self):
         self.assertEqual('en', self.user1.language_code)
 
@@ -79,3 +167,43 @@ class TestUser(DJ_TestCase):
 
         self.user1.telegram_language_code = 'fr'  # not exist in settings
         self.assertEqual('en', self.user1.language_code)
+
+
+class TestStateBackend(DJ_TestCase):
+    def setUp(self) -> None:
+        user_id = settings.TELEGRAM_TEST_USER_IDS[0]
+        self.user = User.objects.create(id=user_id, username=user_id)
+
+    def check_form_drafts(self):
+        self.user.save_form_in_db('TestForm', {'int': 1})
+        self.assertEqual('{}', User.objects.get(id=self.user.id).current_utrl_form_db)  # user row is not used
+
+        user = User.objects.get(id=self.user.id)
+        with self.assertNumQueries(0):
+            self.assertEqual({'form_name': 'TestForm', 'form_data': {'int': 1}}, user.current_utrl_form)
+
+        user.clear_status()
+        self.assertEqual({}, User.objects.get(id=self.user.id).current_utrl_form)
+
+    @override_settings(TELEGRAM_STATE_BACKEND={
+        'BACKEND': 'telegram_django_bot.state_backend.DjangoCacheStateBackend',
+        'OPTIONS': {'key_prefix': 'test_state_backend'},
+    })
+    def test_django_cache(self):
+        self.check_form_drafts()
+
+    def test_redis(self):
+        client = FakeRedis()
+        with override_settings(TELEGRAM_STATE_BACKEND={
+            'BACKEND': 'telegram_django_bot.state_backend.RedisStateBackend',
+            'OPTIONS': {'client': client, 'timeout': 60},
+        }):
+            self.assertIsInstance(get_state_backend(), RedisStateBackend)
+            self.check_form_drafts()
+
+            self.user.save_form_in_db('TestForm', {'int': 1})
+            self.assertEqual(1, len(client.data))
+
+            key = get_state_backend().get_key(self.user.id)
+            client.data[key] = (client.data[key][0], time.monotonic() - 1)  # draft is expired
+            self.assertEqual({}, User.objects.get(id=self.user.id).current_utrl_form)
@@ -1,10 +1,19 @@
 from telegram_django_bot.test import TD_TestCase
 from telegram_django_bot.models import ActionLog, TeleDeepLink, BotMenuElem
-from telegram_django_bot.utils import handler_decor
+from telegram_django_bot.utils import handler_decor, async_handler_decor
+from telegram_django_bot.user_cache import get_user_cache, LocMemUserCache, DjangoCacheUserCache
+from telegram_django_bot.action_log_writer import (
+    BufferedActionLogWriter, ThreadActionLogWriter, AsyncioActionLogWriter, get_action_log_writer,
+)
+from asgiref.sync import async_to_sync, sync_to_async
 from django.conf import settings
+from django.test import override_settings
 from test_app.models import User
 
+import asyncio
+import threading
 import unittest
+from unittest import mock
 import telegram
 
 
@@ -18,6 +27,11 @@ def func_with_error(bot, update, user):
     raise ArithmeticError('error :(')
 
 
+@async_handler_decor(log_type='C')
+async def async_normal_func(bot, update, user):
+    return
+
+
 class TestHandlerDecor(TD_TestCase):
     def setUp(self) -> None:
         self.user_id = settings.TELEGRAM_TEST_USER_IDS[0]
@@ -51,6 +65,198 @@ class TestHandlerDecor(TD_TestCase):
         self.assertEqual(1, ActionLog.objects.filter(user_id=self.user_id, type='func_with_error').count())
 
 
+    def test_daily_active_log(self):
+        normal_func(self.update, self.test_callback_context)
+        with self.assertNumQueries(2):  # user, ActionLog, no ACTION_ACTIVE_TODAY checking
+            normal_func(self.update, self.test_callback_context)
+        self.assertEqual(1, ActionLog.objects.filter(type='ACTION_ACTIVE_TODAY').count())
+
+    @override_settings(TELEGRAM_DAILY_ACTIVE_TRACKER={
+        'BACKEND': 'telegram_django_bot.daily_activity.DjangoCacheDailyActiveTracker',
+        'OPTIONS': {'key_prefix': 'test_daily_active_log_in_cache'},
+    })
+    def test_daily_active_log_in_cache(self):
+        normal_func(self.update, self.test_callback_context)
+        with self.assertNumQueries(2):
+            normal_func(self.update, self.test_callback_context)
+        self.assertEqual(1, ActionLog.objects.filter(type='ACTION_ACTIVE_TODAY').count())
+
+    @override_settings(TELEGRAM_DAILY_ACTIVE_TRACKER=None)
+    def test_daily_active_log_without_tracker(self):
+        normal_func(self.update, self.test_callback_context)
+        with self.assertNumQueries(3):
+            normal_func(self.update, self.test_callback_context)
+        self.assertEqual(1, ActionLog.objects.filter(type='ACTION_ACTIVE_TODAY').count())
+
     # def test_language(self):
     #     # todo:
-    #     pass
\ No newline at end of file
+    #     pass
+
+
+@override_settings(TELEGRAM_USER_CACHE={'BACKEND': 'telegram_django_bot.user_cache.LocMemUserCache'})
+class TestHandlerDecorUserCache(TD_TestCase):
+    def setUp(self) -> None:
+        self.user_id = settings.TELEGRAM_TEST_USER_IDS[0]
+        self.update = self.create_update({'text': '/start'})
+
+    def test_user_from_cache(self):
+        normal_func(self.update, self.test_callback_context)
+        user_cache = get_user_cache()
+        self.assertIsInstance(user_cache, LocMemUserCache)
+        self.assertEqual({'hits': 0, 'misses': 1}, user_cache.get_stats())
+
+        with self.assertNumQueries(1):  # action log
+            normal_func(self.update, self.test_callback_context)
+        self.assertEqual({'hits': 1, 'misses': 1}, user_cache.get_stats())
+
+        user = User.objects.get(id=self.user_id)
+        user.first_name = 'changed'
+        user.save()
+        self.assertIsNone(user_cache.get(self.user_id))
+
+        normal_func(self.update, self.test_callback_context)
+        user.refresh_from_db()
+        self.assertEqual('test', user.first_name)
+        self.assertEqual('test', user_cache.get(self.user_id).first_name)
+
+    def test_cache_expiring(self):
+        user_cache = LocMemUserCache(timeout=0, max_size=1)
+        user = User.objects.create(id=self.user_id, username=self.user_id)
+        user_cache.set(user)
+        self.assertIsNone(user_cache.get(self.user_id))
+
+        user_cache.timeout = 300
+        user_cache.set(user)
+        user_cache.set(User(id=1))
+        self.assertIsNone(user_cache.get(self.user_id))
+        self.assertEqual(1, user_cache.get(1).id)
+
+
+    def test_concurrent_updates_of_user(self):
+        for user_cache in [get_user_cache(), DjangoCacheUserCache(key_prefix='test_concurrent_updates_of_user')]:
+            User.objects.update_or_create(id=self.user_id, defaults={'username': self.user_id, 'current_utrl': ''})
+            user_cache.set(User.objects.get(id=self.user_id))
+
+            # 2 updates of the user are handled at the same time, the first one changes the state
+            user_1, user_2 = user_cache.get(self.user_id), user_cache.get(self.user_id)
+            with mock.patch('telegram_django_bot.user_cache.get_user_cache', return_value=user_cache):
+                user_1.current_utrl = 'cat/se'
+                user_1.save_state()
+            user_cache.set(user_1)
+            user_cache.set(user_2)  # the slower update does not overwrite the state
+            self.assertEqual('cat/se', user_cache.get(self.user_id).current_utrl)
+
+            user_cache.delete(self.user_id)
+            user_cache.set(user_2)
+            self.assertIsNone(user_cache.get(self.user_id))
+
+
+class TestActionLogWriter(TD_TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create(id=settings.TELEGRAM_TEST_USER_IDS[0], username='test')
+
+    def test_buffered_writer(self):
+        writer = BufferedActionLogWriter(max_batch_size=2, max_queue_size=3)
+        for it in range(5):
+            writer.add(self.user.id, f'action{it}')
+
+        self.assertEqual(3, writer.queue_size)
+        self.assertEqual(2, writer.dropped_amount)
+        self.assertEqual(0, ActionLog.objects.count())
+
+        with self.assertNumQueries(2):
+            writer.flush()
+
+        self.assertEqual(0, writer.queue_size)
+        self.assertEqual(3, writer.written_amount)
+        self.assertEqual(
+            ['action0', 'action1', 'action2'],
+            list(ActionLog.objects.order_by('id').values_list('type', flat=True))
+        )
+
+    def test_blocked_adding(self):
+        writer = BufferedActionLogWriter(max_queue_size=1, overflow_policy='block', block_timeout=0.01)
+        writer.add(self.user.id, 'action0')
+        writer.add(self.user.id, 'action1')
+        self.assertEqual(1, writer.dropped_amount)
+
+        self.assertRaises(ValueError, BufferedActionLogWriter, overflow_policy='unknown')
+
+    @override_settings(TELEGRAM_ACTION_LOG_WRITER={
+        'BACKEND': 'telegram_django_bot.action_log_writer.BufferedActionLogWriter',
+    })
+    def test_handler_decor_with_buffer(self):
+        normal_func(self.create_update({'text': '/start'}), self.test_callback_context)
+        self.assertEqual(0, ActionLog.objects.count())
+
+        writer = get_action_log_writer()
+        self.assertEqual(2, writer.queue_size)  # command and ACTION_ACTIVE_TODAY
+        writer.flush()
+        self.assertEqual(2, ActionLog.objects.count())
+
+    def test_thread_writer(self):
+        writer = ThreadActionLogWriter(max_batch_size=2, flush_interval=10)
+        flushed_logs = []
+        is_flushed = threading.Event()
+
+        def flush():  # db of the test is not available in the writer thread
+            with writer._condition:
+                flushed_logs.extend(writer._buffer)
+                writer._buffer = []
+            if flushed_logs:
+                is_flushed.set()
+
+        writer.flush = flush
+        writer.add(self.user.id, 'action0')
+        writer.add(self.user.id, 'action1')  # batch is ready, the thread flushes it without waiting interval
+        self.assertTrue(is_flushed.wait(5))
+        self.assertEqual(['action0', 'action1'], [log.type for log in flushed_logs])
+
+        writer.add(self.user.id, 'action2')
+        writer.close()
+        self.assertFalse(writer._thread.is_alive())
+        self.assertEqual(3, len(flushed_logs))
+
+    def test_asyncio_writer(self):
+        writer = AsyncioActionLogWriter(max_batch_size=2, flush_interval=10)
+
+        async def log_from_threads():
+            writer.start()
+            for it in range(2):
+                await sync_to_async(writer.add)(self.user.id, f'action{it}')  # as in handlers
+            for _ in range(500):
+                if writer.written_amount:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(2, writer.written_amount)
+
+            await sync_to_async(writer.add)(self.user.id, 'action2')
+            await writer.aclose()
+
+        async_to_sync(log_from_threads)()
+        self.assertEqual(3, ActionLog.objects.count())
+
+    def test_asyncio_writer_without_loop(self):
+        writer = AsyncioActionLogWriter(max_batch_size=2, flush_interval=10)
+        writer.add(self.user.id, 'action0')
+        writer.add(self.user.id, 'action1')  # there is no flushing task, batch is written in the thread
+        self.assertEqual(0, writer.queue_size)
+        self.assertEqual(2, ActionLog.objects.count())
+
+    @override_settings(TELEGRAM_ACTION_LOG_WRITER={
+        'BACKEND': 'telegram_django_bot.action_log_writer.AsyncioActionLogWriter',
+        'OPTIONS': {'flush_interval': 0.01},
+    })
+    def test_async_handler_decor_starts_writer(self):
+        async def handle():
+            await async_normal_func(self.create_update({'text': '/start'}), self.test_callback_context)
+            writer = get_action_log_writer()
+            self.assertIsNotNone(writer._task)
+            for _ in range(500):
+                if writer.written_amount == 2:  # command and ACTION_ACTIVE_TODAY
+                    break
+                await asyncio.sleep(0.01)
+            await writer.aclose()
+
+        async_to_sync(handle)()
+        self.assertEqual(2, ActionLog.objects.count())
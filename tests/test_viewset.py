@@ -1,11 +1,15 @@
 from telegram_django_bot.test import TD_TestCase
 from telegram_django_bot.routing import telegram_reverse, RouterCallbackMessageCommandHandler
 from django.conf import settings
+from django.core.cache import caches
+from telegram_django_bot import count_cache
+from telegram_django_bot.count_cache import get_cached_count
 
 from test_app.models import Entity, Order, Size, User, Category
 from test_app.views import CategoryViewSet, EntityViewSet, OrderViewSet
 
 import unittest
+from unittest import mock
 import telegram
 
 
@@ -317,6 +321,26 @@ class TestTelegramViewSet(TD_TestCase):
         self.assertEqual(mess[5], f'<b>Price</b>: {entity.price:.2f}')
         self.assertEqual(mess[6], f'<b>Author id</b>: {self.user.id}')
 
+    def test_show_list_related_plan(self):
+        self.assertEqual((['category'], ['sizes']), EntityViewSet.get_related_plan())
+
+        size = self.create_size()
+        for _ in range(3):
+            self.create_entity(self.create_category(), size)
+
+        with self.assertNumQueries(3):  # count, page with categories, sizes
+            _, (mess, buttons) = self.evs.show_list()
+        self.assertEqual(3, mess.count(f'<b>Sizes</b>: {size.name}'))
+
+        entity_pk = Entity.objects.first().pk
+        with self.assertNumQueries(2):  # entity with category, sizes
+            self.evs.show_elem(entity_pk)
+
+        class NoPrefetchEntityViewSet(EntityViewSet):
+            prefetch_related_fields = []
+
+        self.assertEqual((['category'], []), NoPrefetchEntityViewSet.get_related_plan())
+
     @unittest.skipIf(int(telegram.__version__.split('.')[0]) >= 20, 'tests do not support async')
     def test_show_list_entity_v2(self):
         category = self.create_category()
@@ -559,6 +583,18 @@ class TestTelegramViewSet(TD_TestCase):
         self.assertEqual(button_3[0]['text'], '🔙 Return to list')
         self.assertEqual(button_3[0]['callback_data'], 'cat/sl')
 
+    def test_as_handler(self):
+        handler = CategoryViewSet.as_handler('^cat/')
+        self.assertIs(handler, CategoryViewSet.as_handler('^cat/'))
+        self.assertIsNot(handler, EntityViewSet.as_handler('^cat/'))
+
+        self.assertEqual(
+            {'cr': 'create', 'up': 'change', 'de': 'delete', 'se': 'show_elem', 'sl': 'show_list'},
+            self.cvs.actions_routing
+        )
+        self.assertEqual(self.cvs.show_list, self.cvs.viewset_routing['sl'])
+        self.assertIs(CategoryViewSet.get_permissions()[0], self.cvs.get_permissions()[0])
+
     def test_generate_links(self):
         self.assertEqual(
             'cat/cr&name&hat',
@@ -648,6 +684,105 @@ class TestTelegramViewSet(TD_TestCase):
         self.assertEqual(button_2['text'], '️▶️️')
         self.assertEqual(button_2['callback_data'], 'cat/sl&1')
 
+    def test_show_list_keyset_pagination(self):
+        categories = [Category.objects.create(name=f'cat {it}') for it in range(5)]
+        self.cvs.use_keyset_pagination = True
+
+        with self.assertNumQueries(1):
+            _, (mess, buttons) = self.cvs.show_list('', 2)
+        self.assertEqual(['️▶️️'], [button.text for button in buttons[0]])
+        self.assertEqual(f'cat/sl&1:n:{categories[1].pk}', buttons[0][0].callback_data)
+
+        _, (mess, buttons) = self.cvs.show_list(f'1:n:{categories[1].pk}', 2)
+        self.assertEqual(f'3. Category #{categories[2].pk}', buttons[1][0].text)
+        self.assertEqual(
+            [f'cat/sl&0:p:{categories[2].pk}', f'cat/sl&2:n:{categories[3].pk}'],
+            [button.callback_data for button in buttons[0]]
+        )
+
+        _, (mess, buttons) = self.cvs.show_list(f'2:n:{categories[3].pk}', 2)
+        self.assertEqual([f'cat/sl&1:p:{categories[4].pk}'], [button.callback_data for button in buttons[0]])
+        self.assertEqual(f'5. Category #{categories[4].pk}', buttons[1][0].text)
+
+        _, (mess, buttons) = self.cvs.show_list(f'0:p:{categories[2].pk}', 2)
+        self.assertEqual([f'cat/sl&1:n:{categories[1].pk}'], [button.callback_data for button in buttons[0]])
+        self.assertEqual(f'1. Category #{categories[0].pk}', buttons[1][0].text)
+
+        self.cvs.keyset_pagination_field = '-pk'
+        _, (mess, buttons) = self.cvs.show_list('', 2)
+        self.assertEqual(f'1. Category #{categories[4].pk}', buttons[1][0].text)
+        self.assertEqual(f'cat/sl&1:n:{categories[3].pk}', buttons[0][0].callback_data)
+
+    def test_show_list_count_cache(self):
+        caches['default'].clear()
+        self.create_category()
+        self.cvs.show_list_count_cache_timeout = 60
+
+        with self.assertNumQueries(2):  # count, page
+            self.cvs.show_list()
+        with self.assertNumQueries(1):
+            self.cvs.show_list()
+
+        self.create_category()
+        with self.assertNumQueries(2):  # count is reset after saving
+            _, (mess, buttons) = self.cvs.show_list(0, 1)
+        self.assertEqual(['️▶️️'], [button.text for button in buttons[0]])
+
+        self.cvs.use_approximate_count = True  # no statistics in sqlite, so the count is exact
+        self.cvs.show_list_count_cache_timeout = None
+        self.assertEqual(2, self.cvs.show_list_get_count())
+
+    def test_count_cache_signals(self):
+        get_cached_count(Category.objects.all(), 'test_count_cache_signals')
+        with mock.patch.object(count_cache, 'invalidate_counts') as invalidate_counts:
+            Size.objects.create(name='not counted')
+            invalidate_counts.assert_not_called()
+
+            self.create_category()
+            invalidate_counts.assert_called_once_with(Category)
+
+    def test_count_cache_of_related_models(self):
+        caches['default'].clear()
+        category = self.create_category()
+        entity = self.create_entity(category, self.create_size())
+        order = self.create_order(entity)
+
+        entities = Entity.objects.filter(category__name='hats')
+        self.assertEqual([Category, Entity], count_cache.get_queryset_models(entities))
+        self.assertEqual(0, get_cached_count(entities, 'entities of hats'))
+        Category.objects.filter(pk=category.pk).update(name='hats')
+        self.assertEqual(0, get_cached_count(entities, 'entities of hats'))  # bulk update is not seen
+        category.refresh_from_db()
+        category.save()
+        self.assertEqual(1, get_cached_count(entities, 'entities of hats'))
+
+        orders = Order.objects.filter(entities__name='test')
+        self.assertEqual(1, get_cached_count(orders, 'заказы test'))
+        order.entities.remove(entity)
+        self.assertEqual(0, get_cached_count(orders, 'заказы test'))
+
+    def test_count_cache_key(self):
+        cache = mock.MagicMock(wraps=caches['default'])
+        with mock.patch.object(count_cache, 'caches', {'default': cache}):
+            get_cached_count(Category.objects.all(), 'key with spaces and символы ' * 20)
+
+        count_key = cache.set.call_args[0][0]
+        self.assertRegex(count_key, r'^telegram_django_bot_count:[0-9a-f]{32}$')
+
+    def test_approximate_count_by_explain(self):
+        queryset = Category.objects.filter(name='a')
+        for plan in [[{'Plan': {'Plan Rows': 123}}], '[{"Plan": {"Plan Rows": 123}}]']:  # psycopg2 and text
+            cursor = mock.MagicMock()
+            cursor.__enter__.return_value.fetchone.return_value = (plan,)
+            connection = mock.MagicMock(vendor='postgresql')
+            connection.cursor.return_value = cursor
+
+            with mock.patch.object(count_cache, 'connections', {'default': connection}):
+                self.assertEqual(123, count_cache.get_approximate_count(queryset))
+
+            sql = cursor.__enter__.return_value.execute.call_args[0][0]
+            self.assertTrue(sql.startswith('EXPLAIN (FORMAT JSON) SELECT'))
+
     def test_gm_success_created(self):
         model = self.create_category()
         _, (mess, buttons) = self.cvs.gm_success_created(model.pk)